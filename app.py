@@ -6,7 +6,7 @@ Routes are organized in separate blueprint modules in the routes package.
 """
 
 from flask import Flask
-from database import init_database, add_sample_data
+from database import init_database, add_sample_data, close_pools
 from routes import register_blueprints
 
 
@@ -34,4 +34,8 @@ def create_app():
 
 if __name__ == '__main__':
     app = create_app()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    try:
+        app.run(debug=True, host='0.0.0.0', port=5000)
+    finally:
+        # Write out queued payment ledger entries before the process exits
+        close_pools()
@@ -0,0 +1,53 @@
+"""
+Benchmark: sharded fee job wall time from 1 to N worker processes.
+
+Seeds a temporary database with --loans open loans, then runs the job as a
+new run for each worker count and reports the speedup over one worker.
+Speedup is bounded by the number of CPU cores on the machine.
+
+Usage:
+    python benchmarks/bench_fee_job.py [--loans 2000000] [--workers 1 2 4 8] [--chunk-size 100000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import database
+from services import fee_job
+from bench_overdue_sweep import seed_loans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--loans', type=int, default=2_000_000)
+    parser.add_argument('--patrons', type=int, default=100_000)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--chunk-size', type=int, default=fee_job.DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'bench.db')
+        database.init_database()
+        now = datetime.now()
+        seed_loans(args.loans, args.patrons, now)
+        print(f"{args.loans} open loans, {os.cpu_count()} CPU cores")
+
+        print(f"{'workers':>8} {'seconds':>9} {'loans/s':>12} {'speedup':>8}")
+        baseline = None
+        for workers in args.workers:
+            summary = fee_job.run_fee_job(workers=workers, chunk_size=args.chunk_size, as_of=now, resume=False)
+            baseline = baseline or summary['elapsed']
+            print(f"{workers:>8} {summary['elapsed']:>9.2f} {args.loans / summary['elapsed']:>12.0f} "
+                  f"{baseline / summary['elapsed']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark: loading a patron's borrowing history and current loans.
+
+Times get_patron_borrowing_history (full history and one 50-row page) and
+get_patron_borrowed_books for patrons with growing histories. Rows are
+written through insert_borrow_record/close_open_loan, so the benchmark runs
+against whatever date storage the schema currently uses.
+
+Usage:
+    python benchmarks/bench_history_loading.py [--sizes 100 1000 10000 50000] [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import database
+
+
+def seed_history(patron_id: str, book_id: int, loans: int):
+    """Give the patron `loans` returned loans plus five open ones, in one transaction."""
+    start = datetime.now() - timedelta(days=loans + 30)
+    with database.transaction() as conn:
+        for i in range(loans + 5):
+            borrowed = start + timedelta(days=i)
+            database.insert_borrow_record(patron_id, book_id, borrowed, borrowed + timedelta(days=14), conn=conn)
+            if i < loans:
+                database.close_open_loan(patron_id, book_id, borrowed + timedelta(days=10), conn=conn)
+
+
+def timed(function, repeat: int) -> float:
+    function()  # warm up
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'bench.db')
+        database.init_database()
+        database.insert_book('Benchmark Book', 'Author', '9990000000002', 1, 1)
+        book_id = database.get_book_by_isbn('9990000000002')['id']
+
+        print(f"{'history rows':>12} {'full ms':>10} {'page ms':>10} {'current ms':>11}")
+        for n, size in enumerate(args.sizes):
+            patron_id = f'{600000 + n}'
+            seed_history(patron_id, book_id, size)
+            full = timed(lambda: database.get_patron_borrowing_history(patron_id), args.repeat)
+            page = timed(lambda: database.get_patron_borrowing_history(patron_id, limit=50), args.repeat)
+            current = timed(lambda: database.get_patron_borrowed_books(patron_id), args.repeat)
+            print(f'{size:>12} {full:>10.3f} {page:>10.3f} {current:>11.3f}')
+        database.close_pools()
+
+
+if __name__ == '__main__':
+    main()
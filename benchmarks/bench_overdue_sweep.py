@@ -0,0 +1,81 @@
+"""
+Benchmark: overdue sweep over millions of open loans vs. per-loan fee lookups.
+
+Seeds a temporary database with --loans open loans (spread over --patrons
+patrons, a third of them not yet due), runs the sweep with each engine, and
+times calculate_late_fee_for_book on a sample to extrapolate the cost of the
+one-call-per-loan approach.
+
+Usage:
+    python benchmarks/bench_overdue_sweep.py [--loans 10000000] [--patrons 500000] [--engines numpy python]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import database
+from services import overdue_sweep
+from services.library_service import calculate_late_fee_for_book
+
+
+def seed_loans(loans: int, patrons: int, now: datetime):
+    """Insert open loans due between 10 days from now and 60 days ago, on 1000 books."""
+    conn = database.get_db_connection()
+    conn.executemany('INSERT INTO books (title, author, isbn, total_copies, available_copies) VALUES (?, ?, ?, ?, ?)',
+                     ((f'Bench Book {i}', 'Author', f'{9900000000000 + i}', 10 ** 6, 10 ** 6) for i in range(1000)))
+    rng = random.Random(42)
+
+    def rows():
+        for i in range(loans):
+            due = now - timedelta(days=rng.randint(-10, 60), seconds=rng.randint(0, 86399))
+            yield (f'{100000 + i % patrons}', 1 + i % 1000, database.to_epoch(due - timedelta(days=14)), database.to_epoch(due))
+
+    conn.executemany('INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) VALUES (?, ?, ?, ?)',
+                     rows())
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--loans', type=int, default=10_000_000)
+    parser.add_argument('--patrons', type=int, default=500_000)
+    parser.add_argument('--chunk-size', type=int, default=overdue_sweep.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--engines', nargs='+', choices=overdue_sweep.ENGINES,
+                        default=[e for e in overdue_sweep.ENGINES if e != 'numpy' or overdue_sweep.np is not None])
+    parser.add_argument('--sample', type=int, default=2000, help="per-loan calls timed for the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'bench.db')
+        database.init_database()
+        now = datetime.now()
+        started = time.perf_counter()
+        seed_loans(args.loans, args.patrons, now)
+        print(f"seeded {args.loans} open loans in {time.perf_counter() - started:.1f}s")
+
+        print(f"{'engine':>10} {'seconds':>9} {'loans/s':>12} {'patrons':>9} {'total fees':>14}")
+        for engine in args.engines:
+            summary = overdue_sweep.sweep_overdue_fees(as_of=now, chunk_size=args.chunk_size, engine=engine)
+            print(f"{engine:>10} {summary['elapsed']:>9.2f} {args.loans / summary['elapsed']:>12.0f} "
+                  f"{summary['patrons']:>9} {summary['total_fees']:>14.2f}")
+
+        started = time.perf_counter()
+        for i in range(args.sample):
+            calculate_late_fee_for_book(f'{100000 + i % args.patrons}', 1 + i % 1000)
+        per_call = (time.perf_counter() - started) / args.sample
+        print(f"{'per-loan':>10} {per_call * args.loans:>9.0f} {1 / per_call:>12.0f}  "
+              f"(extrapolated from {args.sample} calculate_late_fee_for_book calls)")
+
+
+if __name__ == '__main__':
+    main()
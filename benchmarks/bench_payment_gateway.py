@@ -0,0 +1,73 @@
+"""
+Benchmark: per-call gateway latency with a pooled session vs. a new connection per call.
+
+Starts the local stand-in gateway (services.gateway_server), then makes
+--calls charges through PaymentGateway (one shared, pooled requests.Session)
+and the same number with a bare requests.post per call, which opens a new
+TCP connection each time as the old client would have. Run with --threads
+to drive the calls concurrently.
+
+Usage:
+    python benchmarks/bench_payment_gateway.py [--calls 500] [--threads 1] [--latency 0]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import requests
+
+from services.gateway_server import StandInGatewayServer
+from services.payment_service import PaymentGateway, configure_gateway_client
+
+
+def pooled_charge(_):
+    started = time.perf_counter()
+    assert PaymentGateway().process_payment('123456', 2.50, 'bench')[0]
+    return time.perf_counter() - started
+
+
+def unpooled_charge(url):
+    started = time.perf_counter()
+    response = requests.post(f'{url}/charges', json={'customer_id': '123456', 'amount': 2.50, 'currency': 'usd'},
+                             headers={'Authorization': 'Bearer test_key_12345', 'Connection': 'close'},
+                             timeout=(3.05, 10.0))
+    assert response.status_code == 200
+    return time.perf_counter() - started
+
+
+def run(call, arg, calls: int, threads: int):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(call, [arg] * calls))
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the stand-in adds per response")
+    args = parser.parse_args()
+
+    with StandInGatewayServer(latency=args.latency) as server:
+        configure_gateway_client(base_url=server.url, pool_size=max(args.threads, 1))
+        print(f"{'client':>10} {'mean ms':>9} {'p95 ms':>9} {'calls/s':>9} {'connections':>12}")
+        for name, call, arg in (('pooled', pooled_charge, None), ('unpooled', unpooled_charge, server.url)):
+            before = server.connections
+            latencies, elapsed = run(call, arg, args.calls, args.threads)
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            print(f'{name:>10} {statistics.mean(latencies) * 1000:>9.2f} {p95 * 1000:>9.2f} '
+                  f'{args.calls / elapsed:>9.0f} {server.connections - before:>12}')
+        configure_gateway_client(base_url='')
+
+
+if __name__ == '__main__':
+    main()
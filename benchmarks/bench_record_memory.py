@@ -0,0 +1,86 @@
+"""
+Benchmark: memory held by catalog and loan-history results.
+
+Seeds --rows books and a patron with --rows returned loans, then loads them
+with get_all_books and get_patron_borrowing_history and reports the memory
+the returned list keeps alive (measured with tracemalloc), scaled to
+1M rows, plus the load time without tracing.
+
+Usage:
+    python benchmarks/bench_record_memory.py [--rows 1000000]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import database
+
+
+def seed(rows: int):
+    """Insert `rows` books and `rows` returned loans of book 1 for patron 600000."""
+    conn = database.get_db_connection()
+    conn.executemany('''
+        INSERT INTO books (title, author, isbn, total_copies, available_copies)
+        VALUES (?, ?, ?, 3, 3)
+    ''', ((f'Memory Book {i}', f'Author {i % 5000}', f'{9800000000000 + i}') for i in range(rows)))
+    start = datetime.now() - timedelta(days=rows // 24 + 30)
+    loans = ((start + timedelta(hours=i)) for i in range(rows))
+    conn.executemany('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date)
+        VALUES ('600000', 1, ?, ?, ?)
+    ''', ((database.to_epoch(b), database.to_epoch(b + timedelta(days=14)),
+           database.to_epoch(b + timedelta(days=10))) for b in loans))
+    conn.commit()
+    conn.close()
+
+
+def measure(load, rows: int):
+    """Return (MB retained per 1M rows, load seconds) for load()."""
+    gc.collect()
+    started = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - started
+    del result
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = load()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(result) == rows
+    return retained / rows * 1_000_000 / 2 ** 20, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'bench.db')
+        database.init_database()
+        seed(args.rows)
+
+        print(f"{'result':>28} {'MB per 1M rows':>15} {'load s':>8}")
+        for name, load in (('get_all_books', database.get_all_books),
+                           ('get_patron_borrowing_history',
+                            lambda: database.get_patron_borrowing_history('600000'))):
+            megabytes, elapsed = measure(load, args.rows)
+            print(f'{name:>28} {megabytes:>15.0f} {elapsed:>8.2f}')
+        database.close_pools()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark: get_patron_status_report latency as a patron's loan history grows.
+
+The report should stay flat because current loans and the history page are
+index seeks and late fees are computed in one pass over the loaded loans.
+
+Usage:
+    python benchmarks/bench_status_report.py [--sizes 10 100 1000 5000] [--repeat 50]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import database
+from services.library_service import get_patron_status_report
+
+
+def seed_history(patron_id: str, book_id: int, loans: int):
+    """Give the patron `loans` returned loans plus three open ones."""
+    start = datetime.now() - timedelta(days=loans + 30)
+    rows = []
+    for i in range(loans + 3):
+        borrowed = start + timedelta(days=i)
+        returned = database.to_epoch(borrowed + timedelta(days=10)) if i < loans else None
+        rows.append((patron_id, book_id, database.to_epoch(borrowed), database.to_epoch(borrowed + timedelta(days=14)),
+                     returned))
+    conn = database.get_db_connection()
+    conn.executemany('''
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000, 20000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'bench.db')
+        database.init_database()
+        database.insert_book('Benchmark Book', 'Author', '9990000000001', 1, 1)
+        book_id = database.get_book_by_isbn('9990000000001')['id']
+
+        print(f"{'history rows':>12} {'ms/report':>10}")
+        for n, size in enumerate(args.sizes):
+            patron_id = f'{500000 + n}'
+            seed_history(patron_id, book_id, size)
+            get_patron_status_report(patron_id)  # warm up
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                get_patron_status_report(patron_id)
+            elapsed = (time.perf_counter() - started) / args.repeat
+            print(f'{size:>12} {elapsed * 1000:>10.3f}')
+        database.close_pools()
+
+
+if __name__ == '__main__':
+    main()
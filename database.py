@@ -3,24 +3,540 @@ Database module for Library Management System
 Handles all database operations and connections
 """
 
+import atexit
+import json
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.request import pathname2url
 
 # Database configuration
 DATABASE = 'library.db'
 
+# Connection pool configuration
+POOL_SIZE = 5
+POOL_TIMEOUT = 10.0  # seconds to wait for a free connection before giving up
+HEALTH_CHECK_INTERVAL = 30.0  # idle seconds after which a connection is pinged on checkout
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('busy_timeout', 5000),
+)
+
+
+# Columns of the books table exposed to callers (excludes the normalized search columns)
+BOOK_COLUMNS = 'id, title, author, isbn, total_copies, available_copies'
+
+# Columns of a loan (borrow_records br joined to books b), in Loan field order
+LOAN_COLUMNS = 'br.id, br.patron_id, br.book_id, b.title, b.author, br.borrow_date, br.due_date, br.return_date'
+
+# borrow_records dates (and patrons.last_activity) are stored as integer
+# seconds since 1970-01-01 on the naive local clock, with no time zone shift,
+# so day arithmetic in SQL agrees exactly with datetime arithmetic in Python.
+# Values are converted to datetime only when they leave this module.
+EPOCH = datetime(1970, 1, 1)
+_ONE_SECOND = timedelta(seconds=1)
+
+def to_epoch(value: datetime) -> int:
+    """Convert a naive datetime to stored epoch seconds (sub-second part dropped)."""
+    return (value - EPOCH) // _ONE_SECOND
+
+def from_epoch(seconds: Optional[int]) -> Optional[datetime]:
+    """Convert stored epoch seconds back to a naive datetime (None stays None)."""
+    return None if seconds is None else EPOCH + timedelta(seconds=seconds)
+
+
+class Record:
+    """
+    Base for the lightweight row records returned by the helpers below.
+
+    Fields live in __slots__, so a record has no per-row __dict__. Records
+    read like the dicts they replace, as attributes (templates) or by key
+    (record['title'], record.get('title')); to_json() gives a JSON-ready
+    dict for API responses.
+    """
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> Tuple[str, ...]:
+        return self._fields
+
+    def __contains__(self, key) -> bool:
+        return key in self._fields
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields)
+        return f'{type(self).__name__}({values})'
+
+    def to_json(self) -> Dict:
+        return {name: getattr(self, name) for name in self._fields}
+
+
+class Book(Record):
+    """A books row (BOOK_COLUMNS)."""
+    __slots__ = ('id', 'title', 'author', 'isbn', 'total_copies', 'available_copies')
+    _fields = __slots__
+
+    def __init__(self, id, title, author, isbn, total_copies, available_copies):
+        self.id = id
+        self.title = title
+        self.author = author
+        self.isbn = isbn
+        self.total_copies = total_copies
+        self.available_copies = available_copies
+
+    def to_json(self) -> Dict:
+        return {'id': self.id, 'title': self.title, 'author': self.author, 'isbn': self.isbn,
+                'total_copies': self.total_copies, 'available_copies': self.available_copies}
+
+
+class Loan(Record):
+    """
+    A borrow_records row (LOAN_COLUMNS), with the book's title and author.
+
+    Dates are kept as the stored epoch seconds and only turned into datetimes
+    when read (borrow_date, due_date, return_date) or into ISO strings by
+    to_json(). late_fee, days_overdue and amount_paid stay None until a
+    caller prices the loan.
+    """
+    __slots__ = ('loan_id', 'patron_id', 'book_id', 'title', 'author',
+                 'borrow_epoch', 'due_epoch', 'return_epoch', 'late_fee', 'days_overdue', 'amount_paid')
+    _fields = ('loan_id', 'patron_id', 'book_id', 'title', 'author',
+               'borrow_date', 'due_date', 'return_date', 'is_returned', 'is_overdue')
+
+    def __init__(self, loan_id, patron_id, book_id, title, author, borrow_epoch, due_epoch, return_epoch=None):
+        self.loan_id = loan_id
+        self.patron_id = patron_id
+        self.book_id = book_id
+        self.title = title
+        self.author = author
+        self.borrow_epoch = borrow_epoch
+        self.due_epoch = due_epoch
+        self.return_epoch = return_epoch
+        self.late_fee = None
+        self.days_overdue = None
+        self.amount_paid = None
+
+    @property
+    def borrow_date(self) -> datetime:
+        return from_epoch(self.borrow_epoch)
+
+    @property
+    def due_date(self) -> datetime:
+        return from_epoch(self.due_epoch)
+
+    @property
+    def return_date(self) -> Optional[datetime]:
+        return from_epoch(self.return_epoch)
+
+    @property
+    def is_returned(self) -> bool:
+        return self.return_epoch is not None
+
+    @property
+    def is_overdue(self) -> bool:
+        """Still open and past its due date right now."""
+        return self.return_epoch is None and self.due_epoch < to_epoch(datetime.now())
+
+    def to_json(self) -> Dict:
+        data = {
+            'loan_id': self.loan_id,
+            'patron_id': self.patron_id,
+            'book_id': self.book_id,
+            'title': self.title,
+            'author': self.author,
+            'borrow_date': from_epoch(self.borrow_epoch).isoformat(),
+            'due_date': from_epoch(self.due_epoch).isoformat(),
+            'return_date': None if self.return_epoch is None else from_epoch(self.return_epoch).isoformat(),
+            'is_returned': self.return_epoch is not None,
+            'is_overdue': self.is_overdue
+        }
+        if self.late_fee is not None:
+            data['late_fee'] = self.late_fee
+            data['days_overdue'] = self.days_overdue
+        if self.amount_paid is not None:
+            data['amount_paid'] = self.amount_paid
+        return data
+
+
+def _book_row(cursor, row) -> Book:
+    """row_factory building a Book from a BOOK_COLUMNS row."""
+    return Book(*row)
+
+def _loan_row(cursor, row) -> Loan:
+    """row_factory building a Loan from a LOAN_COLUMNS row."""
+    return Loan(*row)
+
+def _fetch_records(db, row_factory, sql: str, params=()) -> list:
+    """Run a query on a cursor of its own with the given row_factory and fetch every row."""
+    cursor = db.cursor()
+    cursor.row_factory = row_factory
+    return cursor.execute(sql, params).fetchall()
+
+def _casefold(value):
+    """SQL function casefold(): Unicode case folding used for the *_norm search columns."""
+    return value.casefold() if isinstance(value, str) else value
+
+
+class PooledConnection:
+    """
+    Thin wrapper around a pooled sqlite3 connection.
+
+    Behaves like the underlying connection, except that close() hands the
+    connection back to its pool instead of closing it. Helpers hold one
+    through _use_connection() so it is released even when a query raises;
+    a wrapper that is garbage-collected unreleased is returned as well.
+    """
+
+    __slots__ = ('_pool', '_conn')
+
+    def __init__(self, pool: 'ConnectionPool', conn: sqlite3.Connection):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Same semantics as sqlite3.Connection used as a context manager
+        if exc_type is None:
+            self._conn.commit()
+        else:
+            self._conn.rollback()
+        return False
+
+    def close(self):
+        """Return the connection to the pool."""
+        conn = self._conn
+        if conn is not None:
+            object.__setattr__(self, '_conn', None)
+            self._pool.release(conn)
+
+    def __del__(self):
+        # A wrapper dropped without close() (a caller that raised before
+        # reaching it) still hands its connection back instead of leaking the slot
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of SQLite connections for a single database file.
+
+    Connections are created lazily up to ``size``, configured once with the
+    PRAGMAs in ``pragmas`` and reused across requests and threads. Callers
+    that find the pool exhausted wait up to ``timeout`` seconds.
+    """
+
+    def __init__(self, database: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 pragmas: Tuple = SQLITE_PRAGMAS, health_check_interval: float = HEALTH_CHECK_INTERVAL):
+        if size < 1:
+            raise ValueError('Pool size must be at least 1.')
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()  # (connection, released_at); LIFO keeps hot connections warm
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # This enables column access by name
+        conn.create_function('casefold', 1, _casefold, deterministic=True)
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name}={value}')
+        return conn
+
+    def _new_connection(self) -> sqlite3.Connection:
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        with self._lock:
+            self._stats['connections_created'] += 1
+        return conn
+
+    def _discard(self, conn: sqlite3.Connection):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+            self._stats['connections_discarded'] += 1
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> PooledConnection:
+        """Check a connection out of the pool, waiting if all are in use."""
+        if self._closed:
+            raise sqlite3.ProgrammingError('Connection pool is closed.')
+
+        started = time.perf_counter()
+        waited = False
+        try:
+            conn, released_at = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                conn, released_at = self._new_connection(), None
+            else:
+                waited = True
+                try:
+                    conn, released_at = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise sqlite3.OperationalError(
+                        f'Timed out after {self.timeout}s waiting for a database connection.')
+
+        if released_at is not None and time.monotonic() - released_at > self.health_check_interval:
+            if not self._is_healthy(conn):
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                self._discard(conn)
+                with self._lock:
+                    self._created += 1
+                conn = self._new_connection()
+
+        wait_time = time.perf_counter() - started
+        with self._lock:
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+        return PooledConnection(self, conn)
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, rolling back any unfinished transaction."""
+        if self._closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    def close(self):
+        """Close every idle connection; connections still checked out are closed on release."""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self) -> Dict:
+        """Snapshot of pool usage counters for sizing the pool under load."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open_connections'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['open_connections'] - stats['idle']
+        stats['avg_wait_time'] = stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """Get the connection pool for the currently configured DATABASE, creating it on first use."""
+    pool = _pools.get(DATABASE)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(DATABASE)
+            if pool is None:
+                pool = ConnectionPool(DATABASE, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=SQLITE_PRAGMAS,
+                                      health_check_interval=HEALTH_CHECK_INTERVAL)
+                _pools[DATABASE] = pool
+    return pool
+
+def configure_pool(size: Optional[int] = None, timeout: Optional[float] = None,
+                   pragmas: Optional[Tuple] = None, health_check_interval: Optional[float] = None):
+    """Change pool settings. Existing pools are closed so the new settings apply to every connection."""
+    global POOL_SIZE, POOL_TIMEOUT, SQLITE_PRAGMAS, HEALTH_CHECK_INTERVAL
+    if size is not None:
+        if size < 1:
+            raise ValueError('Pool size must be at least 1.')
+        POOL_SIZE = size
+    if timeout is not None:
+        POOL_TIMEOUT = timeout
+    if pragmas is not None:
+        SQLITE_PRAGMAS = tuple(pragmas)
+    if health_check_interval is not None:
+        HEALTH_CHECK_INTERVAL = health_check_interval
+    close_pools()
+
+def close_pools():
+    """
+    Close all connection pools (e.g. on shutdown or after switching DATABASE).
+    Queued payment ledger entries are written out first.
+    """
+    try:
+        close_ledger_writers()
+    finally:
+        with _pools_lock:
+            pools = list(_pools.values())
+            _pools.clear()
+        for pool in pools:
+            pool.close()
+
+def get_pool_stats() -> Dict:
+    """Get usage statistics for the current database's connection pool."""
+    return get_pool().stats()
+
 def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
-    return conn
+    """Get a database connection from the pool. Calling close() returns it to the pool."""
+    return get_pool().acquire()
 
-def init_database():
-    """Initialize the database with required tables."""
-    conn = get_db_connection()
+# Catalog change tracking
+#
+# A version counter per database file, kept in the single catalog_state row
+# and bumped by triggers on every change to the books table, whichever
+# process or connection commits it. Caches and HTTP validators key catalog
+# output by it; reading it is one primary-key lookup.
+
+def get_catalog_state(conn=None) -> Tuple[str, int, float]:
+    """
+    Get the catalog's change state for DATABASE.
     
-    # Create books table
+    Returns:
+        tuple: (instance, version, changed_at) - a random ID fixed when the
+        database was created (versions restart with a new file), the change
+        counter, and the time of the last change in epoch seconds
+    """
+    with _use_connection(conn) as db:
+        row = db.execute('SELECT instance, version, changed_at FROM catalog_state WHERE id = 1').fetchone()
+    return row['instance'], row['version'], row['changed_at']
+
+def get_catalog_version() -> int:
+    """Get the current catalog version for DATABASE."""
+    return get_catalog_state()[1]
+
+def bump_catalog_version() -> int:
+    """Record that the catalog changed (the books triggers do this on every change). Returns the new version."""
+    with _use_connection() as conn:
+        conn.execute(f'UPDATE catalog_state SET version = version + 1, changed_at = {_SQL_NOW_EPOCH} WHERE id = 1')
+        conn.commit()
+        return get_catalog_state(conn)[1]
+
+@contextmanager
+def transaction():
+    """
+    Unit of work: run several helpers on one connection and commit once.
+
+    Opens the transaction with BEGIN IMMEDIATE so the write lock is taken up
+    front and read-then-write sequences cannot interleave with other writers.
+    Commits when the block exits normally and rolls back if it raises.
+
+    Usage:
+        with transaction() as conn:
+            book = get_book_by_id(book_id, conn=conn)
+            insert_borrow_record(patron_id, book_id, borrow_date, due_date, conn=conn)
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+@contextmanager
+def _use_connection(conn=None):
+    """Yield the caller's connection, or a pooled one that is released afterwards."""
+    if conn is not None:
+        yield conn
+        return
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def init_database():
+    """Initialize the database by applying any pending schema migrations."""
+    migrate()
+
+# Schema Migrations
+#
+# Each migration is (version, description, function). They run in version
+# order, each in its own transaction, and the version is recorded in the
+# schema_version table so a migration runs exactly once per database. New
+# schema changes are appended to MIGRATIONS with the next version number;
+# existing entries must not be edited. Migrations are written to be safe on
+# databases created before this framework existed.
+
+def _create_base_tables(conn):
+    """Migration 1: create the books and borrow_records tables."""
     conn.execute('''
         CREATE TABLE IF NOT EXISTS books (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -32,7 +548,6 @@ def init_database():
         )
     ''')
     
-    # Create borrow_records table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS borrow_records (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -44,184 +559,1713 @@ def init_database():
             FOREIGN KEY (book_id) REFERENCES books (id)
         )
     ''')
+
+def _create_borrow_record_indexes(conn):
+    """
+    Migration 2: index the borrow_records lookups.
+    
+    Open-loan queries use partial indexes (WHERE return_date IS NULL) that
+    stay small no matter how much history accumulates.
+    """
+    # Paged patron history, newest first
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_borrow_date
+        ON borrow_records (patron_id, borrow_date)
+    ''')
+    # A patron's open loans: borrow count, current loans, closing a loan on return
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_open_by_patron
+        ON borrow_records (patron_id, borrow_date) WHERE return_date IS NULL
+    ''')
+    # Open loans of a book
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_open_by_book
+        ON borrow_records (book_id, patron_id) WHERE return_date IS NULL
+    ''')
+    # Overdue sweeps over all open loans
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_open_by_due_date
+        ON borrow_records (due_date) WHERE return_date IS NULL
+    ''')
+
+def _add_normalized_columns(conn):
+    """
+    Migration 3: add casefolded title_norm/author_norm columns to books.
+    
+    Existing rows are backfilled. Both columns are indexed so prefix
+    searches become range seeks instead of lowercasing every row per query.
+    """
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(books)')}
+    for column in ('title_norm', 'author_norm'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE books ADD COLUMN {column} TEXT')
+    conn.execute('''
+        UPDATE books SET title_norm = casefold(title), author_norm = casefold(author)
+        WHERE title_norm IS NULL OR author_norm IS NULL
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_title_norm ON books (title_norm)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_author_norm ON books (author_norm)')
+
+def _create_search_index(conn):
+    """
+    Migration 4: create the books_fts full-text index over title/author and its sync triggers.
+    
+    Uses the FTS5 trigram tokenizer so any substring of three or more
+    characters can be looked up through the index (case-insensitive), which
+    preserves the partial-match semantics of catalog search. Does nothing if
+    this SQLite build lacks FTS5; search then falls back to a table scan.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+    ).fetchone()
+    if not exists:
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE books_fts USING fts5(
+                    title, author, content='books', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            return
+        # Index the books that existed before the search index did
+        conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_after_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_after_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_after_update AFTER UPDATE OF title, author ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+
+def _create_catalog_page_indexes(conn):
+    """
+    Migration 5: index the catalog's (title, id) keyset order.
+    
+    The partial index covers the "available only" filter so that page fetch
+    time does not depend on how many unavailable books precede the cursor.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_title_id ON books (title, id)')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_books_available_title_id
+        ON books (title, id) WHERE available_copies > 0
+    ''')
+
+def _create_borrow_date_index(conn):
+    """Migration 6: index borrow_records by borrow_date for date-range exports."""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_borrow_date
+        ON borrow_records (borrow_date)
+    ''')
+
+def _create_fee_report_tables(conn):
+    """
+    Migration 7: overdue sweep runs and their per-patron fee totals.
+    
+    Each run of the nightly sweep gets a fee_sweep_runs row; its per-patron
+    totals go to overdue_fee_report under that run id. The open-loans-by-due-
+    date index is replaced by one that also covers patron_id, so the sweep
+    reads only the index and never visits the table rows.
+    """
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_open_by_due_date_patron
+        ON borrow_records (due_date, patron_id) WHERE return_date IS NULL
+    ''')
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_open_by_due_date')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fee_sweep_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            as_of TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            overdue_loans INTEGER,
+            patrons INTEGER,
+            total_fees REAL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS overdue_fee_report (
+            run_id INTEGER NOT NULL,
+            patron_id TEXT NOT NULL,
+            overdue_loans INTEGER NOT NULL,
+            total_fees REAL NOT NULL,
+            PRIMARY KEY (run_id, patron_id),
+            FOREIGN KEY (run_id) REFERENCES fee_sweep_runs (id)
+        )
+    ''')
+
+def _create_fee_job_tables(conn):
+    """
+    Migration 8: shards of the process-pool fee job.
+    
+    A job run is a fee_sweep_runs row split into patron_id ranges; a shard's
+    finished_at is set in the same transaction that stores its report rows,
+    so a crashed job resumes with exactly the shards that were not saved.
+    Workers read a shard's open loans through the (patron_id, due_date) index.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fee_job_shards (
+            run_id INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            patron_low TEXT,
+            patron_high TEXT,
+            finished_at TEXT,
+            overdue_loans INTEGER,
+            total_fees REAL,
+            PRIMARY KEY (run_id, shard),
+            FOREIGN KEY (run_id) REFERENCES fee_sweep_runs (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_borrow_records_open_by_patron_due_date
+        ON borrow_records (patron_id, due_date) WHERE return_date IS NULL
+    ''')
+
+# Rebuilds patrons.active_loans / last_activity from borrow_records (fees start at 0)
+PATRON_COUNTERS_SQL = '''
+    INSERT INTO patrons (patron_id, active_loans, accrued_fees, last_activity)
+    SELECT patron_id, SUM(return_date IS NULL), 0,
+           MAX(MAX(borrow_date), COALESCE(MAX(return_date), MAX(borrow_date)))
+    FROM borrow_records
+    GROUP BY patron_id
+'''
+
+def _create_patron_summary_table(conn):
+    """
+    Migration 9: per-patron summary counters.
+    
+    active_loans and last_activity are kept current by the borrow/return
+    helpers in the same transaction as the loan change, so the borrowing
+    limit and status header are primary-key lookups. Existing counters are
+    backfilled here; accrued_fees for past returns is filled in by the
+    reconciliation command (services.patron_accounts), which owns the fee rules.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patrons (
+            patron_id TEXT PRIMARY KEY,
+            active_loans INTEGER NOT NULL DEFAULT 0,
+            accrued_fees REAL NOT NULL DEFAULT 0,
+            last_activity TEXT
+        )
+    ''')
+    conn.execute(PATRON_COUNTERS_SQL)
+
+def _convert_dates_to_epoch(conn):
+    """
+    Migration 10: store borrow_records dates and patrons.last_activity as
+    INTEGER epoch seconds instead of ISO strings.
+    
+    SQLite cannot change a column's type in place, so each table is rebuilt
+    and its indexes are recreated from their original definitions.
+    strftime('%s') reads the ISO text as-is (no time zone shift), matching to_epoch.
+    """
+    index_sql = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'borrow_records' AND sql IS NOT NULL"
+    )]
+    conn.execute('''
+        CREATE TABLE borrow_records_epoch (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            borrow_date INTEGER NOT NULL,
+            due_date INTEGER NOT NULL,
+            return_date INTEGER,
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO borrow_records_epoch (id, patron_id, book_id, borrow_date, due_date, return_date)
+        SELECT id, patron_id, book_id,
+               CAST(strftime('%s', borrow_date) AS INTEGER),
+               CAST(strftime('%s', due_date) AS INTEGER),
+               CAST(strftime('%s', return_date) AS INTEGER)
+        FROM borrow_records
+    ''')
+    conn.execute('DROP TABLE borrow_records')
+    conn.execute('ALTER TABLE borrow_records_epoch RENAME TO borrow_records')
+    for sql in index_sql:
+        conn.execute(sql)
+    
+    conn.execute('''
+        CREATE TABLE patrons_epoch (
+            patron_id TEXT PRIMARY KEY,
+            active_loans INTEGER NOT NULL DEFAULT 0,
+            accrued_fees REAL NOT NULL DEFAULT 0,
+            last_activity INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO patrons_epoch (patron_id, active_loans, accrued_fees, last_activity)
+        SELECT patron_id, active_loans, accrued_fees, CAST(strftime('%s', last_activity) AS INTEGER)
+        FROM patrons
+    ''')
+    conn.execute('DROP TABLE patrons')
+    conn.execute('ALTER TABLE patrons_epoch RENAME TO patrons')
+
+def _create_payment_allocation_table(conn):
+    """
+    Migration 11: how each late fee payment was split across the patron's loans.
+    
+    A pay-all charge is one gateway transaction covering several loans; it
+    gets one row per loan, looked up by transaction or by loan.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fee_payment_allocations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id TEXT NOT NULL,
+            patron_id TEXT NOT NULL,
+            loan_id INTEGER NOT NULL,
+            book_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            paid_at INTEGER NOT NULL,
+            FOREIGN KEY (loan_id) REFERENCES borrow_records (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_fee_payment_allocations_transaction
+        ON fee_payment_allocations (transaction_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_fee_payment_allocations_loan
+        ON fee_payment_allocations (loan_id)
+    ''')
+
+def _create_idempotency_table(conn):
+    """
+    Migration 12: results of payment gateway calls, by idempotency key.
+    
+    A row is 'pending' while its call is in flight and 'completed' (with the
+    JSON-encoded result) once the gateway has answered, so a retried request
+    is answered from here instead of charging or refunding twice.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            operation TEXT NOT NULL,
+            status TEXT NOT NULL,
+            response TEXT,
+            created_at INTEGER NOT NULL,
+            completed_at INTEGER
+        )
+    ''')
+
+def _create_payment_verification_table(conn):
+    """
+    Migration 13: gateway statuses confirmed by payment reconciliation.
+    
+    Transactions that reached a terminal status are recorded here once, so
+    later reconciliation runs skip them instead of asking the gateway again.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_verifications (
+            transaction_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            amount REAL,
+            verified_at INTEGER NOT NULL
+        )
+    ''')
+
+def _create_payment_ledger_table(conn):
+    """
+    Migration 14: ledger of late fee payments and refunds, one row per loan.
+    
+    Amounts are positive; entry_type says whether they were paid or refunded.
+    The (loan_id, entry_type, amount) index covers the paid-amount lookup
+    made when pricing loans. Pay-all allocations recorded before the ledger
+    existed are copied in.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entry_type TEXT NOT NULL,
+            transaction_id TEXT NOT NULL,
+            patron_id TEXT,
+            loan_id INTEGER,
+            book_id INTEGER,
+            amount REAL NOT NULL,
+            recorded_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payment_ledger_loan
+        ON payment_ledger (loan_id, entry_type, amount)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payment_ledger_transaction
+        ON payment_ledger (transaction_id)
+    ''')
+    conn.execute('''
+        INSERT INTO payment_ledger (entry_type, transaction_id, patron_id, loan_id, book_id, amount, recorded_at)
+        SELECT 'payment', transaction_id, patron_id, loan_id, book_id, amount, paid_at
+        FROM fee_payment_allocations
+        ORDER BY id
+    ''')
+
+def _create_normalized_column_triggers(conn):
+    """
+    Migration 15: keep title_norm/author_norm in sync with title/author through triggers.
+    
+    Like books_fts, the casefolded columns are maintained by the database on
+    every insert and on any update of title or author, so an edited book is
+    found by prefix search under its new name. Rows that drifted before the
+    triggers existed are corrected.
+    """
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_norm_after_insert AFTER INSERT ON books BEGIN
+            UPDATE books SET title_norm = casefold(new.title), author_norm = casefold(new.author)
+            WHERE id = new.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_norm_after_update AFTER UPDATE OF title, author ON books BEGIN
+            UPDATE books SET title_norm = casefold(new.title), author_norm = casefold(new.author)
+            WHERE id = new.id;
+        END
+    ''')
+    conn.execute('''
+        UPDATE books SET title_norm = casefold(title), author_norm = casefold(author)
+        WHERE title_norm IS NOT casefold(title) OR author_norm IS NOT casefold(author)
+    ''')
+
+# Current time in epoch seconds (with fractions) as an SQL expression
+_SQL_NOW_EPOCH = "(julianday('now') - 2440587.5) * 86400.0"
+
+def _create_catalog_state_table(conn):
+    """
+    Migration 16: catalog change counter kept in the database by triggers.
+    
+    Any insert, update or delete on books bumps catalog_state.version and
+    stamps changed_at, so a change committed by another process (or by
+    hand) invalidates cached pages and HTTP validators as well. instance
+    is random per database, so a recreated file never reuses old versions.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            instance TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            changed_at REAL NOT NULL
+        )
+    ''')
+    conn.execute(f'''
+        INSERT OR IGNORE INTO catalog_state (id, instance, version, changed_at)
+        VALUES (1, lower(hex(randomblob(6))), 0, {_SQL_NOW_EPOCH})
+    ''')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS books_catalog_after_{event.lower()} AFTER {event} ON books BEGIN
+                UPDATE catalog_state SET version = version + 1, changed_at = {_SQL_NOW_EPOCH} WHERE id = 1;
+            END
+        ''')
+
+def _guard_normalized_column_triggers(conn):
+    """
+    Migration 17: fire the casefolding triggers only when the *_norm columns are stale.
     
-    conn.commit()
-    conn.close()
+    Books are inserted with title_norm/author_norm already filled in, so the
+    row is written once; an unconditional AFTER INSERT update wrote it a
+    second time and bumped catalog_state twice per book. Writes that leave
+    the columns stale (by hand, or from older code) are still corrected.
+    """
+    for event, trigger in (('INSERT', 'books_norm_after_insert'),
+                           ('UPDATE OF title, author', 'books_norm_after_update')):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        conn.execute(f'''
+            CREATE TRIGGER {trigger} AFTER {event} ON books
+            WHEN new.title_norm IS NOT casefold(new.title) OR new.author_norm IS NOT casefold(new.author)
+            BEGIN
+                UPDATE books SET title_norm = casefold(new.title), author_norm = casefold(new.author)
+                WHERE id = new.id;
+            END
+        ''')
+
+MIGRATIONS = [
+    (1, 'create books and borrow_records tables', _create_base_tables),
+    (2, 'index borrow_records lookups', _create_borrow_record_indexes),
+    (3, 'add casefolded title/author search columns', _add_normalized_columns),
+    (4, 'create books_fts full-text index', _create_search_index),
+    (5, 'index catalog pages by (title, id)', _create_catalog_page_indexes),
+    (6, 'index borrow_records by borrow_date', _create_borrow_date_index),
+    (7, 'create overdue fee report tables', _create_fee_report_tables),
+    (8, 'create fee job shard table', _create_fee_job_tables),
+    (9, 'create patrons summary table', _create_patron_summary_table),
+    (10, 'store loan dates as integer epoch seconds', _convert_dates_to_epoch),
+    (11, 'create fee payment allocation table', _create_payment_allocation_table),
+    (12, 'create idempotency key table', _create_idempotency_table),
+    (13, 'create payment verification table', _create_payment_verification_table),
+    (14, 'create payment ledger table', _create_payment_ledger_table),
+    (15, 'maintain casefolded title/author columns by trigger', _create_normalized_column_triggers),
+    (16, 'track catalog changes in catalog_state by trigger', _create_catalog_state_table),
+    (17, 'skip the casefolding triggers when *_norm is already current', _guard_normalized_column_triggers),
+]
+
+def get_schema_version(conn=None) -> int:
+    """Get the highest migration version applied to the database (0 if none)."""
+    with _use_connection(conn) as db:
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+        ).fetchone()
+        if not exists:
+            return 0
+        return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+def migrate(target_version: Optional[int] = None) -> int:
+    """
+    Apply pending migrations up to target_version (default: all of them).
+    
+    Safe to call on every startup and from several processes at once: each
+    migration re-checks the recorded version after taking the write lock.
+    
+    Returns:
+        int: The schema version after migrating
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        ''')
+        conn.commit()
+        
+        for version, description, apply_migration in MIGRATIONS:
+            if target_version is not None and version > target_version:
+                break
+            if version <= get_schema_version(conn):
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if version > get_schema_version(conn):
+                    apply_migration(conn)
+                    conn.execute(
+                        'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                        (version, description, datetime.now().isoformat()))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        
+        return get_schema_version(conn)
+    finally:
+        conn.close()
 
 def add_sample_data():
     """Add sample data to the database if it's empty."""
-    conn = get_db_connection()
-    book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
-    
-    if book_count == 0:
-        # Add sample books
-        sample_books = [
-            ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
-            ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
-            ('1984', 'George Orwell', '9780451524935', 1)
-        ]
+    with _use_connection() as conn:
+        book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
+    
+        if book_count == 0:
+            # Add sample books
+            sample_books = [
+                ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
+                ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
+                ('1984', 'George Orwell', '9780451524935', 1)
+            ]
+        
+            for title, author, isbn, copies in sample_books:
+                conn.execute('''
+                    INSERT INTO books (title, author, isbn, total_copies, available_copies, title_norm, author_norm)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (title, author, isbn, copies, copies, _casefold(title), _casefold(author)))
         
-        for title, author, isbn, copies in sample_books:
+            # Make 1984 unavailable by adding a borrow record
             conn.execute('''
-                INSERT INTO books (title, author, isbn, total_copies, available_copies)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (title, author, isbn, copies, copies))
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+                VALUES (?, ?, ?, ?)
+            ''', ('123456', 3, 
+                  to_epoch(datetime.now() - timedelta(days=5)),
+                  to_epoch(datetime.now() + timedelta(days=9))))
         
-        # Make 1984 unavailable by adding a borrow record
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', ('123456', 3, 
-              (datetime.now() - timedelta(days=5)).isoformat(),
-              (datetime.now() + timedelta(days=9)).isoformat()))
+            _update_patron_summary(conn, '123456', loans_change=1, activity=datetime.now() - timedelta(days=5))
         
-        # Update available copies for 1984
-        conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
+            # Update available copies for 1984
+            conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
         
-        conn.commit()
+            conn.commit()
     
-    conn.close()
 
 # Helper Functions for Database Operations
 
-def get_all_books() -> List[Dict]:
+def get_all_books() -> List[Book]:
     """Get all books from the database."""
-    conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY title').fetchall()
-    conn.close()
-    return [dict(book) for book in books]
+    with _use_connection() as conn:
+        books = _fetch_records(conn, _book_row, f'SELECT {BOOK_COLUMNS} FROM books ORDER BY title')
+    return books
+
+def get_books_page(after: Optional[Tuple[str, int]] = None, limit: int = 50,
+                   available_only: bool = False) -> Tuple[List[Book], Optional[Tuple[str, int]]]:
+    """
+    Get one page of the catalog in (title, id) order using keyset pagination.
+    
+    Args:
+        after: (title, id) of the last book on the previous page, or None for the first page
+        limit: Maximum number of books on the page
+        available_only: Only include books with at least one available copy
+        
+    Returns:
+        tuple: (books, next_after) where next_after is None on the last page
+    """
+    conditions = []
+    params = []
+    if after is not None:
+        conditions.append('(title, id) > (?, ?)')
+        params.extend(after)
+    if available_only:
+        conditions.append('available_copies > 0')
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    
+    with _use_connection() as conn:
+        # One extra row tells us whether there is a next page
+        books = _fetch_records(conn, _book_row, f'''
+            SELECT {BOOK_COLUMNS} FROM books
+            {where}
+            ORDER BY title, id
+            LIMIT ?
+        ''', (*params, limit + 1))
+    
+    if len(books) > limit:
+        books = books[:limit]
+        return books, (books[-1].title, books[-1].id)
+    return books, None
 
-def get_book_by_id(book_id: int) -> Optional[Dict]:
+def get_book_by_id(book_id: int, conn=None) -> Optional[Book]:
     """Get a specific book by ID."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
+    with _use_connection(conn) as conn:
+        books = _fetch_records(conn, _book_row, f'SELECT {BOOK_COLUMNS} FROM books WHERE id = ?', (book_id,))
+    return books[0] if books else None
 
-def get_book_by_isbn(isbn: str) -> Optional[Dict]:
+def get_book_by_isbn(isbn: str) -> Optional[Book]:
     """Get a specific book by ISBN."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
+    with _use_connection() as conn:
+        books = _fetch_records(conn, _book_row, f'SELECT {BOOK_COLUMNS} FROM books WHERE isbn = ?', (isbn,))
+    return books[0] if books else None
+
+def search_books(field: str, term: str, limit: Optional[int] = None, offset: int = 0) -> List[Book]:
+    """
+    Case-insensitive partial-match search on the title or author column, ordered by title.
+    
+    Terms of three or more characters are answered from the books_fts trigram
+    index; shorter terms (which have no trigram) fall back to scanning the
+    stored casefolded column.
+    """
+    if field not in ('title', 'author'):
+        raise ValueError(f'Cannot search on column {field!r}.')
+    
+    with _use_connection() as conn:
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        ).fetchone()
+        if has_fts and len(term) >= 3:
+            # Quote the term as an FTS5 phrase so it matches as a literal substring
+            phrase = '"' + term.replace('"', '""') + '"'
+            books = _fetch_records(conn, _book_row, '''
+                SELECT b.id, b.title, b.author, b.isbn, b.total_copies, b.available_copies FROM books_fts
+                JOIN books b ON b.id = books_fts.rowid
+                WHERE books_fts MATCH ?
+                ORDER BY b.title, b.id
+                LIMIT ? OFFSET ?
+            ''', (f'{field} : {phrase}', -1 if limit is None else limit, offset))
+        else:
+            books = _fetch_records(conn, _book_row, f'''
+                SELECT {BOOK_COLUMNS} FROM books
+                WHERE instr({field}_norm, ?) > 0
+                ORDER BY title, id
+                LIMIT ? OFFSET ?
+            ''', (term.casefold(), -1 if limit is None else limit, offset))
+    return books
+
+def search_books_by_prefix(field: str, prefix: str, limit: Optional[int] = None, offset: int = 0) -> List[Book]:
+    """
+    Case-insensitive prefix search on the title or author column.
+    
+    Runs as a range seek on the casefolded, indexed {field}_norm column, so
+    results come back in that column's order.
+    """
+    if field not in ('title', 'author'):
+        raise ValueError(f'Cannot search on column {field!r}.')
+    
+    low = prefix.casefold()
+    high = low + '\U0010ffff'  # sorts after every string that starts with low
+    with _use_connection() as conn:
+        books = _fetch_records(conn, _book_row, f'''
+            SELECT {BOOK_COLUMNS} FROM books
+            WHERE {field}_norm >= ? AND {field}_norm < ?
+            ORDER BY {field}_norm, id
+            LIMIT ? OFFSET ?
+        ''', (low, high, -1 if limit is None else limit, offset))
+    return books
 
-def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
+def get_patron_borrowed_books(patron_id: str) -> List[Loan]:
     """Get currently borrowed books for a patron."""
-    conn = get_db_connection()
-    records = conn.execute('''
-        SELECT br.*, b.title, b.author 
-        FROM borrow_records br 
-        JOIN books b ON br.book_id = b.id 
-        WHERE br.patron_id = ? AND br.return_date IS NULL
-        ORDER BY br.borrow_date
-    ''', (patron_id,)).fetchall()
-    conn.close()
-    
-    borrowed_books = []
-    for record in records:
-        borrowed_books.append({
-            'book_id': record['book_id'],
-            'title': record['title'],
-            'author': record['author'],
-            'borrow_date': datetime.fromisoformat(record['borrow_date']),
-            'due_date': datetime.fromisoformat(record['due_date']),
-            'is_overdue': datetime.now() > datetime.fromisoformat(record['due_date'])
-        })
-    
-    return borrowed_books
-
-def get_patron_borrow_count(patron_id: str) -> int:
-    """Get the number of books currently borrowed by a patron."""
-    conn = get_db_connection()
-    count = conn.execute('''
-        SELECT COUNT(*) as count FROM borrow_records 
-        WHERE patron_id = ? AND return_date IS NULL
-    ''', (patron_id,)).fetchone()['count']
-    conn.close()
-    return count
+    with _use_connection() as conn:
+        loans = _fetch_records(conn, _loan_row, f'''
+            SELECT {LOAN_COLUMNS}
+            FROM borrow_records br 
+            JOIN books b ON br.book_id = b.id 
+            WHERE br.patron_id = ? AND br.return_date IS NULL
+            ORDER BY br.borrow_date
+        ''', (patron_id,))
+    return loans
+
+def get_loans_due_between(start: datetime, end: datetime, limit: Optional[int] = None) -> List[Loan]:
+    """
+    Get open loans due in [start, end), earliest first (e.g. for due-soon reminders).
+    The range is a seek on the open-loans (due_date, patron_id) index.
+    """
+    with _use_connection() as conn:
+        loans = _fetch_records(conn, _loan_row, f'''
+            SELECT {LOAN_COLUMNS}
+            FROM borrow_records br INDEXED BY idx_borrow_records_open_by_due_date_patron
+            JOIN books b ON br.book_id = b.id
+            WHERE br.return_date IS NULL AND br.due_date >= ? AND br.due_date < ?
+            ORDER BY br.due_date, br.patron_id
+            LIMIT ?
+        ''', (to_epoch(start), to_epoch(end), -1 if limit is None else limit))
+    return loans
+
+def get_patron_borrow_count(patron_id: str, conn=None) -> int:
+    """Get the number of books currently borrowed by a patron (from the patrons summary row)."""
+    with _use_connection(conn) as conn:
+        row = conn.execute(
+            'SELECT active_loans FROM patrons WHERE patron_id = ?', (patron_id,)
+        ).fetchone()
+    return row['active_loans'] if row else 0
+
+def get_patron_summary(patron_id: str, conn=None) -> Dict:
+    """Get a patron's summary counters; a patron with no activity gets zeros."""
+    with _use_connection(conn) as db:
+        row = db.execute('''
+            SELECT active_loans, accrued_fees, last_activity FROM patrons WHERE patron_id = ?
+        ''', (patron_id,)).fetchone()
+    if not row:
+        return {'patron_id': patron_id, 'active_loans': 0, 'accrued_fees': 0.00, 'last_activity': None}
+    return {
+        'patron_id': patron_id,
+        'active_loans': row['active_loans'],
+        'accrued_fees': row['accrued_fees'],
+        'last_activity': from_epoch(row['last_activity'])
+    }
+
+def _update_patron_summary(db, patron_id: str, loans_change: int = 0, fee: float = 0.0,
+                           activity: Optional[datetime] = None):
+    """Apply a change to a patron's summary row on the caller's connection (creating the row if needed)."""
+    when = to_epoch(activity) if activity is not None else None
+    db.execute('''
+        INSERT INTO patrons (patron_id, active_loans, accrued_fees, last_activity)
+        VALUES (?, MAX(?, 0), ROUND(?, 2), ?)
+        ON CONFLICT (patron_id) DO UPDATE SET
+            active_loans = MAX(active_loans + ?, 0),
+            accrued_fees = ROUND(accrued_fees + ?, 2),
+            last_activity = COALESCE(MAX(last_activity, ?), last_activity, ?)
+    ''', (patron_id, loans_change, fee, when, loans_change, fee, when, when))
+
+def add_patron_accrued_fee(patron_id: str, amount: float, conn=None):
+    """
+    Add a late fee charged on return to the patron's accrued_fees.
+    When a transaction connection is passed, the caller owns the commit.
+    """
+    with _use_connection(conn) as db:
+        _update_patron_summary(db, patron_id, fee=amount)
+        if conn is None:
+            db.commit()
 
 def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> bool:
     """Insert a new book into the database."""
-    conn = get_db_connection()
+    with _use_connection() as conn:
+        try:
+            conn.execute('''
+                INSERT INTO books (title, author, isbn, total_copies, available_copies, title_norm, author_norm)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (title, author, isbn, total_copies, available_copies, _casefold(title), _casefold(author)))
+            conn.commit()
+        except Exception as e:
+            return False
+    return True
+
+def get_existing_isbns(isbns: Iterable[str], conn=None) -> Set[str]:
+    """
+    Get which of the given ISBNs are already in the catalog.
+    One query regardless of how many ISBNs are passed (they travel as a JSON array).
+    """
+    with _use_connection(conn) as db:
+        rows = db.execute(
+            'SELECT isbn FROM books WHERE isbn IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(isbns)),)
+        ).fetchall()
+    return {row['isbn'] for row in rows}
+
+def insert_books_bulk(books: List[Tuple[str, str, str, int]], conn=None) -> int:
+    """
+    Insert many (title, author, isbn, total_copies) books with one executemany.
+    When a transaction connection is passed, the caller owns the commit.
+    
+    Returns:
+        int: Number of books inserted
+    """
+    rows = [(title, author, isbn, copies, copies, _casefold(title), _casefold(author))
+            for title, author, isbn, copies in books]
+    with _use_connection(conn) as db:
+        db.executemany('''
+            INSERT INTO books (title, author, isbn, total_copies, available_copies, title_norm, author_norm)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        if conn is None:
+            db.commit()
+    return len(rows)
+
+def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime, conn=None) -> bool:
+    """
+    Insert a new borrow record into the database.
+    When a transaction connection is passed, the caller owns the commit.
+    """
+    with _use_connection(conn) as db:
+        try:
+            db.execute('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+                VALUES (?, ?, ?, ?)
+            ''', (patron_id, book_id, to_epoch(borrow_date), to_epoch(due_date)))
+            _update_patron_summary(db, patron_id, loans_change=1, activity=borrow_date)
+            if conn is None:
+                db.commit()
+            return True
+        except Exception as e:
+            if conn is None:
+                db.rollback()
+            return False
+
+def update_book_availability(book_id: int, change: int, conn=None) -> bool:
+    """
+    Update the available copies of a book by a given amount (+1 for return, -1 for borrow).
+    When a transaction connection is passed, the caller owns the commit.
+    """
+    with _use_connection(conn) as db:
+        try:
+            db.execute('''
+                UPDATE books SET available_copies = available_copies + ? WHERE id = ?
+            ''', (change, book_id))
+            if conn is None:
+                db.commit()
+            return True
+        except Exception as e:
+            return False
+
+def checkout_book_copy(book_id: int, conn=None) -> bool:
+    """
+    Take one copy of a book if any is available.
+    The availability check and the decrement are a single guarded UPDATE, so
+    two concurrent borrowers can never both take the last copy.
+    Returns False when no copy was available.
+    """
+    with _use_connection(conn) as db:
+        cursor = db.execute('''
+            UPDATE books SET available_copies = available_copies - 1
+            WHERE id = ? AND available_copies > 0
+        ''', (book_id,))
+        if conn is None:
+            db.commit()
+    return cursor.rowcount == 1
+
+def update_borrow_record_return_date(patron_id: str, book_id: int, return_date: datetime) -> bool:
+    """Update the return date for a borrow record."""
+    with _use_connection() as conn:
+        try:
+            cursor = conn.execute('''
+                UPDATE borrow_records 
+                SET return_date = ? 
+                WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+            ''', (to_epoch(return_date), patron_id, book_id))
+            if cursor.rowcount:
+                _update_patron_summary(conn, patron_id, loans_change=-cursor.rowcount, activity=return_date)
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def close_open_loan(patron_id: str, book_id: int, return_date: datetime, conn=None) -> Optional[Loan]:
+    """
+    Close the patron's open loan for a book and return that loan (without title/author).
+    Returns None when the patron has no open loan for the book.
+    When a transaction connection is passed, the caller owns the commit.
+    """
+    with _use_connection(conn) as db:
+        loans = _fetch_records(db, _loan_row, '''
+            SELECT id, patron_id, book_id, NULL, NULL, borrow_date, due_date, NULL FROM borrow_records
+            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+            ORDER BY borrow_date
+            LIMIT 1
+        ''', (patron_id, book_id))
+        if not loans:
+            return None
+        loan = loans[0]
+        loan.return_epoch = to_epoch(return_date)
+        db.execute('UPDATE borrow_records SET return_date = ? WHERE id = ?', (loan.return_epoch, loan.loan_id))
+        _update_patron_summary(db, patron_id, loans_change=-1, activity=return_date)
+        if conn is None:
+            db.commit()
+    
+    return loan
+
+def get_patron_borrowing_history(patron_id: str, limit: Optional[int] = None, offset: int = 0) -> List[Loan]:
+    """
+    Get borrowing history for a patron, newest first.
+    Pass limit/offset to fetch one page instead of the complete history.
+    """
+    with _use_connection() as conn:
+        history = _fetch_records(conn, _loan_row, f'''
+            SELECT {LOAN_COLUMNS}
+            FROM borrow_records br 
+            JOIN books b ON br.book_id = b.id 
+            WHERE br.patron_id = ?
+            ORDER BY br.borrow_date DESC
+            LIMIT ? OFFSET ?
+        ''', (patron_id, -1 if limit is None else limit, offset))
+    return history
+
+# Columns of an exported borrow record, in output order
+EXPORT_COLUMNS = ('loan_id', 'patron_id', 'book_id', 'title', 'author', 'borrow_date', 'due_date', 'return_date')
+
+def iter_borrow_records(patron_id: Optional[str] = None, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None, batch_size: int = 1000, conn=None) -> Iterator[Dict]:
+    """
+    Stream borrow records (with book title/author) in borrow_date order.
+    
+    Rows are pulled from the cursor batch_size at a time, so memory use does
+    not grow with the number of records. Dates are passed through as stored
+    (epoch seconds); converting them is left to the output format.
+    
+    An export can stream for as long as its client reads, so by default it
+    opens its own connect_read_only() connection rather than holding a pool
+    slot; the generator closes it when exhausted, closed or collected.
+    
+    Args:
+        patron_id: Only this patron's loans (None for every patron)
+        start: Only loans borrowed at or after this time
+        end: Only loans borrowed before this time
+        batch_size: Rows fetched per fetchmany call
+        conn: Connection to read through instead (left open)
+    """
+    conditions, params = [], []
+    if patron_id is not None:
+        conditions.append('br.patron_id = ?')
+        params.append(patron_id)
+    if start is not None:
+        conditions.append('br.borrow_date >= ?')
+        params.append(to_epoch(start))
+    if end is not None:
+        conditions.append('br.borrow_date < ?')
+        params.append(to_epoch(end))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    # Without a filter, walk the table in rowid order instead of sorting it
+    order = 'br.borrow_date, br.id' if conditions else 'br.id'
+    
+    db = conn if conn is not None else connect_read_only()
     try:
-        conn.execute('''
-            INSERT INTO books (title, author, isbn, total_copies, available_copies)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (title, author, isbn, total_copies, available_copies))
+        cursor = db.execute(f'''
+            SELECT br.id AS loan_id, br.patron_id, br.book_id, b.title, b.author,
+                   br.borrow_date, br.due_date, br.return_date
+            FROM borrow_records br
+            JOIN books b ON br.book_id = b.id
+            {where}
+            ORDER BY {order}
+        ''', params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(EXPORT_COLUMNS, row))
+    finally:
+        if conn is None:
+            db.close()
+
+def connect_read_only(database: Optional[str] = None) -> sqlite3.Connection:
+    """
+    Open a separate read-only connection (outside the pool), e.g. for a worker process.
+    SQLite rejects any write made through it.
+    """
+    conn = sqlite3.connect(f'file:{pathname2url(os.path.abspath(database or DATABASE))}?mode=ro',
+                           uri=True, timeout=POOL_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.create_function('casefold', 1, _casefold, deterministic=True)
+    return conn
+
+def iter_overdue_loan_chunks(as_of: datetime, chunk_size: int = 100000,
+                             patron_range: Optional[Tuple[Optional[str], Optional[str]]] = None,
+                             conn=None) -> Iterator[Tuple[List[str], List[int], List[int]]]:
+    """
+    Stream (patron_ids, due_dates, loan_ids) column chunks for open loans due before as_of.
+    
+    Reads only a covering partial index on open loans with fetchmany (the
+    loan id is the rowid every index entry carries), so only one chunk is
+    in memory at a time. Rows come back as plain tuples (no sqlite3.Row per
+    loan) and due dates are the stored epoch seconds.
+    
+    Args:
+        as_of: Only loans due before this time
+        chunk_size: Rows per chunk
+        patron_range: (low, high) to read only patron_id >= low and < high;
+            either end may be None for an open bound
+        conn: Connection to read through (e.g. a worker's read-only one)
+    """
+    conditions, params = ['return_date IS NULL', 'due_date < ?'], [to_epoch(as_of)]
+    if patron_range is not None:
+        low, high = patron_range
+        if low is not None:
+            conditions.append('patron_id >= ?')
+            params.append(low)
+        if high is not None:
+            conditions.append('patron_id < ?')
+            params.append(high)
+    # A patron range reads through (patron_id, due_date), the whole sweep through (due_date, patron_id)
+    index = ('idx_borrow_records_open_by_patron_due_date' if patron_range is not None
+             else 'idx_borrow_records_open_by_due_date_patron')
+    
+    with _use_connection(conn) as db:
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute(f'''
+            SELECT patron_id, due_date, id FROM borrow_records INDEXED BY {index}
+            WHERE {' AND '.join(conditions)}
+        ''', params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            patron_ids, due_dates, loan_ids = zip(*rows)
+            yield list(patron_ids), list(due_dates), list(loan_ids)
+
+def get_open_loan_paid_amounts(as_of: datetime,
+                               patron_range: Optional[Tuple[Optional[str], Optional[str]]] = None,
+                               conn=None) -> Dict[int, float]:
+    """
+    Get the net amount paid on every open loan due before as_of, in one query.
+    
+    The overdue sweep and each fee job shard call this once for the loans
+    iter_overdue_loan_chunks will stream, so their totals subtract payments
+    the same way calculate_late_fee_for_book does. Without a connection,
+    the ledger is synced first (sync_ledger).
+    
+    Args:
+        as_of: Only loans due before this time
+        patron_range: (low, high) to read only patron_id >= low and < high;
+            either end may be None for an open bound
+        conn: Connection to read through (e.g. a worker's read-only one)
+    
+    Returns:
+        dict: loan_id -> amount paid, for the loans with ledger entries
+    """
+    conditions, params = ['br.return_date IS NULL', 'br.due_date < ?'], [to_epoch(as_of)]
+    if patron_range is not None:
+        low, high = patron_range
+        if low is not None:
+            conditions.append('br.patron_id >= ?')
+            params.append(low)
+        if high is not None:
+            conditions.append('br.patron_id < ?')
+            params.append(high)
+    if conn is None:
+        sync_ledger()
+    with _use_connection(conn) as db:
+        rows = db.execute(f'''
+            SELECT l.loan_id, SUM(CASE l.entry_type WHEN 'payment' THEN l.amount ELSE -l.amount END) AS paid
+            FROM payment_ledger l
+            JOIN borrow_records br ON br.id = l.loan_id
+            WHERE {' AND '.join(conditions)}
+            GROUP BY l.loan_id
+        ''', params).fetchall()
+    return {row['loan_id']: round(row['paid'], 2) for row in rows}
+
+def start_fee_sweep_run(as_of: datetime) -> int:
+    """Record the start of an overdue sweep and return its run id."""
+    with _use_connection() as conn:
+        cursor = conn.execute('INSERT INTO fee_sweep_runs (as_of, started_at) VALUES (?, ?)',
+                              (as_of.isoformat(), datetime.now().isoformat()))
         conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+    return cursor.lastrowid
 
-def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime) -> bool:
-    """Insert a new borrow record into the database."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+def save_overdue_fee_report(run_id: int, totals: Iterable[Tuple[str, int, float]]) -> Dict:
+    """
+    Write a sweep's per-patron (patron_id, overdue_loans, total_fees) rows and
+    mark the run finished, in one transaction.
+    
+    Returns:
+        dict: The run's overdue_loans, patrons and total_fees
+    """
+    rows = [(run_id, patron_id, loans, fees) for patron_id, loans, fees in totals]
+    with transaction() as conn:
+        conn.execute('DELETE FROM overdue_fee_report WHERE run_id = ?', (run_id,))
+        conn.executemany('''
+            INSERT INTO overdue_fee_report (run_id, patron_id, overdue_loans, total_fees)
             VALUES (?, ?, ?, ?)
-        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+        ''', rows)
+        return finish_fee_sweep_run(run_id, conn=conn)
 
-def update_book_availability(book_id: int, change: int) -> bool:
-    """Update the available copies of a book by a given amount (+1 for return, -1 for borrow)."""
-    conn = get_db_connection()
-    try:
+def finish_fee_sweep_run(run_id: int, conn=None) -> Dict:
+    """
+    Total up a run's report rows and mark the run finished.
+    When a transaction connection is passed, the caller owns the commit.
+    
+    Returns:
+        dict: The run's overdue_loans, patrons and total_fees
+    """
+    with _use_connection(conn) as db:
+        summary = db.execute('''
+            SELECT COALESCE(SUM(overdue_loans), 0) AS overdue_loans, COUNT(*) AS patrons,
+                   ROUND(COALESCE(SUM(total_fees), 0), 2) AS total_fees
+            FROM overdue_fee_report WHERE run_id = ?
+        ''', (run_id,)).fetchone()
+        db.execute('''
+            UPDATE fee_sweep_runs SET finished_at = ?, overdue_loans = ?, patrons = ?, total_fees = ?
+            WHERE id = ?
+        ''', (datetime.now().isoformat(), summary['overdue_loans'], summary['patrons'],
+              summary['total_fees'], run_id))
+        if conn is None:
+            db.commit()
+    return dict(summary)
+
+def get_patron_shard_bounds(shards: int) -> List[str]:
+    """
+    Split patrons with open loans into about `shards` ranges of equal loan count.
+    
+    Returns:
+        list: Sorted patron_id boundaries; shard i covers [bounds[i-1], bounds[i]),
+        with open ends before the first and after the last boundary
+    """
+    with _use_connection() as conn:
+        open_loans = conn.execute(
+            'SELECT COUNT(*) FROM borrow_records WHERE return_date IS NULL'
+        ).fetchone()[0]
+        step = -(-open_loans // max(shards, 1))
+        rows = conn.execute('''
+            SELECT DISTINCT patron_id FROM (
+                SELECT patron_id, ROW_NUMBER() OVER (ORDER BY patron_id) AS position
+                FROM borrow_records INDEXED BY idx_borrow_records_open_by_patron_due_date
+                WHERE return_date IS NULL
+            )
+            WHERE position % ? = 1 AND position > 1
+            ORDER BY patron_id
+        ''', (max(step, 1),)).fetchall()
+    return [row['patron_id'] for row in rows]
+
+def create_fee_job(as_of: datetime, patron_ranges: List[Tuple[Optional[str], Optional[str]]]) -> int:
+    """Record a new sharded fee job run with one pending shard per patron range. Returns the run id."""
+    with transaction() as conn:
+        run_id = conn.execute('INSERT INTO fee_sweep_runs (as_of, started_at) VALUES (?, ?)',
+                              (as_of.isoformat(), datetime.now().isoformat())).lastrowid
+        conn.executemany('''
+            INSERT INTO fee_job_shards (run_id, shard, patron_low, patron_high) VALUES (?, ?, ?, ?)
+        ''', [(run_id, shard, low, high) for shard, (low, high) in enumerate(patron_ranges)])
+    return run_id
+
+def get_resumable_fee_job() -> Optional[Dict]:
+    """Get the latest sharded fee job that never finished ({'run_id', 'as_of'}), or None."""
+    with _use_connection() as conn:
+        row = conn.execute('''
+            SELECT id, as_of FROM fee_sweep_runs
+            WHERE finished_at IS NULL AND id IN (SELECT run_id FROM fee_job_shards)
+            ORDER BY id DESC
+            LIMIT 1
+        ''').fetchone()
+    if not row:
+        return None
+    return {'run_id': row['id'], 'as_of': datetime.fromisoformat(row['as_of'])}
+
+def get_pending_fee_job_shards(run_id: int) -> List[Dict]:
+    """Get the shards of a fee job that have not been saved yet."""
+    with _use_connection() as conn:
+        rows = conn.execute('''
+            SELECT shard, patron_low, patron_high FROM fee_job_shards
+            WHERE run_id = ? AND finished_at IS NULL
+            ORDER BY shard
+        ''', (run_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+def save_fee_job_shard(run_id: int, shard: int, totals: Iterable[Tuple[str, int, float]]):
+    """Store one shard's per-patron (patron_id, overdue_loans, total_fees) rows and mark it finished."""
+    rows = [(run_id, patron_id, loans, fees) for patron_id, loans, fees in totals]
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT INTO overdue_fee_report (run_id, patron_id, overdue_loans, total_fees)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
         conn.execute('''
-            UPDATE books SET available_copies = available_copies + ? WHERE id = ?
-        ''', (change, book_id))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+            UPDATE fee_job_shards SET finished_at = ?, overdue_loans = ?, total_fees = ?
+            WHERE run_id = ? AND shard = ?
+        ''', (datetime.now().isoformat(), sum(row[2] for row in rows),
+              round(sum(row[3] for row in rows), 2), run_id, shard))
 
-def update_borrow_record_return_date(patron_id: str, book_id: int, return_date: datetime) -> bool:
-    """Update the return date for a borrow record."""
-    conn = get_db_connection()
-    try:
+def get_overdue_fee_report(run_id: Optional[int] = None) -> List[Dict]:
+    """Get per-patron fee totals of a sweep run (default: the latest finished run), largest first."""
+    with _use_connection() as conn:
+        if run_id is None:
+            latest = conn.execute(
+                'SELECT MAX(id) FROM fee_sweep_runs WHERE finished_at IS NOT NULL'
+            ).fetchone()[0]
+            run_id = latest if latest is not None else -1
+        rows = conn.execute('''
+            SELECT patron_id, overdue_loans, total_fees FROM overdue_fee_report
+            WHERE run_id = ?
+            ORDER BY total_fees DESC, patron_id
+        ''', (run_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+def iter_late_returns(conn=None, chunk_size: int = 10000) -> Iterator[List[Tuple[str, str, str]]]:
+    """Stream (patron_id, due_date, return_date) chunks (epoch seconds) for loans returned after their due date."""
+    with _use_connection(conn) as db:
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute('''
+            SELECT patron_id, due_date, return_date FROM borrow_records
+            WHERE return_date IS NOT NULL AND return_date > due_date
+        ''')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+def get_all_patron_summaries(conn=None) -> Dict[str, Tuple[int, float, Optional[str]]]:
+    """Get every patrons row as patron_id -> (active_loans, accrued_fees, last_activity)."""
+    with _use_connection(conn) as db:
+        cursor = db.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(
+            'SELECT patron_id, active_loans, accrued_fees, last_activity FROM patrons'
+        ).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+def rebuild_patron_summaries(accrued_fees: Dict[str, float], conn=None):
+    """
+    Replace the patrons table with counters recomputed from borrow_records and
+    the given per-patron accrued fees.
+    When a transaction connection is passed, the caller owns the commit.
+    """
+    with _use_connection(conn) as db:
+        db.execute('DELETE FROM patrons')
+        db.execute(PATRON_COUNTERS_SQL)
+        db.executemany(
+            'UPDATE patrons SET accrued_fees = ROUND(?, 2) WHERE patron_id = ?',
+            [(fees, patron_id) for patron_id, fees in accrued_fees.items()]
+        )
+        if conn is None:
+            db.commit()
+
+def get_payment_allocations(transaction_id: str) -> List[Dict]:
+    """
+    Get the per-loan allocation of a payment, in the order it was recorded.
+    
+    Read from the payment entries the payments ledger holds for the
+    transaction (queued entries are written first).
+    """
+    sync_ledger()
+    with _use_connection() as conn:
+        rows = conn.execute('''
+            SELECT loan_id, book_id, amount, recorded_at FROM payment_ledger
+            WHERE transaction_id = ? AND entry_type = 'payment'
+            ORDER BY id
+        ''', (transaction_id,)).fetchall()
+    return [{
+        'loan_id': row['loan_id'],
+        'book_id': row['book_id'],
+        'amount': row['amount'],
+        'paid_at': from_epoch(row['recorded_at'])
+    } for row in rows]
+
+def claim_idempotency_key(key: str, operation: str, stale_before: datetime,
+                          expired_before: Optional[datetime] = None) -> Tuple[bool, Optional[Dict]]:
+    """
+    Try to claim an idempotency key for a new gateway call.
+    
+    The key is claimed when it has no row yet, when its row is still
+    pending but older than stale_before (its caller died mid-call), when
+    its call's outcome was left 'unknown' (the gateway did not answer), or
+    when it completed before expired_before.
+    
+    Returns:
+        tuple: (claimed, the key's previous row as a dict, or None if it had none)
+    """
+    now = to_epoch(datetime.now())
+    with transaction() as conn:
+        row = conn.execute('''
+            SELECT key, operation, status, response, created_at, completed_at FROM idempotency_keys WHERE key = ?
+        ''', (key,)).fetchone()
+        if row is None:
+            conn.execute('''
+                INSERT INTO idempotency_keys (key, operation, status, created_at) VALUES (?, ?, 'pending', ?)
+            ''', (key, operation, now))
+            return True, None
+        claimable = (row['status'] == 'unknown'
+                     or (row['status'] == 'pending' and row['created_at'] < to_epoch(stale_before))
+                     or (row['status'] == 'completed' and expired_before is not None
+                         and row['completed_at'] < to_epoch(expired_before)))
+        if claimable:
+            conn.execute('''
+                UPDATE idempotency_keys
+                SET operation = ?, status = 'pending', response = NULL, created_at = ?, completed_at = NULL
+                WHERE key = ?
+            ''', (operation, now, key))
+    return claimable, dict(row)
+
+def get_idempotency_record(key: str) -> Optional[Dict]:
+    """Get the stored row for an idempotency key, or None."""
+    with _use_connection() as conn:
+        row = conn.execute('''
+            SELECT key, operation, status, response, created_at, completed_at FROM idempotency_keys WHERE key = ?
+        ''', (key,)).fetchone()
+    return dict(row) if row else None
+
+def complete_idempotency_key(key: str, response: str):
+    """Store the JSON-encoded result of the call made under a claimed key."""
+    with _use_connection() as conn:
         conn.execute('''
-            UPDATE borrow_records 
-            SET return_date = ? 
-            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
-        ''', (return_date.isoformat(), patron_id, book_id))
+            UPDATE idempotency_keys SET status = 'completed', response = ?, completed_at = ? WHERE key = ?
+        ''', (response, to_epoch(datetime.now()), key))
         conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
 
-def get_patron_borrowing_history(patron_id: str) -> List[Dict]:
-    """Get complete borrowing history for a patron."""
-    conn = get_db_connection()
-    records = conn.execute('''
-        SELECT br.*, b.title, b.author 
-        FROM borrow_records br 
-        JOIN books b ON br.book_id = b.id 
-        WHERE br.patron_id = ?
-        ORDER BY br.borrow_date DESC
-    ''', (patron_id,)).fetchall()
-    conn.close()
-    
-    history = []
-    for record in records:
-        history.append({
-            'book_id': record['book_id'],
-            'title': record['title'],
-            'author': record['author'],
-            'borrow_date': datetime.fromisoformat(record['borrow_date']),
-            'due_date': datetime.fromisoformat(record['due_date']),
-            'return_date': datetime.fromisoformat(record['return_date']) if record['return_date'] else None,
-            'is_returned': record['return_date'] is not None
-        })
+def mark_idempotency_key_unknown(key: str):
+    """Keep a pending key whose call got no answer, so the next request under it checks the gateway first."""
+    with _use_connection() as conn:
+        conn.execute("UPDATE idempotency_keys SET status = 'unknown' WHERE key = ? AND status = 'pending'", (key,))
+        conn.commit()
+
+def release_idempotency_key(key: str):
+    """Drop a pending key whose call did not complete, so the request can be retried."""
+    with _use_connection() as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND status = 'pending'", (key,))
+        conn.commit()
+
+def get_recorded_transactions(include_verified: bool = False) -> List[Dict]:
+    """
+    Get the late fee payments recorded locally, one row per gateway transaction.
     
-    return history
+    Transactions come from payment_ledger (queued entries are written
+    first), with amount the total paid and refunded the total refunded.
+    Single-fee payments approved before the ledger existed are only known
+    from their completed pay_late_fees idempotency records, which keep the
+    transaction ID but not the amount (None). Transactions already in
+    payment_verifications are left out unless include_verified is set.
+    
+    Returns:
+        list: {'transaction_id', 'patron_id', 'amount', 'refunded', 'recorded_at'} dicts, oldest first
+    """
+    verified_filter = '' if include_verified else '''
+        WHERE NOT EXISTS (SELECT 1 FROM payment_verifications v WHERE v.transaction_id = recorded.transaction_id)
+    '''
+    sync_ledger()
+    with _use_connection() as conn:
+        rows = conn.execute(f'''
+            SELECT transaction_id, patron_id, amount, refunded, recorded_at FROM (
+                SELECT transaction_id, MAX(patron_id) AS patron_id,
+                       ROUND(SUM(CASE entry_type WHEN 'payment' THEN amount ELSE 0 END), 2) AS amount,
+                       ROUND(SUM(CASE entry_type WHEN 'refund' THEN amount ELSE 0 END), 2) AS refunded,
+                       MIN(recorded_at) AS recorded_at
+                FROM payment_ledger
+                GROUP BY transaction_id
+                UNION ALL
+                SELECT json_extract(response, '$[2]'), NULL, NULL, 0, completed_at
+                FROM idempotency_keys
+                WHERE operation = 'pay_late_fees' AND status = 'completed'
+                  AND NOT EXISTS (SELECT 1 FROM payment_ledger l WHERE l.transaction_id = json_extract(response, '$[2]'))
+            ) AS recorded
+            {verified_filter}
+            ORDER BY recorded_at, transaction_id
+        ''').fetchall()
+    return [{
+        'transaction_id': row['transaction_id'],
+        'patron_id': row['patron_id'],
+        'amount': row['amount'],
+        'refunded': row['refunded'],
+        'recorded_at': from_epoch(row['recorded_at'])
+    } for row in rows if row['transaction_id']]
+
+def save_payment_verifications(verifications: Iterable[Tuple[str, str, Optional[float]]], conn=None) -> int:
+    """
+    Record terminal gateway statuses as (transaction_id, status, amount) tuples.
+    When a transaction connection is passed, the caller owns the commit.
+    
+    Returns:
+        int: Number of rows written
+    """
+    now = to_epoch(datetime.now())
+    rows = [(transaction_id, status, amount, now) for transaction_id, status, amount in verifications]
+    with _use_connection(conn) as db:
+        db.executemany('''
+            INSERT OR REPLACE INTO payment_verifications (transaction_id, status, amount, verified_at)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+        if conn is None:
+            db.commit()
+    return len(rows)
+
+def forget_payment_verification(transaction_id: str):
+    """Drop the recorded status of a transaction (e.g. after refunding it) so it is verified again."""
+    with _use_connection() as conn:
+        conn.execute('DELETE FROM payment_verifications WHERE transaction_id = ?', (transaction_id,))
+        conn.commit()
+
+# Payment Ledger
+#
+# Payments and refunds are appended to payment_ledger by a write-behind
+# writer per database file: record_payment() and record_refund() only queue
+# the entry, and a background thread writes whatever has queued up in one
+# transaction (group commit), so the payment request path never waits on a
+# commit. Readers of the ledger in this module sync it first (sync_ledger),
+# so a fee looked up right after a payment already reflects it, and they
+# raise rather than read a ledger still missing entries that failed to write.
+#
+# Entries are never dropped: a batch that keeps failing is held by the
+# writer and retried, and close_ledger_writers() (run at interpreter exit)
+# writes anything still held synchronously and raises if it cannot.
+
+# Most entries written in one transaction
+LEDGER_BATCH_SIZE = 500
+# Attempts at writing a batch (with backoff) before it is held for a later retry
+LEDGER_WRITE_ATTEMPTS = 5
+# Seconds between retries of held entries while nothing new is queued
+LEDGER_RETRY_SECONDS = 1.0
+
+PAYMENT = 'payment'
+REFUND = 'refund'
+
+_STOP = object()
+
+
+class LedgerWriter:
+    """
+    Background writer batching ledger entries for one database file.
+
+    Entries are (entry_type, transaction_id, patron_id, loan_id, book_id,
+    amount, recorded_at epoch) tuples. The thread starts on the first
+    submit and has its own connection. flush() waits until everything
+    submitted so far has been processed. Entries that could not be written
+    are held (in order, ahead of newer ones) and retried until they are;
+    write_held() makes a synchronous attempt on the caller's thread (as
+    close() does last) and raises if that fails.
+    """
+
+    def __init__(self, database: str, batch_size: int = LEDGER_BATCH_SIZE):
+        self.database = database
+        self.batch_size = batch_size
+        self._queue: queue.Queue = queue.Queue()
+        self._done = threading.Condition()
+        self._write_lock = threading.Lock()  # one writer of held entries at a time (thread or write_held)
+        self._submitted = 0
+        self._processed = 0
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._held: List[Tuple] = []
+        self._stats = {'written': 0, 'batches': 0, 'write_errors': 0, 'last_error': None}
+
+    def submit(self, entry: Tuple):
+        """Queue an entry; returns without touching SQLite."""
+        with self._done:
+            if self._closed:
+                raise sqlite3.ProgrammingError('Ledger writer is closed.')
+            self._submitted += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+                self._thread.start()
+            self._queue.put(entry)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every entry submitted so far has been processed.
+
+        Returns:
+            bool: False on timeout, or when entries are held after failed writes
+        """
+        with self._done:
+            target = self._submitted
+            return self._done.wait_for(lambda: self._processed >= target, timeout) and not self._held
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Write what is queued and stop the thread.
+
+        Held entries are then written on the caller's thread; if that fails
+        the sqlite3.Error is raised and the entries stay held.
+        """
+        with self._done:
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return
+        self.write_held()
+
+    def write_held(self):
+        """
+        Write the held entries on the caller's thread.
+
+        Raises the sqlite3.Error if that fails; the entries then stay held.
+        """
+        with self._write_lock:
+            with self._done:
+                held = list(self._held)
+            if not held:
+                return
+            pool = ConnectionPool(self.database, size=1)
+            try:
+                self._commit(pool, held)
+            except sqlite3.Error as e:
+                self._record_error(e)
+                raise
+            finally:
+                pool.close()
+            with self._done:
+                self._held = []
+                self._stats['written'] += len(held)
+                self._stats['batches'] += 1
+                self._done.notify_all()
+
+    def stats(self) -> Dict:
+        """Counters for the entries written so far, the current backlog and entries held after failed writes."""
+        with self._done:
+            return dict(self._stats, pending=self._submitted - self._processed, held=len(self._held))
+
+    def _run(self):
+        pool = ConnectionPool(self.database, size=1)
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    batch = [self._queue.get(timeout=LEDGER_RETRY_SECONDS if self._held else None)]
+                except queue.Empty:
+                    batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch and batch[-1] is _STOP:
+                    stopping = True
+                    batch.pop()
+                self._write(pool, batch)
+        finally:
+            pool.close()
+
+    def _write(self, pool: ConnectionPool, batch: List[Tuple]):
+        with self._write_lock:
+            # Held entries go first so the ledger keeps submission order (refunds split over earlier payments)
+            with self._done:
+                entries = self._held + batch
+            written = not entries
+            for attempt in range(LEDGER_WRITE_ATTEMPTS if entries else 0):
+                try:
+                    self._commit(pool, entries)
+                    written = True
+                    break
+                except sqlite3.Error as e:
+                    self._record_error(e)
+                    time.sleep(0.05 * 2 ** attempt)
+            with self._done:
+                if entries and written:
+                    self._stats['written'] += len(entries)
+                    self._stats['batches'] += 1
+                self._held = [] if written else entries
+                self._processed += len(batch)
+                self._done.notify_all()
+
+    @staticmethod
+    def _commit(pool: ConnectionPool, entries: List[Tuple]):
+        conn = pool.acquire()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                write_ledger_entries(entries, conn=conn)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            conn.close()
+
+    def _record_error(self, error: sqlite3.Error):
+        with self._done:
+            self._stats['write_errors'] += 1
+            self._stats['last_error'] = str(error)
+
+
+_ledger_writers: Dict[str, LedgerWriter] = {}
+_ledger_writers_lock = threading.Lock()
+
+def get_ledger_writer() -> LedgerWriter:
+    """Get the ledger writer for the currently configured DATABASE, creating it on first use."""
+    writer = _ledger_writers.get(DATABASE)
+    if writer is None:
+        with _ledger_writers_lock:
+            writer = _ledger_writers.get(DATABASE)
+            if writer is None:
+                writer = LedgerWriter(DATABASE)
+                _ledger_writers[DATABASE] = writer
+    return writer
+
+def close_ledger_writers():
+    """
+    Write out every queued ledger entry and stop the writers.
+
+    Runs from close_pools and at interpreter exit. Every writer is closed
+    even when one fails; the first error is raised afterwards.
+    """
+    with _ledger_writers_lock:
+        writers = list(_ledger_writers.values())
+        _ledger_writers.clear()
+    error = None
+    for writer in writers:
+        try:
+            writer.close()
+        except sqlite3.Error as e:
+            error = error or e
+    if error is not None:
+        raise error
+
+atexit.register(close_ledger_writers)
+
+def flush_ledger(timeout: Optional[float] = None) -> bool:
+    """Wait until the queued ledger entries for DATABASE are written. Returns False on timeout or held entries."""
+    writer = _ledger_writers.get(DATABASE)
+    return writer is None or writer.flush(timeout)
+
+def sync_ledger():
+    """
+    Make every ledger entry queued so far readable, before a read of the ledger.
+
+    Waits for the writer; entries it holds after failed writes are written
+    on the caller's thread. Raises the sqlite3.Error if they still cannot
+    be, so the read is not made on a ledger that lacks them (a fee already
+    paid would look owed).
+    """
+    if flush_ledger():
+        return
+    writer = _ledger_writers.get(DATABASE)
+    if writer is not None:
+        writer.write_held()
+
+def get_ledger_stats() -> Dict:
+    """Write-behind counters for the current database's ledger writer."""
+    return get_ledger_writer().stats()
+
+def record_payment(transaction_id: str, patron_id: str, loan_id: Optional[int], book_id: Optional[int],
+                   amount: float):
+    """Queue a ledger entry for a late fee paid on a loan (written in the background)."""
+    get_ledger_writer().submit((PAYMENT, transaction_id, patron_id, loan_id, book_id, round(amount, 2),
+                                to_epoch(datetime.now())))
+
+def record_refund(transaction_id: str, amount: float):
+    """
+    Queue a ledger entry for a refund (written in the background).
+
+    When written, the refund is split across the loans its transaction paid
+    for, in the order they were paid, up to what is still paid on each.
+    """
+    get_ledger_writer().submit((REFUND, transaction_id, None, None, None, round(amount, 2),
+                                to_epoch(datetime.now())))
+
+def write_ledger_entries(entries: Iterable[Tuple], conn=None) -> int:
+    """
+    Insert ledger entries, splitting refunds without a loan across their transaction's loans.
+    When a transaction connection is passed, the caller owns the commit.
+
+    Returns:
+        int: Number of ledger rows written
+    """
+    count = 0
+    with _use_connection(conn) as db:
+        for entry_type, transaction_id, patron_id, loan_id, book_id, amount, recorded_at in entries:
+            if entry_type == REFUND and loan_id is None:
+                rows = _split_refund(db, transaction_id, amount, recorded_at)
+            else:
+                rows = [(entry_type, transaction_id, patron_id, loan_id, book_id, amount, recorded_at)]
+            db.executemany('''
+                INSERT INTO payment_ledger (entry_type, transaction_id, patron_id, loan_id, book_id, amount, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            count += len(rows)
+        if conn is None:
+            db.commit()
+    return count
+
+def _split_refund(conn, transaction_id: str, amount: float, recorded_at: int) -> List[Tuple]:
+    paid = conn.execute('''
+        SELECT patron_id, loan_id, book_id,
+               SUM(CASE entry_type WHEN 'payment' THEN amount ELSE -amount END) AS net
+        FROM payment_ledger
+        WHERE transaction_id = ? AND loan_id IS NOT NULL
+        GROUP BY loan_id
+        ORDER BY MIN(id)
+    ''', (transaction_id,)).fetchall()
+    rows, remaining, patron_id = [], amount, None
+    for row in paid:
+        patron_id = row['patron_id']
+        share = round(min(remaining, row['net']), 2)
+        if share > 0:
+            rows.append((REFUND, transaction_id, patron_id, row['loan_id'], row['book_id'], share, recorded_at))
+            remaining = round(remaining - share, 2)
+    if remaining > 0:
+        # More than the ledger knows was paid (e.g. a payment made before the ledger existed)
+        rows.append((REFUND, transaction_id, patron_id, None, None, remaining, recorded_at))
+    return rows
+
+def get_paid_amounts(loan_ids: Iterable[int], conn=None) -> Dict[int, float]:
+    """
+    Get the net amount paid (payments minus refunds) on each loan, through the ledger's loan index.
+
+    Without a connection, queued ledger entries are written first. A caller
+    inside a transaction sees only entries already written.
+
+    Returns:
+        dict: loan_id -> amount paid, for the loans with ledger entries
+    """
+    loan_ids = list(loan_ids)
+    if not loan_ids:
+        return {}
+    if conn is None:
+        sync_ledger()
+    with _use_connection(conn) as db:
+        rows = db.execute(f'''
+            SELECT loan_id, SUM(CASE entry_type WHEN 'payment' THEN amount ELSE -amount END) AS paid
+            FROM payment_ledger
+            WHERE loan_id IN ({', '.join('?' * len(loan_ids))})
+            GROUP BY loan_id
+        ''', loan_ids).fetchall()
+    return {row['loan_id']: round(row['paid'], 2) for row in rows}
+
+def get_loan_refund_count(loan_id: Optional[int]) -> int:
+    """Number of refund entries on a loan (queued entries are written first); 0 without a loan."""
+    if loan_id is None:
+        return 0
+    sync_ledger()
+    with _use_connection() as conn:
+        row = conn.execute('''
+            SELECT COUNT(*) FROM payment_ledger WHERE loan_id = ? AND entry_type = 'refund'
+        ''', (loan_id,)).fetchone()
+    return row[0]
+
+def get_ledger_entries(transaction_id: str) -> List[Dict]:
+    """Get the ledger rows of a transaction, oldest first (queued entries are written first)."""
+    sync_ledger()
+    with _use_connection() as conn:
+        rows = conn.execute('''
+            SELECT entry_type, transaction_id, patron_id, loan_id, book_id, amount, recorded_at
+            FROM payment_ledger
+            WHERE transaction_id = ?
+            ORDER BY id
+        ''', (transaction_id,)).fetchall()
+    return [dict(row, recorded_at=from_epoch(row['recorded_at'])) for row in rows]
@@ -2,11 +2,32 @@
 API Routes - JSON API endpoints
 """
 
-from flask import Blueprint, jsonify, request
-from library_service import calculate_late_fee_for_book, search_books_in_catalog
+import io
+from datetime import datetime
+
+from flask import Blueprint, current_app, jsonify, request
+from database import get_pool_stats, get_ledger_stats
+from services.page_cache import page_cache
+from services.catalog_import import import_books, detect_format, FORMATS, DEFAULT_BATCH_SIZE
+from services.loan_export import export_loans, EXPORT_FORMATS, EXPORT_MIMETYPES
+from services.payment_queue import payment_queue, HANDLE_PREFIX
+from services.idempotency import idempotency_store
+from services.payment_service import gateway_breaker_stats
+from .conditional import catalog_validators, is_not_modified, not_modified_response, add_validators
+from library_service import (
+    calculate_late_fee_for_book, search_books_in_catalog, get_catalog_page, process_circulation_batch,
+    get_loans_due_soon, pay_late_fees, pay_all_late_fees,
+    SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE, CATALOG_PAGE_SIZE
+)
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+def _cached_json(cache_key, build_payload, etag=None, last_modified=None):
+    """Serve a JSON payload from the page cache, building and caching it on a miss."""
+    body = page_cache.get_or_render(cache_key, lambda: jsonify(build_payload()).get_data(as_text=True))
+    response = current_app.response_class(body, mimetype='application/json')
+    return add_validators(response, etag, last_modified)
+
 @api_bp.route('/late_fee/<patron_id>/<int:book_id>')
 def get_late_fee(patron_id, book_id):
     """
@@ -16,6 +37,194 @@ def get_late_fee(patron_id, book_id):
     result = calculate_late_fee_for_book(patron_id, book_id)
     return jsonify(result), 501 if 'not implemented' in result.get('status', '') else 200
 
+@api_bp.route('/late_fee/<patron_id>/pay_all', methods=['POST'])
+def pay_all_late_fees_api(patron_id):
+    """
+    Pay all of a patron's outstanding late fees with one gateway charge.
+    Reports the transaction ID, the total and how it was split per book.
+    
+    A client retrying the request sends the same Idempotency-Key header,
+    so it gets the first result back instead of being charged again.
+    """
+    success, message, transaction_id, allocations = pay_all_late_fees(
+        patron_id, idempotency_key=request.headers.get('Idempotency-Key'))
+    body = {
+        'success': success,
+        'message': message,
+        'transaction_id': transaction_id,
+        'total': round(sum(allocation['amount'] for allocation in allocations), 2),
+        'allocations': allocations
+    }
+    return jsonify(body), 200 if success else 400
+
+@api_bp.route('/books')
+def list_books_api():
+    """
+    Page through the catalog via API endpoint.
+    JSON interface for R2: Book Catalog Display
+    
+    Query parameters: cursor (next_cursor of the previous page), limit, available=1
+    """
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', CATALOG_PAGE_SIZE, type=int)
+    available_only = request.args.get('available') == '1'
+    
+    etag, last_modified = catalog_validators('api_books', cursor, limit, available_only)
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    
+    # The ETag names this exact payload (database, catalog version and variant), so it is the cache key too
+    cache_key = etag
+    cached = page_cache.get(cache_key)
+    if cached is not None:
+        return add_validators(current_app.response_class(cached, mimetype='application/json'),
+                              etag, last_modified)
+    
+    page = get_catalog_page(cursor, limit, available_only)
+    if 'error' in page:
+        return jsonify({'error': page['error']}), 400
+    
+    body = jsonify({
+        'books': [book.to_json() for book in page['books']],
+        'count': len(page['books']),
+        'next_cursor': page['next_cursor'],
+        'limit': page['page_size'],
+        'available_only': page['available_only']
+    }).get_data(as_text=True)
+    page_cache.set(cache_key, body)
+    return add_validators(current_app.response_class(body, mimetype='application/json'),
+                          etag, last_modified)
+
+_IMPORT_FORMAT_BY_MIMETYPE = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+}
+
+@api_bp.route('/books/import', methods=['POST'])
+def import_books_api():
+    """
+    Bulk import books from CSV or JSON Lines.
+    
+    Accepts a multipart upload in the 'file' field or the raw request body.
+    The format comes from ?format=, the upload's file name or the content type.
+    The input is streamed, so request size does not affect memory use.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename = upload.stream, upload.filename
+    else:
+        stream, filename = request.stream, ''
+    
+    file_format = (request.args.get('format') or detect_format(filename)
+                   or _IMPORT_FORMAT_BY_MIMETYPE.get(request.mimetype))
+    if file_format not in FORMATS:
+        return jsonify({'error': f"Unknown import format; use one of: {', '.join(FORMATS)}."}), 400
+    
+    batch_size = request.args.get('batch_size', DEFAULT_BATCH_SIZE, type=int)
+    if batch_size < 1:
+        return jsonify({'error': 'batch_size must be a positive integer.'}), 400
+    
+    summary = import_books(io.TextIOWrapper(stream, encoding='utf-8', newline=''), file_format, batch_size)
+    return jsonify(summary)
+
+@api_bp.route('/circulation/batch', methods=['POST'])
+def circulation_batch_api():
+    """
+    Borrow and return many books in one request (circulation desk scanning).
+    
+    Body: {"action": "borrow" | "return" (default for every item),
+           "operations": [{"patron_id": "123456", "book_id": 1, "action": ...}, ...]}
+    Each operation gets its own result; one failed item does not undo the others.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('operations'), list):
+        return jsonify({'error': 'Expected a JSON object with an operations list.'}), 400
+    
+    default_action = payload.get('action')
+    operations = []
+    for operation in payload['operations']:
+        if not isinstance(operation, dict):
+            operation = {}
+        operations.append(dict(operation, action=operation.get('action', default_action)))
+    
+    result = process_circulation_batch(operations)
+    return jsonify(result), 400 if 'error' in result else 200
+
+@api_bp.route('/loans/export')
+def export_loans_api():
+    """
+    Stream borrowing history as NDJSON (default) or CSV.
+    
+    Query parameters: format=ndjson|csv, patron_id, start and end (ISO dates;
+    loans borrowed in [start, end)). Without filters the whole borrow_records
+    table is exported. Rows are streamed as they are read, so the response
+    uses constant memory regardless of row count.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown export format; use one of: {', '.join(EXPORT_FORMATS)}."}), 400
+    
+    patron_id = request.args.get('patron_id') or None
+    if patron_id is not None and (not patron_id.isdigit() or len(patron_id) != 6):
+        return jsonify({'error': 'Invalid patron ID. Must be exactly 6 digits.'}), 400
+    
+    bounds = {}
+    for name in ('start', 'end'):
+        value = request.args.get(name)
+        if value:
+            try:
+                bounds[name] = datetime.fromisoformat(value)
+            except ValueError:
+                return jsonify({'error': f'{name} must be an ISO date (YYYY-MM-DD[THH:MM:SS]).'}), 400
+    
+    chunks = export_loans(export_format, patron_id=patron_id, **bounds)
+    response = current_app.response_class(chunks, mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=loans.{export_format}'
+    return response
+
+@api_bp.route('/loans/due_soon')
+def loans_due_soon_api():
+    """Open loans falling due within ?days= days (default 3, at most 30), earliest first."""
+    days = min(max(request.args.get('days', 3, type=int), 1), 30)
+    loans = [loan.to_json() for loan in get_loans_due_soon(days)]
+    return jsonify({'days': days, 'loans': loans, 'count': len(loans)})
+
+@api_bp.route('/payments', methods=['POST'])
+def submit_payment_api():
+    """
+    Pay a patron's late fee for one book without waiting on the gateway.
+    
+    Body: {"patron_id": "123456", "book_id": 1}. Answers 202 with a pending
+    handle; poll GET /api/payments/<handle> for the outcome. A retry with
+    the same Idempotency-Key header as a payment that already went through
+    answers 200 with its transaction ID.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('book_id'), int):
+        return jsonify({'error': 'Expected a JSON object with patron_id and an integer book_id.'}), 400
+    
+    success, message, handle = pay_late_fees(str(payload.get('patron_id', '')), payload['book_id'], enqueue=True,
+                                             idempotency_key=request.headers.get('Idempotency-Key'))
+    if not success:
+        return jsonify({'error': message}), 400
+    if not handle.startswith(HANDLE_PREFIX):
+        return jsonify({'transaction_id': handle, 'status': 'succeeded', 'message': message}), 200
+    return jsonify({
+        'handle': handle,
+        'status': 'pending',
+        'message': message,
+        'status_url': f'/api/payments/{handle}'
+    }), 202
+
+@api_bp.route('/payments/<handle>')
+def payment_status_api(handle):
+    """Status of a queued payment: pending, processing, succeeded or failed."""
+    job = payment_queue.get(handle)
+    if job is None:
+        return jsonify({'error': 'Unknown payment handle.'}), 404
+    return jsonify(job)
+
 @api_bp.route('/search')
 def search_books_api():
     """
@@ -24,16 +233,42 @@ def search_books_api():
     """
     search_term = request.args.get('q', '').strip()
     search_type = request.args.get('type', 'title')
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), MAX_SEARCH_PAGE_SIZE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    match = request.args.get('match', 'partial')
     
     if not search_term:
         return jsonify({'error': 'Search term is required'}), 400
     
-    # Use business logic function
-    books = search_books_in_catalog(search_term, search_type)
+    # Answer 304 before any database or serialization work
+    variant = ('api_search', search_term, search_type, limit, offset, match)
+    etag, last_modified = catalog_validators(*variant)
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
     
+    def build_payload():
+        # Use business logic function
+        books = search_books_in_catalog(search_term, search_type, limit=limit, offset=offset, match=match)
+        return {
+            'search_term': search_term,
+            'search_type': search_type,
+            'match': match,
+            'results': [book.to_json() for book in books],
+            'count': len(books),
+            'limit': limit,
+            'offset': offset
+        }
+    
+    return _cached_json(etag, build_payload, etag, last_modified)
+
+@api_bp.route('/metrics')
+def metrics_api():
+    """Operational metrics: cache counters, database pool usage, payment queue and gateway breaker state."""
     return jsonify({
-        'search_term': search_term,
-        'search_type': search_type,
-        'results': books,
-        'count': len(books)
+        'page_cache': page_cache.stats(),
+        'db_pool': get_pool_stats(),
+        'payment_queue': payment_queue.stats(),
+        'idempotency': idempotency_store.stats(),
+        'gateway_breakers': gateway_breaker_stats(),
+        'payment_ledger': get_ledger_stats()
     })
@@ -2,9 +2,10 @@
 Catalog Routes - Book catalog related endpoints
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-from database import get_all_books
-from library_service import add_book_to_catalog
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, make_response
+from library_service import add_book_to_catalog, get_catalog_page, CATALOG_PAGE_SIZE
+from services.page_cache import page_cache
+from .conditional import catalog_validators, is_not_modified, not_modified_response, add_validators
 
 catalog_bp = Blueprint('catalog', __name__)
 
@@ -16,11 +17,38 @@ def index():
 @catalog_bp.route('/catalog')
 def catalog():
     """
-    Display all books in the catalog.
+    Display the catalog one page at a time.
     Implements R2: Book Catalog Display
     """
-    books = get_all_books()
-    return render_template('catalog.html', books=books)
+    cursor = request.args.get('cursor')
+    available_only = request.args.get('available') == '1'
+    
+    # Pending flash messages are rendered into the page, so those requests
+    # bypass the cache (and conditional GET) in both directions
+    cacheable = not session.get('_flashes')
+    etag, last_modified = catalog_validators('catalog', cursor, available_only, CATALOG_PAGE_SIZE)
+    # The ETag names this exact page (database, catalog version and variant), so it is the cache key too
+    cache_key = etag
+    if cacheable:
+        if is_not_modified(etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        html = page_cache.get(cache_key)
+        if html is not None:
+            return add_validators(make_response(html), etag, last_modified)
+    
+    page = get_catalog_page(cursor, CATALOG_PAGE_SIZE, available_only)
+    if 'error' in page:
+        flash(page['error'], 'error')
+        cacheable = False
+        cursor = None
+        page = get_catalog_page(None, CATALOG_PAGE_SIZE, available_only)
+    
+    html = render_template('catalog.html', books=page['books'], next_cursor=page['next_cursor'],
+                           is_first_page=not cursor, available_only=available_only)
+    if not cacheable:
+        return html
+    page_cache.set(cache_key, html)
+    return add_validators(make_response(html), etag, last_modified)
 
 @catalog_bp.route('/add_book', methods=['GET', 'POST'])
 def add_book():
@@ -0,0 +1,65 @@
+"""
+Conditional GET helpers - ETag / Last-Modified validators for catalog data
+
+Validators are derived from the catalog state stored in the database (see
+database.get_catalog_state), which triggers bump on every change to books,
+so a change committed by any process invalidates them. Deciding whether to
+answer 304 Not Modified costs that one primary-key read and no template
+rendering.
+"""
+
+import hashlib
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from flask import current_app, request
+
+import database
+
+
+def catalog_validators(*variant) -> Tuple[str, datetime]:
+    """
+    Build (etag, last_modified) for a response derived from the catalog.
+    last_modified is the exact time of the last change, with its fraction of a second.
+
+    Args:
+        variant: Everything besides the catalog that shapes the response
+            (route name, query parameters, page size, ...)
+    """
+    instance, version, changed_at = database.get_catalog_state()
+    digest = hashlib.sha1(repr((database.DATABASE,) + variant).encode('utf-8')).hexdigest()[:16]
+    etag = f'{instance}-{version}-{digest}'
+    last_modified = datetime.fromtimestamp(changed_at, tz=timezone.utc)
+    return etag, last_modified
+
+
+def is_not_modified(etag: str, last_modified: datetime) -> bool:
+    """True if the request's If-None-Match / If-Modified-Since say the client copy is current."""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        # The client's date is a whole second that add_validators only hands
+        # out once it is over, so every change up to its end is in that copy
+        return last_modified < request.if_modified_since + timedelta(seconds=1)
+    return False
+
+
+def not_modified_response(etag: str, last_modified: datetime):
+    """An empty 304 response carrying the current validators."""
+    response = current_app.response_class(status=304)
+    return add_validators(response, etag, last_modified)
+
+
+def add_validators(response, etag: Optional[str], last_modified: Optional[datetime]):
+    """Attach ETag/Last-Modified and ask clients to revalidate on every use."""
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        # HTTP dates have whole seconds, and a change later in the current
+        # second would share its date, so the current second is never sent
+        current_second = datetime.fromtimestamp(int(time.time()), tz=timezone.utc)
+        response.last_modified = min(last_modified, current_second - timedelta(seconds=1))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
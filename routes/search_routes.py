@@ -2,8 +2,9 @@
 Search Routes - Book search functionality
 """
 
-from flask import Blueprint, render_template, request, flash
-from library_service import search_books_in_catalog
+from flask import Blueprint, render_template, request, flash, session
+from library_service import search_books_in_catalog, SEARCH_PAGE_SIZE
+from services.page_cache import page_cache, versioned_key
 
 search_bp = Blueprint('search', __name__)
 
@@ -19,10 +20,22 @@ def search_books():
     if not search_term:
         return render_template('search.html', books=[], search_term='', search_type=search_type)
     
+    # Pending flash messages are rendered into the page, so those requests
+    # bypass the cache in both directions
+    cache_key = versioned_key('search', search_term, search_type, SEARCH_PAGE_SIZE)
+    cacheable = not session.get('_flashes')
+    if cacheable:
+        html = page_cache.get(cache_key)
+        if html is not None:
+            return html
+    
     # Use business logic function
-    books = search_books_in_catalog(search_term, search_type)
+    books = search_books_in_catalog(search_term, search_type, limit=SEARCH_PAGE_SIZE)
     
     if not books:
         flash('Search functionality is not yet implemented.', 'error')
     
-    return render_template('search.html', books=books, search_term=search_term, search_type=search_type)
+    html = render_template('search.html', books=books, search_term=search_term, search_type=search_type)
+    if cacheable:
+        page_cache.set(cache_key, html)
+    return html
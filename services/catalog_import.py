@@ -0,0 +1,197 @@
+"""
+Catalog Import Module - Streaming bulk loader for vendor catalog feeds
+
+Reads CSV or JSON Lines input one row at a time, validates each row with the
+same rules as add_book_to_catalog, and writes accepted books in batches: one
+set-based duplicate-ISBN query and one executemany insert per batch, each
+batch in a single transaction. Memory use depends on the batch size, not on
+the size of the input.
+
+Usage:
+    python -m services.catalog_import books.csv [--format csv|jsonl] [--batch-size 5000]
+
+Input columns / keys: title, author, isbn, total_copies
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, IO, Iterator, List, Optional, Tuple
+
+import database
+from database import get_existing_isbns, insert_books_bulk, transaction
+from .library_service import validate_book_fields
+
+DEFAULT_BATCH_SIZE = 5000
+# Rejected rows beyond this many are counted but their messages are not kept
+MAX_ERROR_SAMPLES = 100
+
+FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(filename: str) -> Optional[str]:
+    """Guess the input format from a file name ('csv', 'jsonl' or None)."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return None
+
+
+def _iter_rows(source: IO[str], file_format: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """Yield (line_number, row, parse_error) for each record in the input."""
+    if file_format == 'csv':
+        reader = csv.DictReader(source)
+        for row in reader:
+            yield reader.line_num, row, None
+    elif file_format == 'jsonl':
+        for line_number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None, "Invalid JSON."
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, "Each line must be a JSON object."
+                continue
+            yield line_number, row, None
+    else:
+        raise ValueError(f"Unsupported import format {file_format!r}; expected one of {FORMATS}.")
+
+
+def _parse_row(row: Dict) -> Tuple[Optional[Tuple[str, str, str, int]], Optional[str]]:
+    """Turn a raw input row into a (title, author, isbn, total_copies) book, or an error message."""
+    title = str(row.get('title') or '')
+    author = str(row.get('author') or '')
+    isbn = str(row.get('isbn') or '').strip()
+    total_copies = row.get('total_copies')
+    if isinstance(total_copies, str):
+        try:
+            total_copies = int(total_copies.strip())
+        except ValueError:
+            pass
+    elif isinstance(total_copies, bool):
+        total_copies = None
+
+    error = validate_book_fields(title, author, isbn, total_copies)
+    if error:
+        return None, error
+    return (title.strip(), author.strip(), isbn, total_copies), None
+
+
+def _write_batch(batch: List[Tuple[int, Tuple[str, str, str, int]]], summary: Dict):
+    """Reject duplicate ISBNs in the batch with one query, then insert the rest in one transaction."""
+    with transaction() as conn:
+        existing = get_existing_isbns([book[2] for _, book in batch], conn=conn)
+        accepted = []
+        seen = set()
+        for line_number, book in batch:
+            isbn = book[2]
+            if isbn in existing or isbn in seen:
+                _reject(summary, line_number, "A book with this ISBN already exists.")
+                continue
+            seen.add(isbn)
+            accepted.append(book)
+        summary['imported'] += insert_books_bulk(accepted, conn=conn)
+
+
+def _reject(summary: Dict, line_number: int, message: str):
+    summary['rejected'] += 1
+    if len(summary['errors']) < MAX_ERROR_SAMPLES:
+        summary['errors'].append({'line': line_number, 'error': message})
+
+
+def import_books(source: IO[str], file_format: str = 'csv', batch_size: int = DEFAULT_BATCH_SIZE,
+                 progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Import books from a text stream.
+
+    Args:
+        source: Text stream of CSV (with a header row) or JSON Lines
+        file_format: 'csv' or 'jsonl'
+        batch_size: Rows validated, checked and inserted per transaction
+        progress: Called with the running summary after every batch
+
+    Returns:
+        dict: rows_read, imported, rejected, errors (first MAX_ERROR_SAMPLES
+        rejected rows as {'line', 'error'}) and elapsed seconds
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported import format {file_format!r}; expected one of {FORMATS}.")
+    if batch_size < 1:
+        raise ValueError("Batch size must be at least 1.")
+
+    started = time.perf_counter()
+    summary = {'rows_read': 0, 'imported': 0, 'rejected': 0, 'errors': [], 'elapsed': 0.0}
+    batch = []
+
+    def flush():
+        if batch:
+            _write_batch(batch, summary)
+            batch.clear()
+        summary['elapsed'] = time.perf_counter() - started
+        if progress is not None:
+            progress(summary)
+
+    for line_number, row, parse_error in _iter_rows(source, file_format):
+        summary['rows_read'] += 1
+        if parse_error:
+            _reject(summary, line_number, parse_error)
+            continue
+        book, error = _parse_row(row)
+        if error:
+            _reject(summary, line_number, error)
+            continue
+        batch.append((line_number, book))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    return summary
+
+
+def import_books_from_file(path: str, file_format: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                           progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """Import books from a CSV/JSON Lines file, detecting the format from its extension if not given."""
+    file_format = file_format or detect_format(path)
+    if file_format is None:
+        raise ValueError(f"Cannot tell the format of {path!r}; pass --format.")
+    with io.open(path, 'r', encoding='utf-8', newline='') as source:
+        return import_books(source, file_format, batch_size, progress)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import books into the library catalog.")
+    parser.add_argument('path', help="CSV or JSON Lines file with title, author, isbn, total_copies")
+    parser.add_argument('--format', choices=FORMATS, help="input format (default: from file extension)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--database', default=database.DATABASE, help="SQLite database file")
+    args = parser.parse_args(argv)
+
+    database.DATABASE = args.database
+    database.init_database()
+
+    def report(summary):
+        rate = summary['rows_read'] / summary['elapsed'] if summary['elapsed'] else 0.0
+        print(f"{summary['rows_read']} rows read, {summary['imported']} imported, "
+              f"{summary['rejected']} rejected ({rate:.0f} rows/s)", file=sys.stderr)
+
+    try:
+        summary = import_books_from_file(args.path, args.format, args.batch_size, report)
+    except ValueError as e:
+        parser.error(str(e))
+    for error in summary['errors']:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(json.dumps({key: value for key, value in summary.items() if key != 'errors'}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+Circuit Breaker Module - Fail fast while the payment gateway is unhealthy
+
+PaymentGateway runs every HTTP call through a CircuitBreaker. The breaker
+keeps the outcomes of the last WINDOW_SIZE calls; once at least
+MINIMUM_CALLS have been seen and either the failure rate (timeouts,
+connection errors, 5xx responses) or the slow-call rate (calls taking
+longer than SLOW_CALL_SECONDS) reaches its threshold, it opens.
+
+While open, calls are rejected straight away with CircuitOpenError instead
+of waiting out the network timeout. After OPEN_SECONDS it turns half-open
+and lets HALF_OPEN_CALLS trial calls through: if they all succeed quickly
+it closes again, and a single failed or slow trial opens it again.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+# Breaker defaults
+WINDOW_SIZE = 20
+MINIMUM_CALLS = 10
+FAILURE_RATE_THRESHOLD = 0.5
+SLOW_CALL_SECONDS = 2.0
+SLOW_CALL_RATE_THRESHOLD = 0.5
+OPEN_SECONDS = 30.0
+HALF_OPEN_CALLS = 3
+
+# Breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a call while the breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"Payment gateway is unavailable (circuit open after repeated failures or slow responses); "
+                         f"retry in {max(retry_after, 0):.0f}s")
+
+
+class CircuitBreaker:
+    """
+    Thread-safe closed/open/half-open breaker over a sliding window of call outcomes.
+
+    Callers bracket each call with before_call() and record(); call() does
+    both around a function. clock is injectable so tests can move time.
+    """
+
+    def __init__(self, name: str = 'gateway', window_size: int = WINDOW_SIZE, minimum_calls: int = MINIMUM_CALLS,
+                 failure_rate_threshold: float = FAILURE_RATE_THRESHOLD, slow_call_seconds: float = SLOW_CALL_SECONDS,
+                 slow_call_rate_threshold: float = SLOW_CALL_RATE_THRESHOLD, open_seconds: float = OPEN_SECONDS,
+                 half_open_calls: int = HALF_OPEN_CALLS, clock: Callable[[], float] = time.monotonic):
+        if minimum_calls < 1 or window_size < minimum_calls:
+            raise ValueError('Window size must be at least minimum_calls, which must be at least 1.')
+        self.name = name
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self._window: "deque[tuple]" = deque(maxlen=window_size)  # (failed, slow) per call
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trials_started = 0
+        self._trials_passed = 0
+        self._counts = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def before_call(self):
+        """Admit a call, or raise CircuitOpenError if the breaker is open (or its trial calls are taken)."""
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN and self._trials_started < self.half_open_calls:
+                self._trials_started += 1
+                return
+            if state != CLOSED:
+                self._counts['rejected'] += 1
+                raise CircuitOpenError(self.name, self._opened_at + self.open_seconds - self.clock())
+
+    def record(self, duration: float, failed: bool = False):
+        """Record the outcome of an admitted call."""
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            self._counts['calls'] += 1
+            self._counts['failures'] += failed
+            self._counts['slow_calls'] += slow
+            state = self._current_state()
+            if state == HALF_OPEN:
+                if failed or slow:
+                    self._open()
+                else:
+                    self._trials_passed += 1
+                    if self._trials_passed >= self.half_open_calls:
+                        self._state = CLOSED
+                        self._window.clear()
+            elif state == CLOSED:
+                self._window.append((failed, slow))
+                if len(self._window) >= self.minimum_calls:
+                    failure_rate, slow_rate = self._rates()
+                    if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+                        self._open()
+            # Calls admitted before the breaker opened finish while it is open; their outcome is dropped
+
+    def call(self, function: Callable, *args, **kwargs):
+        """Run function under the breaker; an exception counts as a failure and is re-raised."""
+        self.before_call()
+        started = self.clock()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.record(self.clock() - started, failed=True)
+            raise
+        self.record(self.clock() - started)
+        return result
+
+    def reset(self):
+        """Close the breaker and forget the recorded calls."""
+        with self._lock:
+            self._state = CLOSED
+            self._window.clear()
+
+    def stats(self) -> Dict:
+        """Current state, window rates and lifetime counters."""
+        with self._lock:
+            failure_rate, slow_rate = self._rates()
+            return dict(self._counts, state=self._current_state(), window_calls=len(self._window),
+                        failure_rate=round(failure_rate, 3), slow_call_rate=round(slow_rate, 3))
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self.clock() >= self._opened_at + self.open_seconds:
+            self._state = HALF_OPEN
+            self._trials_started = 0
+            self._trials_passed = 0
+        return self._state
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self.clock()
+        self._counts['opened'] += 1
+
+    def _rates(self):
+        if not self._window:
+            return 0.0, 0.0
+        failed = sum(1 for failure, _ in self._window if failure)
+        slow = sum(1 for _, is_slow in self._window if is_slow)
+        return failed / len(self._window), slow / len(self._window)
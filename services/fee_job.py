@@ -0,0 +1,149 @@
+"""
+Fee Job Module - Nightly overdue fee job sharded across worker processes
+
+Open loans are split into patron_id ranges of about equal size. Each range
+is a shard that a multiprocessing pool worker prices on its own read-only
+SQLite connection, with the same fee table as the overdue sweep (and so
+the same rules as calculate_late_fee_for_book), less the amounts the
+payments ledger holds as paid, read with one query per shard. The parent process stores
+each finished shard's per-patron totals in overdue_fee_report and marks the
+shard done in the same transaction.
+
+If the job dies part way, running it again resumes the unfinished run: the
+saved shards are kept and only the pending ones are computed, against the
+run's original as_of date.
+
+Usage:
+    python -m services.fee_job [--workers 4] [--shards 16] [--chunk-size 50000] [--new-run]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import database
+from database import (
+    connect_read_only, iter_overdue_loan_chunks, get_open_loan_paid_amounts, get_patron_shard_bounds,
+    create_fee_job, sync_ledger,
+    get_resumable_fee_job, get_pending_fee_job_shards, save_fee_job_shard, finish_fee_sweep_run
+)
+from .overdue_sweep import price_loan_chunks, resolve_engine, DEFAULT_CHUNK_SIZE
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Shards per worker: more shards balance uneven ranges and lose less work to a crash
+SHARDS_PER_WORKER = 4
+
+
+def _run_shard(task: Tuple) -> Tuple[int, Dict[str, List[int]]]:
+    """Worker: price one shard's open loans, less their ledger payments, on a private read-only connection."""
+    database_path, shard, patron_range, as_of, chunk_size, engine = task
+    conn = connect_read_only(database_path)
+    try:
+        paid = get_open_loan_paid_amounts(as_of, patron_range, conn=conn)
+        chunks = iter_overdue_loan_chunks(as_of, chunk_size, patron_range=patron_range, conn=conn)
+        return shard, price_loan_chunks(chunks, as_of, engine, paid)
+    finally:
+        conn.close()
+
+
+def _shard_ranges(bounds: List[str]) -> List[Tuple[Optional[str], Optional[str]]]:
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def run_fee_job(workers: int = DEFAULT_WORKERS, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                shards: Optional[int] = None, as_of: Optional[datetime] = None,
+                engine: Optional[str] = None, resume: bool = True,
+                progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Run (or resume) the sharded overdue fee job.
+
+    Args:
+        workers: Worker processes in the pool
+        chunk_size: Open loans each worker loads and prices at a time
+        shards: Number of patron_id ranges (default: workers * SHARDS_PER_WORKER)
+        as_of: Date to measure lateness against (default: now; ignored when resuming)
+        engine: 'numpy' or 'python' pricing (default: numpy when installed)
+        resume: Continue the latest unfinished job run instead of starting a new one
+        progress: Called with {'run_id', 'shard', 'done', 'total'} after each shard is saved
+
+    Returns:
+        dict: run_id, as_of, resumed, shards, workers, overdue_loans, patrons,
+        total_fees and elapsed seconds
+    """
+    if workers < 1:
+        raise ValueError("Worker count must be at least 1.")
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1.")
+    engine = resolve_engine(engine)
+    started = time.perf_counter()
+
+    run = get_resumable_fee_job() if resume else None
+    if run is not None:
+        run_id, as_of = run['run_id'], run['as_of']
+    else:
+        as_of = as_of or datetime.now()
+        bounds = get_patron_shard_bounds(shards or workers * SHARDS_PER_WORKER)
+        run_id = create_fee_job(as_of, _shard_ranges(bounds))
+    pending = get_pending_fee_job_shards(run_id)
+    # Workers read the ledger on their own connections, so payments queued in this process go in first
+    sync_ledger()
+
+    tasks = [(database.DATABASE, shard['shard'], (shard['patron_low'], shard['patron_high']),
+              as_of, chunk_size, engine) for shard in pending]
+    if tasks:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            for done, (shard, totals) in enumerate(pool.imap_unordered(_run_shard, tasks), start=1):
+                save_fee_job_shard(run_id, shard, (
+                    (patron_id, loans, cents / 100) for patron_id, (loans, cents) in totals.items()))
+                if progress is not None:
+                    progress({'run_id': run_id, 'shard': shard, 'done': done, 'total': len(tasks)})
+
+    summary = finish_fee_sweep_run(run_id)
+    return {
+        'run_id': run_id,
+        'as_of': as_of.isoformat(),
+        'resumed': run is not None,
+        'shards': len(tasks),
+        'workers': workers,
+        'overdue_loans': summary['overdue_loans'],
+        'patrons': summary['patrons'],
+        'total_fees': summary['total_fees'],
+        'elapsed': time.perf_counter() - started
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compute late fees for all open loans on a process pool.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--shards', type=int, help="patron_id ranges (default: workers x 4)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--as-of', type=datetime.fromisoformat, help="ISO date/time (default: now)")
+    parser.add_argument('--engine', choices=('numpy', 'python'))
+    parser.add_argument('--new-run', action='store_true', help="do not resume an unfinished run")
+    parser.add_argument('--database', default=database.DATABASE, help="SQLite database file")
+    args = parser.parse_args(argv)
+
+    database.DATABASE = args.database
+    database.init_database()
+
+    def report(state):
+        print(f"run {state['run_id']}: shard {state['shard']} saved ({state['done']}/{state['total']})",
+              file=sys.stderr)
+
+    try:
+        summary = run_fee_job(args.workers, args.chunk_size, args.shards, args.as_of, args.engine,
+                              resume=not args.new_run, progress=report)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(summary))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+Gateway Server Module - Local stand-in for the external payment gateway
+
+A small HTTP server speaking the same API that PaymentGateway calls when a
+base URL is configured, so the payment code (and load tests) can make real
+HTTP round trips without the external service:
+
+    POST /charges        {"customer_id", "amount", "currency", "description"}
+    POST /refunds        {"charge", "amount"}
+    GET  /charges/<id>   status of a charge
+    GET  /charges?idempotency_key=<key>   status of the charge sent with that key
+
+Charges follow the same rules as the simulated gateway (amount must be
+positive and at most 1000, customer IDs have 6 characters). A POST with
+an Idempotency-Key header that was seen before gets the first response
+back and changes nothing. A fixed latency can be added to every call,
+after the request has been carried out (as with a slow network), and the
+whole response, status line and headers included, can be trickled out a
+byte at a time (as with a stalled peer that never quite stops sending). The server counts the TCP connections
+it accepts, which shows whether clients reuse them.
+
+Usage:
+    python -m services.gateway_server [--port 8765] [--latency 0.05] [--trickle 0.01]
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+MAX_CHARGE = 1000
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so pooled clients can reuse connections
+    disable_nagle_algorithm = True  # no delayed-ACK stalls between small writes on a kept-alive socket
+
+    def setup(self):
+        super().setup()
+        self.server.stand_in.record_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        payload = self._read_json()
+        if payload is None:
+            return self._reply(400, {'error': {'message': 'Request body must be a JSON object'}})
+        key = self.headers.get('Idempotency-Key')
+        if self.path == '/charges':
+            return self._reply(*self.server.stand_in.charge(payload, key))
+        if self.path == '/refunds':
+            return self._reply(*self.server.stand_in.refund(payload, key))
+        self._reply(404, {'error': {'message': 'Not found'}})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/charges' and url.query:
+            key = parse_qs(url.query).get('idempotency_key', [''])[0]
+            return self._reply(*self.server.stand_in.charge_status_by_key(key))
+        if self.path.startswith('/charges/'):
+            return self._reply(*self.server.stand_in.charge_status(unquote(self.path[len('/charges/'):])))
+        if self.path == '/health':
+            return self._reply(200, {'status': 'ok'})
+        self._reply(404, {'error': {'message': 'Not found'}})
+
+    def _read_json(self) -> Optional[Dict]:
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'null')
+        except ValueError:
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    def _reply(self, status: int, body: Dict):
+        self.server.stand_in.delay()
+        data = json.dumps(body).encode('utf-8')
+        try:
+            if self.server.stand_in.trickle:
+                self._trickle(status, data)
+                return
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the client stopped waiting (its timeout ran out)
+
+
+    def _trickle(self, status: int, data: bytes):
+        """Send the response one byte at a time, trickle seconds apart."""
+        head = (f'{self.protocol_version} {status} {self.responses[status][0]}\r\n'
+                f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n').encode('latin-1')
+        response = head + data
+        for i in range(len(response)):
+            self.wfile.write(response[i:i + 1])
+            time.sleep(self.server.stand_in.trickle)
+
+
+class StandInGatewayServer:
+    """
+    In-memory payment gateway served over HTTP on a background thread.
+
+    Use as a context manager (or call start()/stop()); url is the base URL to
+    give PaymentGateway. Charges, refunds and the responses sent for each
+    Idempotency-Key are kept in memory.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, trickle: float = 0.0):
+        self.latency = latency
+        self.trickle = trickle  # seconds between the bytes of a response
+        self.charges: Dict[str, Dict] = {}
+        self.refunds: List[Dict] = []
+        self.responses: Dict[str, tuple] = {}  # Idempotency-Key -> (status code, body)
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._key_lock = threading.Lock()  # held across a keyed request, so a concurrent repeat waits for it
+        self._counter = 0
+        self._httpd = ThreadingHTTPServer((host, port), _GatewayHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stand_in = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StandInGatewayServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='gateway-stand-in', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve on the calling thread until interrupted (for the command line)."""
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._httpd.server_close()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'StandInGatewayServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def charge(self, payload: Dict, idempotency_key: Optional[str] = None):
+        """POST /charges: (status code, body)."""
+        return self._once(idempotency_key, lambda: self._charge(payload, idempotency_key))
+
+    def refund(self, payload: Dict, idempotency_key: Optional[str] = None):
+        """POST /refunds: (status code, body)."""
+        return self._once(idempotency_key, lambda: self._refund(payload))
+
+    def _once(self, idempotency_key: Optional[str], handle):
+        if not idempotency_key:
+            return handle()
+        with self._key_lock:
+            if idempotency_key not in self.responses:
+                self.responses[idempotency_key] = handle()
+            return self.responses[idempotency_key]
+
+    def _charge(self, payload: Dict, idempotency_key: Optional[str]):
+        customer_id = str(payload.get('customer_id', ''))
+        amount = payload.get('amount')
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return 400, {'error': {'message': 'Invalid amount: must be greater than 0'}}
+        if amount > MAX_CHARGE:
+            return 402, {'error': {'message': 'Payment declined: amount exceeds limit'}}
+        if len(customer_id) != 6:
+            return 400, {'error': {'message': 'Invalid patron ID format'}}
+
+        with self._lock:
+            self._counter += 1
+            charge_id = f'txn_{customer_id}_{int(time.time())}_{self._counter}'
+            self.charges[charge_id] = {
+                'transaction_id': charge_id,
+                'status': 'completed',
+                'amount': round(float(amount), 2),
+                'refunded': 0.0,
+                'description': payload.get('description', ''),
+                'idempotency_key': idempotency_key,
+                'timestamp': time.time()
+            }
+        return 200, {'id': charge_id, 'status': 'succeeded',
+                     'message': f'Payment of ${amount:.2f} processed successfully'}
+
+    def _refund(self, payload: Dict):
+        charge_id = str(payload.get('charge', ''))
+        amount = payload.get('amount')
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return 400, {'error': {'message': 'Invalid refund amount'}}
+        with self._lock:
+            charge = self.charges.get(charge_id)
+            if charge is None:
+                return 404, {'error': {'message': 'Invalid transaction ID'}}
+            if charge['refunded'] + amount > charge['amount'] + 1e-9:
+                return 400, {'error': {'message': 'Refund exceeds the charged amount'}}
+            charge['refunded'] = round(charge['refunded'] + amount, 2)
+            if charge['refunded'] >= charge['amount']:
+                charge['status'] = 'refunded'
+            refund_id = f'refund_{charge_id}_{len(self.refunds) + 1}'
+            self.refunds.append({'id': refund_id, 'charge': charge_id, 'amount': amount})
+        return 200, {'id': refund_id, 'status': 'succeeded',
+                     'message': f'Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}'}
+
+    def charge_status(self, charge_id: str):
+        """GET /charges/<id>: (status code, body)."""
+        with self._lock:
+            charge = self.charges.get(charge_id)
+            if charge is None:
+                return 404, {'status': 'not_found', 'message': 'Transaction not found'}
+            return 200, {key: charge[key] for key in ('transaction_id', 'status', 'amount', 'timestamp')}
+
+    def charge_status_by_key(self, idempotency_key: str):
+        """GET /charges?idempotency_key=<key>: (status code, body)."""
+        with self._lock:
+            charge_id = next((charge_id for charge_id, charge in self.charges.items()
+                              if idempotency_key and charge['idempotency_key'] == idempotency_key), None)
+        return self.charge_status(charge_id or '')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the payment gateway.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--trickle', type=float, default=0.0, help='seconds between the bytes of a response')
+    args = parser.parse_args(argv)
+
+    server = StandInGatewayServer(args.host, args.port, args.latency, args.trickle)
+    print(f'stand-in gateway listening on {server.url} (PAYMENT_GATEWAY_URL={server.url})')
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Idempotency Module - Replay recorded payment results for retried requests
+
+pay_late_fees and refund_late_fee_payment run their gateway call under an
+idempotency key (given by the caller or derived from the request). The
+first request claims the key in the idempotency_keys table; once the
+gateway approves, the result is stored there and in an in-memory LRU, and
+any retry with the same key gets that result back without a gateway call.
+
+Only approved results are recorded: a declined or failed call releases
+the key, so the request can be retried. A retry that arrives while the
+first call is still in flight is turned away instead of being sent again.
+
+A call that gets no answer (timeout, dropped connection) may still have
+been carried out by the gateway, so its key is not released but left
+'unknown'. The next request under the key first asks the gateway what
+became of the call (resolve) and only calls again if it was never made;
+the key also goes to the gateway as its Idempotency-Key, so a repeated
+call cannot be carried out twice either.
+
+Results recorded under derived keys can be given a lifetime (ttl), after
+which the same request is treated as a new one.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Hashable, Optional, Tuple, Type
+
+import database
+
+# Cache limits
+MAX_ENTRIES = 4096
+# A pending key older than this belongs to a call that never finished and may be claimed again
+PENDING_TIMEOUT = timedelta(minutes=2)
+
+# Results of begin()
+CLAIMED = 'claimed'
+REPLAYED = 'replayed'
+IN_PROGRESS = 'in_progress'
+UNKNOWN = 'unknown'
+
+
+def derive_key(operation: str, *parts) -> str:
+    """Build a deterministic key from the request's identifying fields."""
+    raw = json.dumps([operation, *parts], separators=(',', ':'))
+    return f'{operation}:{hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]}'
+
+
+class IdempotencyStore:
+    """
+    SQLite-backed store of gateway results by idempotency key, fronted by a
+    thread-safe LRU of completed results.
+
+    Cache entries are keyed by database file as well, so switching DATABASE
+    (as the tests do) never replays a result recorded in another database,
+    and keep their completion time so a ttl applies to them too.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, pending_timeout: timedelta = PENDING_TIMEOUT):
+        self.max_entries = max_entries
+        self.pending_timeout = pending_timeout
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # (result, completed_at epoch)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._replays = 0
+
+    def recorded(self, key: str) -> Optional[list]:
+        """Get the recorded result for a key, or None if no approved call was made under it."""
+        result = self._cached(key)
+        if result is not None:
+            return result
+        row = database.get_idempotency_record(key)
+        if row is None or row['status'] != 'completed':
+            return None
+        return self._replay(key, row)
+
+    def begin(self, key: str, operation: str, ttl: Optional[timedelta] = None) -> Tuple[str, Optional[list]]:
+        """
+        Claim a key before calling the gateway.
+
+        Args:
+            key: Idempotency key of the request
+            operation: Name of the operation, stored with the key
+            ttl: Replay a recorded result only while it is younger than this
+
+        Returns:
+            tuple: (CLAIMED, None) when the caller should make the call,
+            (UNKNOWN, None) when the caller holds a key whose earlier call
+            got no answer and should find out its outcome first,
+            (REPLAYED, recorded result) when it has already been made, or
+            (IN_PROGRESS, None) while another request holds the key
+        """
+        result = self._cached(key, ttl)
+        if result is not None:
+            return REPLAYED, result
+        now = datetime.now()
+        claimed, row = database.claim_idempotency_key(key, operation, now - self.pending_timeout,
+                                                      now - ttl if ttl is not None else None)
+        if claimed:
+            return (UNKNOWN if row is not None and row['status'] == UNKNOWN else CLAIMED), None
+        if row['status'] != 'completed':
+            return IN_PROGRESS, None
+        return REPLAYED, self._replay(key, row)
+
+    def complete(self, key: str, result: list):
+        """Record the approved result of the call made under a claimed key."""
+        database.complete_idempotency_key(key, json.dumps(result))
+        with self._lock:
+            self._remember((database.DATABASE, key), result, time.time())
+
+    def release(self, key: str):
+        """Give up a claimed key whose call was declined or failed."""
+        database.release_idempotency_key(key)
+
+    def mark_unknown(self, key: str):
+        """Keep a claimed key whose call got no answer; the next request under it resolves the outcome first."""
+        database.mark_idempotency_key_unknown(key)
+
+    def run(self, key: str, operation: str, call: Callable[[], tuple],
+            succeeded: Callable[[tuple], bool], in_progress: tuple,
+            ambiguous: Tuple[Type[BaseException], ...] = (), unknown: Optional[tuple] = None,
+            resolve: Optional[Callable[[], Optional[tuple]]] = None, ttl: Optional[timedelta] = None) -> tuple:
+        """
+        Make call() under the key unless its result is already recorded.
+
+        The result is recorded when succeeded(result) is true; otherwise (or
+        if call raises) the key is released. in_progress is returned while
+        another request holds the key.
+
+        If call raises one of the ambiguous exceptions the key is kept as
+        unknown and unknown is returned. The next request under the key
+        calls resolve() first: it returns the approved result of the
+        earlier call (recorded and returned), None if the gateway never
+        made it (call() is made now), or raises while that is still
+        unclear (unknown is returned again). Without resolve, call() is
+        simply made again under the same key.
+        """
+        state, recorded = self.begin(key, operation, ttl)
+        if state == REPLAYED:
+            return tuple(recorded)
+        if state == IN_PROGRESS:
+            return in_progress
+        if state == UNKNOWN and resolve is not None:
+            try:
+                resolved = resolve()
+            except Exception:
+                self.mark_unknown(key)
+                return unknown
+            if resolved is not None:
+                self.complete(key, list(resolved))
+                return resolved
+        try:
+            result = call()
+        except ambiguous:
+            self.mark_unknown(key)
+            return unknown
+        except BaseException:
+            self.release(key)
+            raise
+        if succeeded(result):
+            self.complete(key, list(result))
+        else:
+            self.release(key)
+        return result
+
+    def clear(self):
+        """Drop every cached entry (the table is kept)."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Cache hits, total replays and current size."""
+        with self._lock:
+            return {
+                'cache_hits': self._hits,
+                'replays': self._replays,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries
+            }
+
+    def _cached(self, key: str, ttl: Optional[timedelta] = None) -> Optional[list]:
+        cache_key = (database.DATABASE, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            result, completed_at = entry
+            if ttl is not None and completed_at < time.time() - ttl.total_seconds():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            self._hits += 1
+            self._replays += 1
+            return result
+
+    def _replay(self, key: str, row: Dict) -> list:
+        result = json.loads(row['response'])
+        with self._lock:
+            self._replays += 1
+            self._remember((database.DATABASE, key), result, row['completed_at'])
+        return result
+
+    def _remember(self, cache_key: Hashable, result: list, completed_at: float):
+        self._entries[cache_key] = (result, completed_at)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+# Shared store used by the payment functions
+idempotency_store = IdempotencyStore()
@@ -3,48 +3,81 @@ Library Service Module - Business Logic Functions
 Contains all the core business logic for the Library Management System
 """
 
+import base64
+import json
+import sqlite3
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from database import (
     get_book_by_id, get_book_by_isbn, get_patron_borrow_count,
     insert_book, insert_borrow_record, update_book_availability,
-    update_borrow_record_return_date, get_all_books, get_patron_borrowed_books,
-    get_patron_borrowing_history
+    get_all_books, get_patron_borrowed_books,
+    get_patron_borrowing_history, checkout_book_copy, close_open_loan, search_books,
+    search_books_by_prefix, get_books_page, transaction, add_patron_accrued_fee, get_patron_summary,
+    get_loans_due_between, forget_payment_verification,
+    get_paid_amounts, get_loan_refund_count, get_ledger_entries, record_payment, record_refund, sync_ledger,
+    Book, Loan
 )
-from .payment_service import PaymentGateway
+from .payment_service import PaymentGateway, AMBIGUOUS_ERRORS, gateway_idempotency_key
+from .payment_queue import payment_queue, SUCCEEDED, UNKNOWN
+from .idempotency import idempotency_store, derive_key, REPLAYED, IN_PROGRESS
 
-def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
+# Default and maximum number of search results returned per page
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_PAGE_SIZE = 1000
+
+# Default and maximum number of books per catalog page
+CATALOG_PAGE_SIZE = 100
+MAX_CATALOG_PAGE_SIZE = 500
+
+# Maximum number of operations in one circulation desk batch
+MAX_CIRCULATION_BATCH_SIZE = 200
+
+def validate_book_fields(title: str, author: str, isbn: str, total_copies: int) -> Optional[str]:
     """
-    Add a new book to the catalog.
-    Implements R1: Book Catalog Management
+    Validate the fields of a new book (R1 rules), without touching the database.
     
-    Args:
-        title: Book title (max 200 chars)
-        author: Book author (max 100 chars)
-        isbn: 13-digit ISBN
-        total_copies: Number of copies (positive integer)
-        
     Returns:
-        tuple: (success: bool, message: str)
+        str: The first validation error message, or None if the book is valid
     """
-    # Input validation
     if not title or not title.strip():
-        return False, "Title is required."
+        return "Title is required."
     
     if len(title.strip()) > 200:
-        return False, "Title must be less than 200 characters."
+        return "Title must be less than 200 characters."
     
     if not author or not author.strip():
-        return False, "Author is required."
+        return "Author is required."
     
     if len(author.strip()) > 100:
-        return False, "Author must be less than 100 characters."
+        return "Author must be less than 100 characters."
     
     if len(isbn) != 13:
-        return False, "ISBN must be exactly 13 digits."
+        return "ISBN must be exactly 13 digits."
     
     if not isinstance(total_copies, int) or total_copies <= 0:
-        return False, "Total copies must be a positive integer."
+        return "Total copies must be a positive integer."
+    
+    return None
+
+def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
+    """
+    Add a new book to the catalog.
+    Implements R1: Book Catalog Management
+    
+    Args:
+        title: Book title (max 200 chars)
+        author: Book author (max 100 chars)
+        isbn: 13-digit ISBN
+        total_copies: Number of copies (positive integer)
+        
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    # Input validation
+    error = validate_book_fields(title, author, isbn, total_copies)
+    if error:
+        return False, error
     
     # Check for duplicate ISBN
     existing = get_book_by_isbn(isbn)
@@ -74,8 +107,28 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits."
     
-    # Check if book exists and is available
-    book = get_book_by_id(book_id)
+    borrow_date = datetime.now()
+    
+    # Availability check, limit check, copy checkout and borrow record all
+    # happen in one transaction with a single commit
+    try:
+        with transaction() as conn:
+            success, message = _borrow_in_transaction(conn, patron_id, book_id, borrow_date)
+            if not success:
+                conn.rollback()
+    except sqlite3.Error:
+        return False, "Database error occurred while creating borrow record."
+    
+    return success, message
+
+def _borrow_in_transaction(conn, patron_id: str, book_id: int, borrow_date: datetime) -> Tuple[bool, str]:
+    """
+    Borrow checks and writes for one book on the caller's transaction.
+    On failure the caller must undo any partial writes (rollback or savepoint).
+    """
+    due_date = borrow_date + timedelta(days=14)
+    
+    book = get_book_by_id(book_id, conn=conn)
     if not book:
         return False, "Book not found."
     
@@ -83,24 +136,18 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
         return False, "This book is currently not available."
     
     # Check patron's current borrowed books count
-    current_borrowed = get_patron_borrow_count(patron_id)
+    current_borrowed = get_patron_borrow_count(patron_id, conn=conn)
     
     if current_borrowed > 5:
         return False, "You have reached the maximum borrowing limit of 5 books."
     
-    # Create borrow record
-    borrow_date = datetime.now()
-    due_date = borrow_date + timedelta(days=14)
+    # Guarded decrement: fails instead of overselling the last copy
+    if not checkout_book_copy(book_id, conn=conn):
+        return False, "This book is currently not available."
     
-    # Insert borrow record and update availability
-    borrow_success = insert_borrow_record(patron_id, book_id, borrow_date, due_date)
-    if not borrow_success:
+    if not insert_borrow_record(patron_id, book_id, borrow_date, due_date, conn=conn):
         return False, "Database error occurred while creating borrow record."
     
-    availability_success = update_book_availability(book_id, -1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
-    
     return True, f'Successfully borrowed "{book["title"]}". Due date: {due_date.strftime("%Y-%m-%d")}.'
 
 def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
@@ -119,53 +166,202 @@ def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits."
     
+    return_date = datetime.now()
     
-    book = get_book_by_id(book_id)
+    # Close the open loan, restore availability and accrue the late fee in one
+    # transaction; the fee is computed from the closed loan row, so nothing is re-fetched.
+    # What the ledger holds as paid on the loan is subtracted (synced first: the
+    # transaction only sees entries already written)
+    try:
+        sync_ledger()
+        with transaction() as conn:
+            error, book, loan = _return_in_transaction(conn, patron_id, book_id, return_date)
+            if error:
+                conn.rollback()
+                return False, error
+            late_fee_amount = _outstanding(
+                calculate_late_fee_for_due_date(loan['due_date'], return_date)['fee_amount'],
+                get_paid_amounts([loan['loan_id']], conn=conn).get(loan['loan_id'], 0.00)
+            )
+            if late_fee_amount > 0:
+                add_patron_accrued_fee(patron_id, late_fee_amount, conn=conn)
+    except sqlite3.Error:
+        return False, "Database error occurred while recording return."
+    
+    return True, _return_message(book, late_fee_amount)
+
+def _return_in_transaction(conn, patron_id: str, book_id: int,
+                           return_date: datetime) -> Tuple[Optional[str], Optional[Book], Optional[Loan]]:
+    """
+    Return checks and writes for one book on the caller's transaction.
+    
+    Returns:
+        tuple: (error message or None, book, closed loan)
+    """
+    book = get_book_by_id(book_id, conn=conn)
     if not book:
-        return False, "Book not found."
+        return "Book not found.", None, None
     
+    loan = close_open_loan(patron_id, book_id, return_date, conn=conn)
+    if not loan:
+        return "You have not borrowed this book.", book, None
     
-    borrowed_books = get_patron_borrowed_books(patron_id)
-    borrowed_book = None
-    for b in borrowed_books:
-        if b['book_id'] == book_id:
-            borrowed_book = b
-            break
+    if not update_book_availability(book_id, 1, conn=conn):
+        return "Database error occurred while updating book availability.", book, None
     
-    if not borrowed_book:
-        return False, "You have not borrowed this book."
+    return None, book, loan
+
+def _return_message(book: Book, late_fee_amount: float) -> str:
+    if late_fee_amount > 0:
+        return f'Book "{book["title"]}" returned successfully. Late fee: ${late_fee_amount:.2f}'
+    else:
+        return f'Book "{book["title"]}" returned successfully. No late fees.'
+
+def process_circulation_batch(operations: List[Dict]) -> Dict:
+    """
+    Run a batch of borrow/return operations from a circulation desk.
     
+    Every operation follows the borrow_book_by_patron / return_book_by_patron
+    rules. The whole batch shares one transaction and one commit; each item
+    runs inside its own savepoint, so a failed item is undone on its own and
+    later items still see the effects of earlier ones (e.g. the borrowing
+    limit). Late fees for all returns are computed in one pass at the end,
+    less what the payments ledger holds as paid on each loan.
     
-    return_date = datetime.now()
-    return_success = update_borrow_record_return_date(patron_id, book_id, return_date)
-    if not return_success:
-        return False, "Database error occurred while recording return."
+    Args:
+        operations: List of {'action': 'borrow' | 'return', 'patron_id', 'book_id'}
+        
+    Returns:
+        dict: results (one per operation, in order, with success and
+        message; returns also carry late_fee), succeeded, failed and
+        total_late_fees; contains error if the batch could not be run
+    """
+    if len(operations) > MAX_CIRCULATION_BATCH_SIZE:
+        return {
+            'error': f'A batch can contain at most {MAX_CIRCULATION_BATCH_SIZE} operations.',
+            'results': [], 'succeeded': 0, 'failed': 0, 'total_late_fees': 0.00
+        }
     
+    now = datetime.now()
+    results = []
+    returned = []
     
-    availability_success = update_book_availability(book_id, 1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
+    try:
+        sync_ledger()
+        with transaction() as conn:
+            for index, operation in enumerate(operations):
+                action = operation.get('action')
+                patron_id = str(operation.get('patron_id') or '')
+                book_id = operation.get('book_id')
+                result = {'index': index, 'action': action, 'patron_id': patron_id, 'book_id': book_id}
+                results.append(result)
+                
+                if action not in ('borrow', 'return'):
+                    result.update(success=False, message="Action must be 'borrow' or 'return'.")
+                    continue
+                if not patron_id.isdigit() or len(patron_id) != 6:
+                    result.update(success=False, message="Invalid patron ID. Must be exactly 6 digits.")
+                    continue
+                if not isinstance(book_id, int) or isinstance(book_id, bool):
+                    result.update(success=False, message="Invalid book ID.")
+                    continue
+                
+                conn.execute('SAVEPOINT circulation_item')
+                if action == 'borrow':
+                    success, message = _borrow_in_transaction(conn, patron_id, book_id, now)
+                    result.update(success=success, message=message)
+                else:
+                    error, book, loan = _return_in_transaction(conn, patron_id, book_id, now)
+                    success = error is None
+                    result.update(success=success, message=error)
+                    if success:
+                        returned.append((result, book, loan))
+                if not success:
+                    conn.execute('ROLLBACK TO circulation_item')
+                conn.execute('RELEASE circulation_item')
+            
+            # One pass over the closed loans, all measured against the same
+            # instant; each patron's accrued fees are updated once
+            fees_by_patron = {}
+            paid = get_paid_amounts((loan['loan_id'] for _, _, loan in returned), conn=conn)
+            for result, book, loan in returned:
+                fee_amount = _outstanding(calculate_late_fee_for_due_date(loan['due_date'], now)['fee_amount'],
+                                          paid.get(loan['loan_id'], 0.00))
+                result['late_fee'] = fee_amount
+                result['message'] = _return_message(book, fee_amount)
+                fees_by_patron[loan['patron_id']] = fees_by_patron.get(loan['patron_id'], 0.00) + fee_amount
+            for patron_id, fees in fees_by_patron.items():
+                if fees > 0:
+                    add_patron_accrued_fee(patron_id, fees, conn=conn)
+    except sqlite3.Error:
+        return {
+            'error': 'Database error occurred while processing the batch; no changes were made.',
+            'results': [], 'succeeded': 0, 'failed': 0, 'total_late_fees': 0.00
+        }
     
+    total_late_fees = sum(result['late_fee'] for result, _, _ in returned)
+    succeeded = sum(1 for result in results if result['success'])
+    return {
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'total_late_fees': round(total_late_fees, 2)
+    }
+
+def calculate_late_fee_for_due_date(due_date: datetime, as_of: Optional[datetime] = None) -> Dict:
+    """
+    Apply the late fee schedule to a single loan.
     
-    late_fee_info = calculate_late_fee_for_book(patron_id, book_id)
-    late_fee_amount = late_fee_info.get('fee_amount', 0.00)
+    Args:
+        due_date: When the loan was due
+        as_of: Date to measure lateness against (defaults to now)
+        
+    Returns:
+        dict: Contains fee_amount, days_overdue, and status
+    """
+    current_date = as_of if as_of is not None else datetime.now()
+    days_overdue = (current_date - due_date).days
     
-    if late_fee_amount > 0:
-        return True, f'Book "{book["title"]}" returned successfully. Late fee: ${late_fee_amount:.2f}'
+    if days_overdue <= 0:
+        return {
+            'fee_amount': 0.00,
+            'days_overdue': 0,
+            'status': 'Not overdue'
+        }
+    
+    # Calculate late fee based on requirements:
+    # $0.50/day for first 7 days overdue
+    # $1.00/day for each additional day after 7 days
+    # Maximum $15.00 per book
+    if days_overdue <= 7:
+        fee_amount = days_overdue * 0.50
     else:
-        return True, f'Book "{book["title"]}" returned successfully. No late fees.'
+        fee_amount = (7 * 0.50) + ((days_overdue - 7) * 1.00)
+    
+    
+    fee_amount = min(fee_amount, 15.00)
+    
+    return {
+        'fee_amount': round(fee_amount, 2),
+        'days_overdue': days_overdue,
+        'status': 'Overdue'
+    }
 
 def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
     """
     Calculate late fees for a specific book.
     Implements R5: Late Fee Calculation API
     
+    Payments already recorded in the ledger for the loan are subtracted, so
+    fee_amount is what is still owed.
+    
     Args:
         patron_id: 6-digit library card ID
         book_id: ID of the book to calculate fees for
         
     Returns:
-        dict: Contains fee_amount, days_overdue, and status
+        dict: Contains fee_amount, days_overdue, and status (plus amount_paid
+        and loan_id for a borrowed book)
     """
     # Validate patron ID
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
@@ -197,37 +393,72 @@ def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
             'status': 'Book not borrowed by this patron'
         }
     
-  
-    current_date = datetime.now()
-    due_date = borrowed_book['due_date']
-    days_overdue = (current_date - due_date).days
-    
-    if days_overdue <= 0:
-        return {
-            'fee_amount': 0.00,
-            'days_overdue': 0,
-            'status': 'Not overdue'
-        }
-    
-    # Calculate late fee based on requirements:
-    # $0.50/day for first 7 days overdue
-    # $1.00/day for each additional day after 7 days
-    # Maximum $15.00 per book
-    if days_overdue <= 7:
-        fee_amount = days_overdue * 0.50
-    else:
-        fee_amount = (7 * 0.50) + ((days_overdue - 7) * 1.00)
+    loan_id = borrowed_book['loan_id']
+    fee_info = calculate_late_fee_for_due_date(borrowed_book['due_date'])
+    amount_paid = get_paid_amounts([loan_id]).get(loan_id, 0.00)
+    fee_info['fee_amount'] = _outstanding(fee_info['fee_amount'], amount_paid)
+    return dict(fee_info, amount_paid=amount_paid, loan_id=loan_id)
+
+def _outstanding(fee_amount: float, amount_paid: float) -> float:
+    """Fee still owed once the recorded payments are subtracted."""
+    return round(max(fee_amount - amount_paid, 0.00), 2)
+
+def encode_catalog_cursor(after: Tuple[str, int]) -> str:
+    """Encode a (title, id) keyset position as an opaque, URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(list(after)).encode('utf-8')).decode('ascii')
+
+def decode_catalog_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    """Decode a cursor made by encode_catalog_cursor. Returns None if it is malformed."""
+    try:
+        title, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(title, str) or not isinstance(book_id, int):
+        return None
+    return title, book_id
+
+def get_catalog_page(cursor: Optional[str] = None, page_size: int = CATALOG_PAGE_SIZE,
+                     available_only: bool = False) -> Dict:
+    """
+    Get one page of the catalog, ordered by title.
+    Implements R2: Book Catalog Display
     
+    Pages are fetched by keyset (title, id) rather than OFFSET, so every page
+    costs the same no matter how deep into the catalog it is.
     
-    fee_amount = min(fee_amount, 15.00)
+    Args:
+        cursor: next_cursor from the previous page, or None for the first page
+        page_size: Number of books per page (1 to MAX_CATALOG_PAGE_SIZE)
+        available_only: Only include books with available copies
+        
+    Returns:
+        dict: Contains books, next_cursor (None on the last page) and the
+        applied page_size/available_only; contains error for a bad cursor
+    """
+    page_size = min(max(page_size, 1), MAX_CATALOG_PAGE_SIZE)
+    after = None
+    if cursor:
+        after = decode_catalog_cursor(cursor)
+        if after is None:
+            return {
+                'error': 'Invalid catalog cursor.',
+                'books': [],
+                'next_cursor': None,
+                'page_size': page_size,
+                'available_only': available_only
+            }
+    
+    books, next_after = get_books_page(after=after, limit=page_size, available_only=available_only)
     
     return {
-        'fee_amount': round(fee_amount, 2),
-        'days_overdue': days_overdue,
-        'status': 'Overdue'
+        'books': books,
+        'next_cursor': encode_catalog_cursor(next_after) if next_after else None,
+        'page_size': page_size,
+        'available_only': available_only
     }
 
-def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
+def search_books_in_catalog(search_term: str, search_type: str, limit: Optional[int] = None,
+                            offset: int = 0, match: str = 'partial') -> List[Book]:
     """
     Search for books in the catalog.
     Implements R6: Book Search Functionality
@@ -235,6 +466,9 @@ def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
     Args:
         search_term: The search term to look for
         search_type: Type of search ('title', 'author', 'isbn')
+        limit: Maximum number of results to return (None for all)
+        offset: Number of results to skip (for paging)
+        match: 'partial' (substring) or 'prefix' for title/author searches
         
     Returns:
         list: List of matching books
@@ -246,35 +480,37 @@ def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
     if search_type not in ['title', 'author', 'isbn']:
         return []
     
- 
-    all_books = get_all_books()
-    matching_books = []
+    if match not in ['partial', 'prefix']:
+        return []
     
     search_term_clean = search_term.strip()
     
-    for book in all_books:
-        if search_type == 'title':
-            #partial match for title
-            if search_term_clean.lower() in book['title'].lower():
-                matching_books.append(book)
-        elif search_type == 'author':
-            #partial match for author
-            if search_term_clean.lower() in book['author'].lower():
-                matching_books.append(book)
-        elif search_type == 'isbn':
-            #exact matching for ISBN
-            if search_term_clean == book['isbn']:
-                matching_books.append(book)
+    if search_type == 'isbn':
+        #exact matching for ISBN through its unique index
+        book = get_book_by_isbn(search_term_clean)
+        return [book] if book and offset == 0 and limit != 0 else []
     
-    return matching_books
+    if match == 'prefix':
+        return search_books_by_prefix(search_type, search_term_clean, limit=limit, offset=offset)
+    
+    #partial, case-insensitive match served by the full-text index
+    return search_books(search_type, search_term_clean, limit=limit, offset=offset)
 
-def get_patron_status_report(patron_id: str) -> Dict:
+def get_patron_status_report(patron_id: str, history_limit: int = 50, history_offset: int = 0) -> Dict:
     """
     Get status report for a patron.
     Implements R7: Patron Status Report
     
+    Current loans come from one query and their late fees are computed in a
+    single pass over the loaded due dates, less the amounts already paid
+    (one indexed ledger lookup for all of them); history is one paged query.
+    accrued_fees (late fees charged on past returns) and last_activity are
+    read from the patron's summary row.
+    
     Args:
         patron_id: 6-digit library card ID
+        history_limit: Maximum number of history entries to include
+        history_offset: Number of history entries to skip (for paging)
         
     Returns:
         dict: Contains patron status information
@@ -289,40 +525,79 @@ def get_patron_status_report(patron_id: str) -> Dict:
             'borrowing_history': []
         }
     
-   
     borrowed_books = get_patron_borrowed_books(patron_id)
     
-  
+    now = datetime.now()
+    paid = get_paid_amounts(loan.loan_id for loan in borrowed_books)
     total_late_fees = 0.00
-    for book in borrowed_books:
-        late_fee_info = calculate_late_fee_for_book(patron_id, book['book_id'])
-        total_late_fees += late_fee_info.get('fee_amount', 0.00)
+    for loan in borrowed_books:
+        late_fee_info = calculate_late_fee_for_due_date(loan.due_date, now)
+        loan.amount_paid = paid.get(loan.loan_id, 0.00)
+        loan.late_fee = _outstanding(late_fee_info['fee_amount'], loan.amount_paid)
+        loan.days_overdue = late_fee_info['days_overdue']
+        total_late_fees += loan.late_fee
     
-
-    borrowing_history = get_patron_borrowing_history(patron_id)
+    # Header counters come from the patron's summary row, not from the history
+    summary = get_patron_summary(patron_id)
+    
+    # Fetch one extra row to know whether another page exists
+    borrowing_history = get_patron_borrowing_history(patron_id, limit=history_limit + 1, offset=history_offset)
+    history_has_more = len(borrowing_history) > history_limit
     
     return {
         'patron_id': patron_id,
         'currently_borrowed': borrowed_books,
         'total_late_fees': round(total_late_fees, 2),
         'books_borrowed_count': len(borrowed_books),
-        'borrowing_history': borrowing_history
+        'accrued_fees': summary['accrued_fees'],
+        'last_activity': summary['last_activity'],
+        'borrowing_history': borrowing_history[:history_limit],
+        'history_offset': history_offset,
+        'history_has_more': history_has_more
     }
 
-def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str]]:
+def get_loans_due_soon(days: int = 3, limit: int = 500) -> List[Loan]:
+    """
+    Get open loans that fall due within the next `days` days, earliest first
+    (for reminder notices). Already overdue loans are not included.
+    """
+    now = datetime.now()
+    return get_loans_due_between(now, now + timedelta(days=days), limit=limit)
+
+def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None,
+                  enqueue: bool = False, idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
     """
     Process payment for late fees using external payment gateway.
     
     NEW FEATURE FOR ASSIGNMENT 3: Demonstrates need for mocking/stubbing
     This function depends on an external payment service that should be mocked in tests.
     
+    With enqueue=True the fee is still validated and priced here, but the
+    gateway call is handed to the payment queue: the call returns at once
+    with a pending handle (pay_...) in place of the transaction ID, and the
+    outcome is read later from payment_queue.get(handle) or
+    GET /api/payments/<handle>.
+    
+    The charge runs under an idempotency key (see services.idempotency),
+    which is also sent to the gateway: once a payment under the key has
+    been approved, repeating the request returns the recorded result
+    without calling the gateway. Without an explicit key one is derived
+    from the patron, loan, fee amount, the amount already paid on the loan
+    and its number of refunds, so a fee owed again after a refund, or the
+    same amount owed again after a partial payment, is charged anew. If the
+    gateway does not answer, the outcome is reported as unknown and the
+    next request under the key asks the gateway whether the charge was
+    made before charging.
+    
     Args:
         patron_id: 6-digit library card ID
         book_id: ID of the book with late fees
         payment_gateway: Payment gateway instance (injectable for testing)
+        enqueue: Charge in the background and return a pending handle
+        idempotency_key: Client-supplied key identifying this payment request
         
     Returns:
-        tuple: (success: bool, message: str, transaction_id: Optional[str])
+        tuple: (success: bool, message: str, transaction_id or pending handle: Optional[str])
         
     Example for you to mock:
         # In tests, mock the payment gateway:
@@ -334,6 +609,12 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits.", None
     
+    # A retry under a known key is answered before any other work
+    if idempotency_key:
+        recorded = idempotency_store.recorded(idempotency_key)
+        if recorded is not None:
+            return tuple(recorded)
+    
     # Calculate late fee first
     fee_info = calculate_late_fee_for_book(patron_id, book_id)
     
@@ -351,38 +632,230 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
     if not book:
         return False, "Book not found.", None
     
+    description = f"Late fees for '{book['title']}'"
+    loan_id = fee_info.get('loan_id')
+    key = idempotency_key or derive_key('pay_late_fees', patron_id, book_id, loan_id, round(fee_amount, 2),
+                                        round(fee_info.get('amount_paid', 0.00), 2), get_loan_refund_count(loan_id))
+    in_progress = (False, "A payment for this request is already in progress.", None)
+    
+    if enqueue:
+        # A key left unknown is charged again too: the gateway answers a repeated key with the first result
+        state, recorded = idempotency_store.begin(key, 'pay_late_fees')
+        if state == REPLAYED:
+            return tuple(recorded)
+        if state == IN_PROGRESS:
+            return in_progress
+        handle = payment_queue.submit(patron_id, fee_amount, description, book_id=book_id,
+                                      gateway=payment_gateway, idempotency_key=key,
+                                      on_finish=lambda job: _record_queued_payment(key, job, loan_id))
+        return True, f"Payment of ${fee_amount:.2f} is pending.", handle
+    
     # Use provided gateway or create new one
     if payment_gateway is None:
         payment_gateway = PaymentGateway()
     
+    return idempotency_store.run(
+        key, 'pay_late_fees',
+        lambda: _record_charge(_charge_late_fee(payment_gateway, patron_id, fee_amount, description, key),
+                               patron_id, loan_id, book_id, fee_amount),
+        succeeded=lambda result: result[0],
+        in_progress=in_progress,
+        ambiguous=AMBIGUOUS_ERRORS,
+        unknown=(False, "Payment outcome unknown: the payment gateway did not answer. "
+                        "Repeat the request to confirm it; the fee will not be charged twice.", None),
+        resolve=lambda: _resolve_charge(payment_gateway, key, patron_id, loan_id, book_id, fee_amount)
+    )
+
+def _charge_late_fee(payment_gateway: PaymentGateway, patron_id: str, fee_amount: float,
+                     description: str, key: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
     # Process payment through external gateway
     # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
     try:
-        success, transaction_id, message = payment_gateway.process_payment(
-            patron_id=patron_id,
-            amount=fee_amount,
-            description=f"Late fees for '{book['title']}'"
-        )
+        with gateway_idempotency_key(key):
+            success, transaction_id, message = payment_gateway.process_payment(
+                patron_id=patron_id,
+                amount=fee_amount,
+                description=description
+            )
         
         if success:
             return True, f"Payment successful! {message}", transaction_id
         else:
             return False, f"Payment failed: {message}", None
             
+    except AMBIGUOUS_ERRORS:
+        # The gateway may have charged; the idempotency store keeps the key to find out
+        raise
     except Exception as e:
         # Handle payment gateway errors
         return False, f"Payment processing error: {str(e)}", None
 
-def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway: PaymentGateway = None) -> Tuple[bool, str]:
+def _resolve_charge(payment_gateway: PaymentGateway, key: str, patron_id: str, loan_id: Optional[int],
+                    book_id: int, fee_amount: float) -> Optional[Tuple[bool, str, Optional[str]]]:
+    """
+    Ask the gateway whether a charge whose call got no answer was made.
+
+    Returns the approved result (added to the ledger) if it was, None if it
+    was not; raises while the gateway cannot tell.
+    """
+    transaction_id = _verify_charge(payment_gateway, key)
+    if transaction_id is None:
+        return None
+    result = (True, f"Payment successful! Payment of ${fee_amount:.2f} processed successfully", transaction_id)
+    return _record_charge(result, patron_id, loan_id, book_id, fee_amount)
+
+def _verify_charge(payment_gateway: PaymentGateway, key: str) -> Optional[str]:
+    """Transaction ID of the charge made under key, None if there is none; raises while the gateway cannot tell."""
+    status = payment_gateway.verify_payment_status(idempotency_key=key)
+    if not isinstance(status, dict) or status.get('status') in (None, 'error'):
+        raise RuntimeError(status.get('message') if isinstance(status, dict) else 'Unexpected gateway response')
+    if status['status'] in ('not_found', 'failed'):
+        return None
+    return status['transaction_id']
+
+def _record_charge(result: Tuple[bool, str, Optional[str]], patron_id: str, loan_id: Optional[int],
+                   book_id: int, fee_amount: float) -> Tuple[bool, str, Optional[str]]:
+    """Add an approved charge to the payments ledger (write-behind) and pass the result through."""
+    if result[0]:
+        record_payment(result[2], patron_id, loan_id, book_id, fee_amount)
+    return result
+
+def _record_queued_payment(key: str, job: Dict, loan_id: Optional[int]):
+    """Record (or release) the idempotency key of a finished queued payment, and ledger it if approved."""
+    if job['status'] == SUCCEEDED:
+        record_payment(job['transaction_id'], job['patron_id'], loan_id, job['book_id'], job['amount'])
+        idempotency_store.complete(key, [True, job['message'], job['transaction_id']])
+    elif job['status'] == UNKNOWN:
+        idempotency_store.mark_unknown(key)
+    else:
+        idempotency_store.release(key)
+
+def pay_all_late_fees(patron_id: str, payment_gateway: PaymentGateway = None,
+                      idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[str], List[Dict]]:
+    """
+    Pay every outstanding late fee of a patron with a single gateway charge.
+    
+    The patron's open loans come from one query and are priced in one pass
+    against the same instant. The gateway is called once for the total, with
+    the per-book breakdown in the description, and the split of the charge
+    across loans goes to the payments ledger under its transaction ID.
+    
+    Like pay_late_fees, the charge runs under an idempotency key (also sent
+    to the gateway), derived from the patron and each allocated loan, its
+    amount, the amount already paid on it and its number of refunds unless
+    one is given, so a retried or unanswered request is never charged twice
+    and a later payment of the same amounts is not mistaken for a retry.
+    
+    Args:
+        patron_id: 6-digit library card ID
+        payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: Client-supplied key identifying this payment request
+        
+    Returns:
+        tuple: (success: bool, message: str, transaction_id: Optional[str],
+        allocations: list of {'loan_id', 'book_id', 'title', 'amount', 'days_overdue'})
+    """
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits.", None, []
+    
+    # A retry under a known key is answered before any other work
+    if idempotency_key:
+        recorded = idempotency_store.recorded(idempotency_key)
+        if recorded is not None:
+            return tuple(recorded)
+    
+    now = datetime.now()
+    loans = get_patron_borrowed_books(patron_id)
+    paid = get_paid_amounts(loan.loan_id for loan in loans)
+    allocations = []
+    for loan in loans:
+        fee_info = calculate_late_fee_for_due_date(loan.due_date, now)
+        amount = _outstanding(fee_info['fee_amount'], paid.get(loan.loan_id, 0.00))
+        if amount > 0:
+            allocations.append({
+                'loan_id': loan.loan_id,
+                'book_id': loan.book_id,
+                'title': loan.title,
+                'amount': amount,
+                'days_overdue': fee_info['days_overdue']
+            })
+    
+    if not allocations:
+        return False, "No late fees to pay.", None, []
+    
+    total = round(sum(allocation['amount'] for allocation in allocations), 2)
+    breakdown = '; '.join(f"'{allocation['title']}' ${allocation['amount']:.2f}" for allocation in allocations)
+    
+    key = idempotency_key or derive_key(
+        'pay_all_late_fees', patron_id,
+        [(allocation['loan_id'], allocation['amount'], paid.get(allocation['loan_id'], 0.00),
+          get_loan_refund_count(allocation['loan_id'])) for allocation in allocations]
+    )
+    
+    if payment_gateway is None:
+        payment_gateway = PaymentGateway()
+    
+    return idempotency_store.run(
+        key, 'pay_all_late_fees',
+        lambda: _record_allocations(
+            _charge_late_fee(payment_gateway, patron_id, total,
+                             f"Late fees for {len(allocations)} book(s): {breakdown}", key) + (allocations,),
+            patron_id
+        ),
+        succeeded=lambda result: result[0],
+        in_progress=(False, "A payment for this request is already in progress.", None, allocations),
+        ambiguous=AMBIGUOUS_ERRORS,
+        unknown=(False, "Payment outcome unknown: the payment gateway did not answer. "
+                        "Repeat the request to confirm it; the fees will not be charged twice.", None, allocations),
+        resolve=lambda: _resolve_charge_all(payment_gateway, key, patron_id, total, allocations)
+    )
+
+def _resolve_charge_all(payment_gateway: PaymentGateway, key: str, patron_id: str, total: float,
+                        allocations: List[Dict]) -> Optional[Tuple[bool, str, Optional[str], List[Dict]]]:
+    """Like _resolve_charge, for a pay-all charge split across allocations."""
+    transaction_id = _verify_charge(payment_gateway, key)
+    if transaction_id is None:
+        return None
+    result = (True, f"Payment successful! Payment of ${total:.2f} processed successfully", transaction_id,
+              allocations)
+    return _record_allocations(result, patron_id)
+
+def _record_allocations(result: Tuple[bool, str, Optional[str], List[Dict]],
+                        patron_id: str) -> Tuple[bool, str, Optional[str], List[Dict]]:
+    """Add each loan's share of an approved pay-all charge to the payments ledger and pass the result through."""
+    success, _, transaction_id, allocations = result
+    if success:
+        for allocation in allocations:
+            record_payment(transaction_id, patron_id, allocation['loan_id'], allocation['book_id'],
+                           allocation['amount'])
+    return result
+
+def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway: PaymentGateway = None,
+                            idempotency_key: Optional[str] = None) -> Tuple[bool, str]:
     """
     Refund a late fee payment (e.g., if book was returned on time but fees were charged in error).
     
     NEW FEATURE FOR ASSIGNMENT 3: Another function requiring mocking
     
+    A transaction in the payments ledger can be refunded up to what was
+    charged on it, less its earlier refunds (a pay-all charge covers
+    several books); one the ledger has no record of, up to the maximum
+    late fee for one book.
+    
+    Like pay_late_fees, the refund runs under an idempotency key (also
+    sent to the gateway), derived from the transaction, the amount and what
+    has already been refunded on it unless one is given. Every recorded
+    refund therefore moves the next request to a new key, so two partial
+    refunds of the same amount are both made. If the gateway does not
+    answer, the outcome is reported as unknown and repeating the request
+    sends it again under the same key, which the gateway carries out only
+    once.
+    
     Args:
         transaction_id: Original transaction ID to refund
         amount: Amount to refund
         payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: Client-supplied key identifying this refund request
         
     Returns:
         tuple: (success: bool, message: str)
@@ -394,22 +867,47 @@ def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway:
     if amount <= 0:
         return False, "Refund amount must be greater than 0."
     
-    if amount > 15.00:  # Maximum late fee per book
-        return False, "Refund amount exceeds maximum late fee."
+    entries = get_ledger_entries(transaction_id)
+    charged = round(sum(entry['amount'] for entry in entries if entry['entry_type'] == 'payment'), 2)
+    refunded = round(sum(entry['amount'] for entry in entries if entry['entry_type'] == 'refund'), 2)
+    if not charged:
+        if amount > 15.00:  # Maximum late fee per book
+            return False, "Refund amount exceeds maximum late fee."
+    elif amount > round(charged - refunded, 2):
+        return False, f"Refund amount exceeds the ${charged - refunded:.2f} left to refund on this transaction."
     
     # Use provided gateway or create new one
     if payment_gateway is None:
         payment_gateway = PaymentGateway()
     
+    key = idempotency_key or derive_key('refund_late_fee_payment', transaction_id, round(amount, 2), refunded)
+    return idempotency_store.run(
+        key, 'refund_late_fee_payment',
+        lambda: _refund_payment(payment_gateway, transaction_id, amount, key),
+        succeeded=lambda result: result[0],
+        in_progress=(False, "A refund for this request is already in progress."),
+        ambiguous=AMBIGUOUS_ERRORS,
+        unknown=(False, "Refund outcome unknown: the payment gateway did not answer. "
+                        "Repeat the request to confirm it; it will not be refunded twice.")
+    )
+
+def _refund_payment(payment_gateway: PaymentGateway, transaction_id: str, amount: float,
+                    key: Optional[str] = None) -> Tuple[bool, str]:
     # Process refund through external gateway
     # THIS IS WHAT YOU SHOULD MOCK IN YOUR TESTS!
     try:
-        success, message = payment_gateway.refund_payment(transaction_id, amount)
+        with gateway_idempotency_key(key):
+            success, message = payment_gateway.refund_payment(transaction_id, amount)
         
         if success:
+            record_refund(transaction_id, amount)
+            # Its reconciled status is stale now; the next reconciliation checks it again
+            forget_payment_verification(transaction_id)
             return True, message
         else:
             return False, f"Refund failed: {message}"
             
+    except AMBIGUOUS_ERRORS:
+        raise
     except Exception as e:
         return False, f"Refund processing error: {str(e)}"
\ No newline at end of file
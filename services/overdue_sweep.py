@@ -0,0 +1,206 @@
+"""
+Overdue Sweep Module - Late fees for every open loan in one pass
+
+The nightly "who owes what" report used to call calculate_late_fee_for_book
+once per (patron, book). This module streams the due dates (epoch seconds)
+of all overdue open loans in chunks and prices a whole chunk at a time, then
+writes one row per patron to the overdue_fee_report table.
+
+Fees are looked up in a table of cents by days overdue that is generated
+from calculate_late_fee_for_due_date itself, so the sweep applies exactly
+the same schedule ($0.50/day for 7 days, $1.00/day after, $15.00 cap).
+What the payments ledger holds as paid on a loan is subtracted from its
+fee, as calculate_late_fee_for_book does; the paid amounts of all the
+swept loans come from one query.
+NumPy is used when it is installed; otherwise a pure Python engine prices
+the same chunks.
+
+Usage:
+    python -m services.overdue_sweep [--as-of 2025-01-31T00:00:00] [--chunk-size 100000] [--engine numpy|python]
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+import database
+from database import (
+    iter_overdue_loan_chunks, get_open_loan_paid_amounts, start_fee_sweep_run, save_overdue_fee_report, to_epoch
+)
+from .library_service import calculate_late_fee_for_due_date
+
+DEFAULT_CHUNK_SIZE = 100000
+ENGINES = ('numpy', 'python')
+
+SECONDS_PER_DAY = 86400
+
+# The schedule reaches its cap well within this many days; later days reuse the last entry
+FEE_TABLE_DAYS = 64
+
+
+def build_fee_table(days: int = FEE_TABLE_DAYS) -> List[int]:
+    """Late fee in cents for 0..days-1 days overdue, taken from calculate_late_fee_for_due_date."""
+    as_of = datetime(2000, 1, 1)
+    return [round(calculate_late_fee_for_due_date(as_of - timedelta(days=d), as_of)['fee_amount'] * 100)
+            for d in range(days)]
+
+
+def _price_chunk_numpy(patron_ids: List[str], due_dates: List[int], loan_ids: List[int], as_of: datetime,
+                       fee_table, paid, totals: Dict[str, List[int]]):
+    due = np.array(due_dates, dtype=np.int64)
+    # Floor division matches timedelta.days for the loan's (as_of - due_date)
+    days = (to_epoch(as_of) - due) // SECONDS_PER_DAY
+    cents = fee_table[np.clip(days, 0, len(fee_table) - 1)]
+    paid_loans, paid_cents = paid
+    if len(paid_loans):
+        loans = np.array(loan_ids, dtype=np.int64)
+        position = np.minimum(np.searchsorted(paid_loans, loans), len(paid_loans) - 1)
+        cents = np.maximum(cents - np.where(paid_loans[position] == loans, paid_cents[position], 0), 0)
+    charged = cents > 0
+    if not charged.any():
+        return
+    patrons, index = np.unique(np.array(patron_ids)[charged], return_inverse=True)
+    loans = np.bincount(index)
+    fees = np.bincount(index, weights=cents[charged])
+    for patron_id, loan_count, fee_cents in zip(patrons.tolist(), loans.tolist(), fees.tolist()):
+        entry = totals.get(patron_id)
+        if entry is None:
+            totals[patron_id] = [loan_count, int(fee_cents)]
+        else:
+            entry[0] += loan_count
+            entry[1] += int(fee_cents)
+
+
+def _price_chunk_python(patron_ids: List[str], due_dates: List[int], loan_ids: List[int], as_of: datetime,
+                        fee_table: List[int], paid: Dict[int, int], totals: Dict[str, List[int]]):
+    last_day = len(fee_table) - 1
+    as_of_seconds = to_epoch(as_of)
+    for patron_id, due_date, loan_id in zip(patron_ids, due_dates, loan_ids):
+        days = (as_of_seconds - due_date) // SECONDS_PER_DAY
+        cents = fee_table[min(days, last_day)] if days > 0 else 0
+        if cents and paid:
+            cents = max(cents - paid.get(loan_id, 0), 0)
+        if cents:
+            entry = totals.get(patron_id)
+            if entry is None:
+                totals[patron_id] = [1, cents]
+            else:
+                entry[0] += 1
+                entry[1] += cents
+
+
+def resolve_engine(engine: Optional[str] = None) -> str:
+    """Check an engine name, defaulting to numpy when it is installed."""
+    engine = engine or ('numpy' if np is not None else 'python')
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown sweep engine {engine!r}; expected one of {ENGINES}.")
+    if engine == 'numpy' and np is None:
+        raise ValueError("The numpy sweep engine needs NumPy installed.")
+    return engine
+
+
+def price_loan_chunks(chunks: Iterable[Tuple[List[str], List[int], List[int]]], as_of: datetime,
+                      engine: Optional[str] = None, paid: Optional[Dict[int, float]] = None) -> Dict[str, List[int]]:
+    """
+    Price (patron_ids, due_dates, loan_ids) chunks of open loans (due dates in epoch seconds).
+
+    Args:
+        chunks: Column chunks from iter_overdue_loan_chunks
+        as_of: Date to measure lateness against
+        engine: 'numpy' or 'python' (default: numpy when installed)
+        paid: loan_id -> amount already paid, subtracted from that loan's fee
+
+    Returns:
+        dict: patron_id -> [overdue_loans, total_fee_cents] for patrons who still owe a fee
+    """
+    engine = resolve_engine(engine)
+    fee_table = build_fee_table()
+    paid_cents = {loan_id: round(amount * 100) for loan_id, amount in (paid or {}).items()}
+    price_chunk = _price_chunk_python
+    if engine == 'numpy':
+        fee_table = np.array(fee_table, dtype=np.int64)
+        # Sorted loan ids and their paid cents, matched against each chunk with searchsorted
+        paid_loans = np.array(sorted(paid_cents), dtype=np.int64)
+        paid_cents = (paid_loans, np.array([paid_cents[loan_id] for loan_id in paid_loans.tolist()], dtype=np.int64))
+        price_chunk = _price_chunk_numpy
+
+    totals: Dict[str, List[int]] = {}
+    for patron_ids, due_dates, loan_ids in chunks:
+        price_chunk(patron_ids, due_dates, loan_ids, as_of, fee_table, paid_cents, totals)
+    return totals
+
+
+def compute_overdue_totals(as_of: datetime, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           engine: Optional[str] = None) -> Dict[str, List[int]]:
+    """
+    Price every open loan due before as_of, less what has been paid on it.
+
+    Returns:
+        dict: patron_id -> [overdue_loans, total_fee_cents] for patrons who still owe a fee
+    """
+    engine = resolve_engine(engine)
+    paid = get_open_loan_paid_amounts(as_of)
+    return price_loan_chunks(iter_overdue_loan_chunks(as_of, chunk_size), as_of, engine, paid)
+
+
+def sweep_overdue_fees(as_of: Optional[datetime] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       engine: Optional[str] = None) -> Dict:
+    """
+    Run the overdue sweep and store per-patron totals in overdue_fee_report.
+
+    Args:
+        as_of: Date to measure lateness against (defaults to now)
+        chunk_size: Open loans loaded and priced per chunk
+        engine: 'numpy' or 'python' (default: numpy when installed)
+
+    Returns:
+        dict: run_id, as_of, engine, overdue_loans, patrons, total_fees and elapsed seconds
+    """
+    as_of = as_of or datetime.now()
+    engine = resolve_engine(engine)
+    started = time.perf_counter()
+
+    run_id = start_fee_sweep_run(as_of)
+    totals = compute_overdue_totals(as_of, chunk_size, engine)
+    summary = save_overdue_fee_report(
+        run_id, ((patron_id, loans, cents / 100) for patron_id, (loans, cents) in totals.items()))
+
+    return {
+        'run_id': run_id,
+        'as_of': as_of.isoformat(),
+        'engine': engine,
+        'overdue_loans': summary['overdue_loans'],
+        'patrons': summary['patrons'],
+        'total_fees': summary['total_fees'],
+        'elapsed': time.perf_counter() - started
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compute late fees for all open loans.")
+    parser.add_argument('--as-of', type=datetime.fromisoformat, help="ISO date/time (default: now)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--engine', choices=ENGINES)
+    parser.add_argument('--database', default=database.DATABASE, help="SQLite database file")
+    args = parser.parse_args(argv)
+
+    database.DATABASE = args.database
+    database.init_database()
+    try:
+        summary = sweep_overdue_fees(args.as_of, args.chunk_size, args.engine)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(summary))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
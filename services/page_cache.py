@@ -0,0 +1,113 @@
+"""
+Page Cache Module - Versioned cache for rendered catalog and search output
+
+Rendered pages (and JSON payloads) are stored under a key that includes the
+catalog state from database.py. Any committed change to the books table
+bumps its version, so stale entries are simply never looked up again and
+age out of the LRU. Looking up an entry costs one primary-key read of that
+state and no Jinja rendering.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import database
+
+# Cache limits
+MAX_ENTRIES = 512
+MAX_BYTES = 32 * 1024 * 1024
+# Upper bound on entry age
+MAX_AGE = 300.0
+
+
+class PageCache:
+    """
+    Thread-safe LRU cache of rendered strings with an entry count and memory cap.
+
+    Sizes are measured as the UTF-8 length of each value; the least recently
+    used entries are evicted until both limits are met.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES,
+                 max_age: Optional[float] = MAX_AGE):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries: "OrderedDict[Hashable, Tuple[str, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """Get a cached value, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.max_age is not None and time.monotonic() - entry[2] > self.max_age:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: str):
+        """Store a value, evicting least recently used entries to stay within limits."""
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def get_or_render(self, key: Hashable, render: Callable[[], str]) -> str:
+        """Return the cached value for key, rendering and storing it on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        """Drop every entry (metrics are kept)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        """Hit/miss/eviction counters and current size."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes
+            }
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+def versioned_key(*parts: Hashable) -> Tuple:
+    """Build a cache key tied to the current database and catalog state (instance and version)."""
+    return (database.DATABASE,) + database.get_catalog_state()[:2] + parts
+
+
+# Shared cache used by the catalog, search and API routes
+page_cache = PageCache()
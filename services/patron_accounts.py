@@ -0,0 +1,96 @@
+"""
+Patron Accounts Module - Reconciliation of the patrons summary table
+
+The borrow and return paths keep each patron's active_loans, accrued_fees
+and last_activity up to date in the same transaction as the loan change.
+This command rebuilds the whole table from borrow_records (pricing every
+late return with calculate_late_fee_for_due_date) and reports which rows
+had drifted, e.g. after loans were edited by hand or imported directly.
+
+Usage:
+    python -m services.patron_accounts [--dry-run] [--database library.db]
+"""
+
+import argparse
+import json
+import sys
+import time
+from typing import Dict, List, Optional
+
+import database
+from database import (
+    get_all_patron_summaries, iter_late_returns, rebuild_patron_summaries, transaction, from_epoch
+)
+from .library_service import calculate_late_fee_for_due_date
+
+# Corrections beyond this many are counted but not listed
+MAX_CORRECTION_SAMPLES = 100
+
+
+def _accrued_fees_from_history(conn) -> Dict[str, float]:
+    fees: Dict[str, float] = {}
+    for rows in iter_late_returns(conn):
+        for patron_id, due_date, return_date in rows:
+            fee_amount = calculate_late_fee_for_due_date(from_epoch(due_date), from_epoch(return_date))['fee_amount']
+            if fee_amount > 0:
+                fees[patron_id] = fees.get(patron_id, 0.00) + fee_amount
+    return fees
+
+
+def reconcile_patron_summaries(dry_run: bool = False) -> Dict:
+    """
+    Rebuild the patrons summary table from borrow_records.
+
+    Runs in one write transaction, so borrows and returns wait until it is
+    done and never interleave with the rebuild.
+
+    Args:
+        dry_run: Report the drift without changing anything
+
+    Returns:
+        dict: patrons (rows after the rebuild), corrected (rows that changed),
+        corrections (first MAX_CORRECTION_SAMPLES as {'patron_id', 'before', 'after'})
+        and elapsed seconds
+    """
+    started = time.perf_counter()
+    with transaction() as conn:
+        before = get_all_patron_summaries(conn)
+        rebuild_patron_summaries(_accrued_fees_from_history(conn), conn=conn)
+        after = get_all_patron_summaries(conn)
+        if dry_run:
+            conn.rollback()
+
+    corrections: List[Dict] = []
+    corrected = 0
+    for patron_id in sorted(set(before) | set(after)):
+        if before.get(patron_id) != after.get(patron_id):
+            corrected += 1
+            if len(corrections) < MAX_CORRECTION_SAMPLES:
+                corrections.append({'patron_id': patron_id,
+                                    'before': before.get(patron_id), 'after': after.get(patron_id)})
+    return {
+        'patrons': len(after),
+        'corrected': corrected,
+        'corrections': corrections,
+        'dry_run': dry_run,
+        'elapsed': time.perf_counter() - started
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild the patrons summary table from borrow_records.")
+    parser.add_argument('--dry-run', action='store_true', help="only report rows that would change")
+    parser.add_argument('--database', default=database.DATABASE, help="SQLite database file")
+    args = parser.parse_args(argv)
+
+    database.DATABASE = args.database
+    database.init_database()
+    summary = reconcile_patron_summaries(dry_run=args.dry_run)
+    for correction in summary['corrections']:
+        print(f"{correction['patron_id']}: {correction['before']} -> {correction['after']}", file=sys.stderr)
+    print(json.dumps({key: value for key, value in summary.items() if key != 'corrections'}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Payment Queue Module - Asynchronous late fee payments
+
+pay_late_fees(..., enqueue=True) prices the fee on the request thread and
+hands the gateway call to this queue, which runs it on a small thread pool
+and returns a pending handle straight away. Callers poll the handle
+(GET /api/payments/<handle>) until the job succeeds or fails, so a slow
+gateway no longer holds a Flask worker thread for the length of the call.
+
+A job whose gateway call got no answer (timeout, dropped connection)
+finishes as unknown rather than failed: the gateway may have charged.
+
+Jobs are kept in memory, per process; finished jobs are evicted oldest
+first once more than MAX_FINISHED_JOBS have accumulated.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from .payment_service import PaymentGateway, AMBIGUOUS_ERRORS, gateway_idempotency_key
+
+# Queue limits
+PAYMENT_WORKERS = 4
+MAX_FINISHED_JOBS = 10000
+
+# Job states
+PENDING = 'pending'
+PROCESSING = 'processing'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+FINISHED_STATES = (SUCCEEDED, FAILED, UNKNOWN)
+
+HANDLE_PREFIX = 'pay_'
+
+
+class PaymentQueue:
+    """
+    Thread pool that runs PaymentGateway.process_payment calls in the background.
+
+    Each submitted payment gets a job dict (handle, patron_id, book_id,
+    amount, status, transaction_id, message, timestamps) that is updated as
+    the call progresses. The pool is started on first use.
+    """
+
+    def __init__(self, workers: int = PAYMENT_WORKERS,
+                 gateway_factory: Callable[[], PaymentGateway] = PaymentGateway,
+                 max_finished_jobs: int = MAX_FINISHED_JOBS):
+        self.workers = workers
+        self.gateway_factory = gateway_factory
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
+        self._done_events: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, patron_id: str, amount: float, description: str = '', book_id: Optional[int] = None,
+               gateway: Optional[PaymentGateway] = None,
+               on_finish: Optional[Callable[[Dict], None]] = None, idempotency_key: Optional[str] = None) -> str:
+        """
+        Queue a payment and return its handle without waiting for the gateway.
+
+        Args:
+            patron_id: 6-digit library card ID
+            amount: Amount to charge
+            description: Payment description sent to the gateway
+            book_id: Book the fee is for (reported back in the job status)
+            gateway: Gateway to charge through (default: a new one from gateway_factory)
+            on_finish: Called on the worker thread with a copy of the finished job
+            idempotency_key: Sent to the gateway with the charge (see gateway_idempotency_key)
+
+        Returns:
+            str: Handle to poll with get()
+        """
+        handle = HANDLE_PREFIX + uuid.uuid4().hex
+        job = {
+            'handle': handle,
+            'patron_id': patron_id,
+            'book_id': book_id,
+            'amount': amount,
+            'status': PENDING,
+            'transaction_id': None,
+            'message': 'Payment queued.',
+            'submitted_at': time.time(),
+            'finished_at': None
+        }
+        with self._lock:
+            self._jobs[handle] = job
+            self._done_events[handle] = threading.Event()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='payment')
+            executor = self._executor
+        executor.submit(self._run, handle, description, gateway, on_finish, idempotency_key)
+        return handle
+
+    def get(self, handle: str) -> Optional[Dict]:
+        """Get a copy of the job for a handle, or None if it is unknown (or was evicted)."""
+        with self._lock:
+            job = self._jobs.get(handle)
+            return dict(job) if job is not None else None
+
+    def wait(self, handle: str, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Block until the job has finished (or timeout passes) and return it."""
+        with self._lock:
+            done = self._done_events.get(handle)
+        if done is not None:
+            done.wait(timeout)
+        return self.get(handle)
+
+    def stats(self) -> Dict:
+        """Job counts by status."""
+        with self._lock:
+            counts = {status: 0 for status in (PENDING, PROCESSING) + FINISHED_STATES}
+            for job in self._jobs.values():
+                counts[job['status']] += 1
+            return dict(counts, workers=self.workers)
+
+    def shutdown(self, wait: bool = True):
+        """Stop the worker pool (a later submit starts a new one)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _run(self, handle: str, description: str, gateway: Optional[PaymentGateway],
+             on_finish: Optional[Callable[[Dict], None]], idempotency_key: Optional[str]):
+        with self._lock:
+            job = self._jobs[handle]
+            job['status'] = PROCESSING
+            patron_id, amount = job['patron_id'], job['amount']
+
+        try:
+            if gateway is None:
+                gateway = self.gateway_factory()
+            with gateway_idempotency_key(idempotency_key):
+                success, transaction_id, message = gateway.process_payment(
+                    patron_id=patron_id,
+                    amount=amount,
+                    description=description
+                )
+            if success:
+                outcome = (SUCCEEDED, transaction_id, f"Payment successful! {message}")
+            else:
+                outcome = (FAILED, None, f"Payment failed: {message}")
+        except AMBIGUOUS_ERRORS as e:
+            outcome = (UNKNOWN, None, f"Payment outcome unknown: {str(e)}")
+        except Exception as e:
+            outcome = (FAILED, None, f"Payment processing error: {str(e)}")
+
+        job = self._finish(handle, *outcome)
+        try:
+            if on_finish is not None:
+                on_finish(job)
+        finally:
+            self._signal_done(handle)
+
+    def _finish(self, handle: str, status: str, transaction_id: Optional[str], message: str) -> Dict:
+        with self._lock:
+            job = self._jobs[handle]
+            job.update(status=status, transaction_id=transaction_id, message=message, finished_at=time.time())
+            return dict(job)
+
+    def _signal_done(self, handle: str):
+        with self._lock:
+            done = self._done_events[handle]
+            self._finished[handle] = None
+            while len(self._finished) > self.max_finished_jobs:
+                evicted, _ = self._finished.popitem(last=False)
+                del self._jobs[evicted]
+                self._done_events.pop(evicted, None)
+        done.set()
+
+
+# Shared queue used by pay_late_fees and the payment status route
+payment_queue = PaymentQueue()
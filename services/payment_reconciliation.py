@@ -0,0 +1,166 @@
+"""
+Payment Reconciliation Module - Check recorded late fee payments against the gateway
+
+Reads the transactions recorded in the payments ledger
+(database.get_recorded_transactions) and asks the gateway for each one's
+status with verify_payment_status. The calls are I/O-bound (about 300 ms
+each), so they run on a bounded thread pool: wall time grows with rows /
+workers rather than with the row count. There are never more workers than
+the gateway session keeps pooled connections (GATEWAY_POOL_SIZE); any more
+would open a connection per extra call and throw it away afterwards
+instead of reusing one. A transaction is expected to be completed, or
+refunded once the ledger holds refunds for its whole amount.
+
+A transaction whose gateway status matches the ledger and is terminal
+(completed, refunded or failed) is recorded in payment_verifications and
+never queried again; refunding it through refund_late_fee_payment clears
+that record. Mismatches are reported as discrepancies and checked again on
+the next run, as are transactions the gateway could not answer for.
+
+Usage:
+    python -m services.payment_reconciliation [--concurrency 10] [--recheck]
+        [--report discrepancies.csv] [--database library.db]
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import database
+from database import get_recorded_transactions, save_payment_verifications
+from . import payment_service
+from .payment_service import PaymentGateway
+
+# Statuses a transaction does not leave on its own
+TERMINAL_STATUSES = ('completed', 'refunded', 'failed')
+
+# Amounts closer than this are treated as equal
+AMOUNT_TOLERANCE = 0.005
+
+REPORT_COLUMNS = ('transaction_id', 'patron_id', 'recorded_amount', 'recorded_refunds', 'gateway_status',
+                  'gateway_amount', 'issue')
+
+
+def _verify(gateway: PaymentGateway, transaction_id: str) -> Dict:
+    try:
+        status = gateway.verify_payment_status(transaction_id)
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+    return status if isinstance(status, dict) else {'status': 'error', 'message': 'Unexpected gateway response'}
+
+
+def _issue(recorded: Dict, status: Dict) -> Optional[str]:
+    """What is wrong with a transaction, or None when the gateway agrees with the ledger."""
+    gateway_status = status.get('status')
+    if gateway_status == 'not_found':
+        return 'missing at gateway'
+    fully_refunded = recorded['amount'] is not None and recorded['refunded'] >= recorded['amount'] - AMOUNT_TOLERANCE
+    expected = 'refunded' if fully_refunded else 'completed'
+    if gateway_status != expected:
+        return f'gateway status is {gateway_status}, ledger expects {expected}'
+    gateway_amount = status.get('amount')
+    if recorded['amount'] is not None and gateway_amount is not None \
+            and abs(recorded['amount'] - gateway_amount) > AMOUNT_TOLERANCE:
+        return 'amount mismatch'
+    return None
+
+
+def reconcile_payments(gateway: Optional[PaymentGateway] = None, concurrency: Optional[int] = None,
+                       recheck: bool = False) -> Dict:
+    """
+    Verify the recorded transactions with the gateway and collect discrepancies.
+
+    Args:
+        gateway: Gateway to query (default: a new PaymentGateway)
+        concurrency: Most verify_payment_status calls in flight at once
+            (default and upper limit: the gateway's GATEWAY_POOL_SIZE)
+        recheck: Also verify transactions whose terminal status was already recorded
+
+    Returns:
+        dict: checked, matched and unverified counts, discrepancies (list of
+        dicts with REPORT_COLUMNS keys), the concurrency used and elapsed seconds
+    """
+    if concurrency is not None and concurrency < 1:
+        raise ValueError('Concurrency must be at least 1.')
+    concurrency = min(concurrency or payment_service.GATEWAY_POOL_SIZE, payment_service.GATEWAY_POOL_SIZE)
+    started = time.perf_counter()
+    if gateway is None:
+        gateway = PaymentGateway()
+
+    transactions = get_recorded_transactions(include_verified=recheck)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='reconcile') as pool:
+        statuses = list(pool.map(lambda recorded: _verify(gateway, recorded['transaction_id']), transactions))
+
+    discrepancies: List[Dict] = []
+    verified = []
+    unverified = 0
+    for recorded, status in zip(transactions, statuses):
+        if status.get('status') == 'error':
+            unverified += 1
+            continue
+        issue = _issue(recorded, status)
+        if issue is not None:
+            discrepancies.append({
+                'transaction_id': recorded['transaction_id'],
+                'patron_id': recorded['patron_id'],
+                'recorded_amount': recorded['amount'],
+                'recorded_refunds': recorded['refunded'],
+                'gateway_status': status.get('status'),
+                'gateway_amount': status.get('amount'),
+                'issue': issue
+            })
+        elif status['status'] in TERMINAL_STATUSES:
+            verified.append((recorded['transaction_id'], status['status'], status.get('amount')))
+    save_payment_verifications(verified)
+
+    return {
+        'checked': len(transactions),
+        'matched': len(verified),
+        'unverified': unverified,
+        'discrepancies': discrepancies,
+        'concurrency': concurrency,
+        'elapsed': time.perf_counter() - started
+    }
+
+
+def write_discrepancy_report(discrepancies: Iterable[Dict], path: str) -> int:
+    """Write discrepancies to a CSV file; returns the number of rows written."""
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as report:
+        writer = csv.writer(report)
+        writer.writerow(REPORT_COLUMNS)
+        for discrepancy in discrepancies:
+            writer.writerow([discrepancy[column] for column in REPORT_COLUMNS])
+            count += 1
+    return count
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Verify recorded late fee payments with the payment gateway.")
+    parser.add_argument('--concurrency', type=int,
+                        help="gateway calls in flight at once (default and most: the gateway connection pool size)")
+    parser.add_argument('--recheck', action='store_true', help="also verify transactions already reconciled")
+    parser.add_argument('--report', help="CSV file for the discrepancies (default: listed on stderr)")
+    parser.add_argument('--database', default=database.DATABASE, help="SQLite database file")
+    args = parser.parse_args(argv)
+
+    database.DATABASE = args.database
+    database.init_database()
+    summary = reconcile_payments(concurrency=args.concurrency, recheck=args.recheck)
+    if args.report:
+        write_discrepancy_report(summary['discrepancies'], args.report)
+    else:
+        for discrepancy in summary['discrepancies']:
+            print(f"{discrepancy['transaction_id']}: {discrepancy['issue']} "
+                  f"(recorded {discrepancy['recorded_amount']}, gateway {discrepancy['gateway_status']} "
+                  f"{discrepancy['gateway_amount']})", file=sys.stderr)
+    print(json.dumps(dict(summary, discrepancies=len(summary['discrepancies']))))
+    return 1 if summary['discrepancies'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
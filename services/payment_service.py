@@ -6,31 +6,322 @@ For Assignment 3: You will learn to mock this service in their tests
 since we cannot make actual payment API calls during testing.
 """
 
+import os
+import socket
+import threading
 import requests
-from typing import Dict, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from typing import Dict, Optional, Tuple
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import time
 
+from .circuit_breaker import CircuitBreaker
+
+# HTTP client configuration. With PAYMENT_GATEWAY_URL unset the gateway is
+# simulated in-process; set it (e.g. to a services.gateway_server stand-in)
+# to send real HTTP requests.
+GATEWAY_URL = os.environ.get('PAYMENT_GATEWAY_URL')
+GATEWAY_POOL_SIZE = int(os.environ.get('PAYMENT_GATEWAY_POOL_SIZE', 10))  # kept-alive connections per host
+GATEWAY_CONNECT_TIMEOUT = float(os.environ.get('PAYMENT_GATEWAY_CONNECT_TIMEOUT', 3.05))
+GATEWAY_READ_TIMEOUT = float(os.environ.get('PAYMENT_GATEWAY_READ_TIMEOUT', 10.0))
+# Most a single gateway call may spend, from sending it to the last byte of the answer; caps both timeouts above
+GATEWAY_CALL_BUDGET = float(os.environ.get('PAYMENT_GATEWAY_CALL_BUDGET', 5.0))
+# Keyword arguments for each URL's CircuitBreaker (empty: the circuit_breaker defaults)
+GATEWAY_BREAKER_SETTINGS: Dict = {}
+
+# Errors after which the gateway may or may not have carried out the request
+AMBIGUOUS_ERRORS = (requests.Timeout, requests.ConnectionError)
+
+_idempotency_key: ContextVar[Optional[str]] = ContextVar('gateway_idempotency_key', default=None)
+
+_sessions: Dict[str, requests.Session] = {}
+_breakers: Dict[str, CircuitBreaker] = {}
+_sessions_lock = threading.Lock()
+_calls = threading.local()  # the _CallDeadline of the gateway call this thread is making
+
+
+class _CallDeadline:
+    """
+    Cut off a gateway call that is still running when its budget is spent.
+    
+    The socket timeouts only bound each connect and read, so a gateway that
+    stalls and then trickles its headers or body could outlast them many
+    times over. While the call runs, the connection it uses registers its
+    socket here; at the deadline a timer shuts that socket down, which
+    breaks off whatever read or write is blocked on it.
+    """
+    
+    def __init__(self, seconds: float):
+        self._lock = threading.Lock()
+        self._sock = None
+        self._done = False
+        self.expired = False
+        self._timer = threading.Timer(seconds, self._expire)
+        self._timer.daemon = True
+    
+    def __enter__(self) -> '_CallDeadline':
+        _calls.deadline = self
+        self._timer.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._timer.cancel()
+        with self._lock:
+            self._done = True
+        _calls.deadline = None
+    
+    def attach(self, sock):
+        """Register the socket the call is using (shut down at once if the deadline has passed)."""
+        with self._lock:
+            self._sock = sock
+            expired = self.expired
+        if expired:
+            self._shutdown(sock)
+    
+    def _expire(self):
+        with self._lock:
+            if self._done:
+                return
+            self.expired = True
+            sock = self._sock
+        if sock is not None:
+            self._shutdown(sock)
+    
+    @staticmethod
+    def _shutdown(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _DeadlineConnectionMixin:
+    """Hands the socket of each request to the current thread's _CallDeadline."""
+    
+    def connect(self):
+        super().connect()
+        self._attach_to_deadline()
+    
+    def request(self, *args, **kwargs):
+        self._attach_to_deadline()  # a kept-alive connection is already connected
+        return super().request(*args, **kwargs)
+    
+    def _attach_to_deadline(self):
+        deadline = getattr(_calls, 'deadline', None)
+        if deadline is not None and self.sock is not None:
+            deadline.attach(self.sock)
+
+
+class _DeadlineHTTPConnection(_DeadlineConnectionMixin, HTTPConnection):
+    pass
+
+
+class _DeadlineHTTPSConnection(_DeadlineConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _DeadlineHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _DeadlineHTTPConnection
+
+
+class _DeadlineHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _DeadlineHTTPSConnection
+
+
+class _GatewayAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections can be cut off by a _CallDeadline."""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _DeadlineHTTPConnectionPool,
+            'https': _DeadlineHTTPSConnectionPool
+        }
+
+
+def get_gateway_session(base_url: str) -> requests.Session:
+    """
+    Get the shared requests.Session for a gateway URL, creating it on first use.
+    
+    Every PaymentGateway pointed at the same URL shares one session, so its
+    connection pool (GATEWAY_POOL_SIZE connections) keeps TCP/TLS connections
+    alive across calls and threads instead of handshaking on every request.
+    """
+    session = _sessions.get(base_url)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = _GatewayAdapter(pool_connections=1, pool_maxsize=GATEWAY_POOL_SIZE, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[base_url] = session
+    return session
+
+@contextmanager
+def gateway_idempotency_key(key: Optional[str]):
+    """
+    Send key as the Idempotency-Key header of the charges and refunds made
+    in this block (on this thread), so the gateway carries out a repeated
+    request only once and answers it with the original result.
+    """
+    token = _idempotency_key.set(key)
+    try:
+        yield
+    finally:
+        _idempotency_key.reset(token)
+
+def get_gateway_breaker(base_url: str) -> CircuitBreaker:
+    """Get the circuit breaker guarding a gateway URL, creating it on first use."""
+    breaker = _breakers.get(base_url)
+    if breaker is None:
+        with _sessions_lock:
+            breaker = _breakers.get(base_url)
+            if breaker is None:
+                breaker = CircuitBreaker(name=base_url, **GATEWAY_BREAKER_SETTINGS)
+                _breakers[base_url] = breaker
+    return breaker
+
+def gateway_breaker_stats() -> Dict[str, Dict]:
+    """Breaker state and counters for every gateway URL called so far."""
+    with _sessions_lock:
+        breakers = dict(_breakers)
+    return {url: breaker.stats() for url, breaker in breakers.items()}
+
+def configure_gateway_client(base_url: Optional[str] = None, pool_size: Optional[int] = None,
+                             connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None,
+                             call_budget: Optional[float] = None, breaker_settings: Optional[Dict] = None):
+    """
+    Change HTTP client settings. Existing sessions are closed and breakers
+    reset so the new settings apply to every call.
+    """
+    global GATEWAY_URL, GATEWAY_POOL_SIZE, GATEWAY_CONNECT_TIMEOUT, GATEWAY_READ_TIMEOUT
+    global GATEWAY_CALL_BUDGET, GATEWAY_BREAKER_SETTINGS
+    if base_url is not None:
+        GATEWAY_URL = base_url or None  # '' switches back to the simulated gateway
+    if pool_size is not None:
+        if pool_size < 1:
+            raise ValueError('Pool size must be at least 1.')
+        GATEWAY_POOL_SIZE = pool_size
+    if connect_timeout is not None:
+        GATEWAY_CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        GATEWAY_READ_TIMEOUT = read_timeout
+    if call_budget is not None:
+        if call_budget <= 0:
+            raise ValueError('Call budget must be greater than 0.')
+        GATEWAY_CALL_BUDGET = call_budget
+    if breaker_settings is not None:
+        GATEWAY_BREAKER_SETTINGS = dict(breaker_settings)
+    close_gateway_sessions()
+    with _sessions_lock:
+        _breakers.clear()
+
+def close_gateway_sessions():
+    """Close all pooled gateway sessions (e.g. on shutdown or after reconfiguring)."""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
 
 class PaymentGateway:
     """
     Simulates an external payment gateway API.
     In production, this would connect to services like Stripe, PayPal, etc.
     
+    When a base URL is configured (argument or PAYMENT_GATEWAY_URL) the
+    calls become real HTTP requests (POST /charges, POST /refunds,
+    GET /charges/<id>) over a pooled session shared by every instance;
+    otherwise the responses are simulated in-process.
+    
+    HTTP calls go through the URL's circuit breaker: while it is open they
+    raise CircuitOpenError at once, and each call's timeouts are capped at
+    its budget (GATEWAY_CALL_BUDGET unless given). Charges and refunds made
+    inside gateway_idempotency_key() carry its key.
+    
     For testing purposes, you should MOCK this class to avoid:
     - Making actual API calls
     - Depending on external service availability
     - Incurring costs or rate limits
     """
     
-    def __init__(self, api_key: str = "test_key_12345"):
+    def __init__(self, api_key: str = "test_key_12345", base_url: Optional[str] = None,
+                 call_budget: Optional[float] = None):
         """
         Initialize payment gateway with API credentials.
         
         Args:
             api_key: API key for authentication (default is test key)
+            base_url: Gateway URL to call over HTTP (default: PAYMENT_GATEWAY_URL,
+                simulated when neither is set)
+            call_budget: Seconds each HTTP call may take (default: GATEWAY_CALL_BUDGET)
         """
         self.api_key = api_key
-        self.base_url = "https://api.payment-gateway.example.com"
+        self.call_budget = call_budget
+        self.http = bool(base_url or GATEWAY_URL)
+        self.base_url = (base_url or GATEWAY_URL or "https://api.payment-gateway.example.com").rstrip('/')
+    
+    def _request(self, method: str, path: str, payload: Optional[Dict] = None) -> Tuple[int, Dict]:
+        """
+        Send one request through the pooled session; returns (status code, JSON body).
+        
+        Raises CircuitOpenError without sending while the breaker is open.
+        Timeouts, connection errors and 5xx responses count as breaker
+        failures, and calls slower than its slow-call threshold as slow.
+        POST requests carry the current gateway_idempotency_key, if any.
+        
+        The whole call, from connecting to the last byte of the body, is held
+        to the budget (see _CallDeadline); one still running then raises
+        Timeout like a socket timeout does.
+        """
+        breaker = get_gateway_breaker(self.base_url)
+        budget = self.call_budget or GATEWAY_CALL_BUDGET
+        timeout = (min(GATEWAY_CONNECT_TIMEOUT, budget), min(GATEWAY_READ_TIMEOUT, budget))
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        idempotency_key = _idempotency_key.get()
+        if method == "POST" and idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        breaker.before_call()
+        started = time.monotonic()
+        deadline = _CallDeadline(budget)
+        try:
+            with deadline:
+                response = get_gateway_session(self.base_url).request(
+                    method,
+                    f"{self.base_url}{path}",
+                    headers=headers,
+                    json=payload,
+                    timeout=timeout,
+                    stream=True
+                )
+                response.content
+        except requests.RequestException as e:
+            breaker.record(time.monotonic() - started, failed=True)
+            if deadline.expired:
+                raise requests.Timeout(f"Payment gateway did not respond within {budget:g}s") from e
+            if isinstance(e, requests.Timeout):
+                raise requests.Timeout(f"Payment gateway did not respond within {timeout[1]:g}s") from e
+            raise
+        breaker.record(time.monotonic() - started, failed=response.status_code >= 500)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return response.status_code, body if isinstance(body, dict) else {}
+    
+    @staticmethod
+    def _error_message(body: Dict, status: int) -> str:
+        error = body.get("error")
+        if isinstance(error, dict):
+            error = error.get("message")
+        return error or body.get("message") or f"Gateway returned HTTP {status}"
     
     def process_payment(self, patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
         """
@@ -51,21 +342,20 @@ class PaymentGateway:
             gateway = PaymentGateway()
             success, txn_id, msg = gateway.process_payment("123456", 10.50, "Late fees")
         """
+        if self.http:
+            status, body = self._request("POST", "/charges", {
+                "customer_id": patron_id,
+                "amount": amount,
+                "currency": "usd",
+                "description": description
+            })
+            if status == 200 and body.get("id"):
+                return True, body["id"], body.get("message", "Payment processed successfully")
+            return False, "", self._error_message(body, status)
+        
         # Simulate API call delay
         time.sleep(0.5)
         
-        # In a real implementation, this would make an HTTP request:
-        # response = requests.post(
-        #     f"{self.base_url}/charges",
-        #     headers={"Authorization": f"Bearer {self.api_key}"},
-        #     json={
-        #         "customer_id": patron_id,
-        #         "amount": amount,
-        #         "currency": "usd",
-        #         "description": description
-        #     }
-        # )
-        
         # For this template, we simulate different scenarios based on amount
         # This allows testing without a real API
         
@@ -96,6 +386,12 @@ class PaymentGateway:
         Returns:
             tuple: (success: bool, message: str)
         """
+        if self.http:
+            status, body = self._request("POST", "/refunds", {"charge": transaction_id, "amount": amount})
+            if status == 200 and body.get("id"):
+                return True, body.get("message", f"Refund processed successfully. Refund ID: {body['id']}")
+            return False, self._error_message(body, status)
+        
         time.sleep(0.5)
         
         if not transaction_id or not transaction_id.startswith("txn_"):
@@ -107,7 +403,7 @@ class PaymentGateway:
         refund_id = f"refund_{transaction_id}_{int(time.time())}"
         return True, f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"
     
-    def verify_payment_status(self, transaction_id: str) -> Dict:
+    def verify_payment_status(self, transaction_id: str = "", idempotency_key: Optional[str] = None) -> Dict:
         """
         Check the status of a payment transaction.
         
@@ -116,13 +412,28 @@ class PaymentGateway:
         
         Args:
             transaction_id: Transaction ID to check
+            idempotency_key: Look the charge up by the Idempotency-Key it was
+                sent with instead (when its transaction ID never arrived)
             
         Returns:
             dict: Payment status information
         """
+        if self.http:
+            if idempotency_key:
+                path = f"/charges?idempotency_key={quote(idempotency_key, safe='')}"
+            else:
+                path = f"/charges/{quote(transaction_id or '', safe='')}"
+            status, body = self._request("GET", path)
+            if status == 404:
+                return {"status": "not_found", "message": self._error_message(body, status)}
+            if status != 200:
+                return {"status": "error", "message": self._error_message(body, status)}
+            return body
+        
         time.sleep(0.3)
         
-        if not transaction_id or not transaction_id.startswith("txn_"):
+        # The simulated gateway always answers, so it never has a charge known only by its key
+        if idempotency_key or not transaction_id or not transaction_id.startswith("txn_"):
             return {"status": "not_found", "message": "Transaction not found"}
         
         # Simulate status check
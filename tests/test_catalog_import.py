@@ -0,0 +1,102 @@
+import io
+import json
+import os
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from services.catalog_import import import_books, main
+from services.library_service import add_book_to_catalog, search_books_in_catalog
+
+
+@pytest.fixture
+def isolated_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "import_test.db"))
+    database.init_database()
+    yield database.DATABASE
+    database.close_pools()
+
+
+CSV_FEED = """title,author,isbn,total_copies
+Imported One,Vendor Author,7000000000001,2
+Imported Two,Vendor Author,7000000000002,1
+,Missing Title,7000000000003,1
+Short ISBN,Vendor Author,123,1
+Zero Copies,Vendor Author,7000000000004,0
+Already Here,Vendor Author,7000000000005,1
+Imported One Again,Vendor Author,7000000000001,1
+Imported Three,Vendor Author,7000000000006,abc
+"""
+
+
+def test_csv_import_applies_catalog_rules(isolated_db):
+    add_book_to_catalog("Already Here", "Someone", "7000000000005", 1)
+    batches = []
+
+    summary = import_books(io.StringIO(CSV_FEED), "csv", batch_size=2,
+                           progress=lambda s: batches.append(s["rows_read"]))
+
+    assert summary["rows_read"] == 8
+    assert summary["imported"] == 2
+    assert summary["rejected"] == 6
+    messages = {e["line"]: e["error"] for e in summary["errors"]}
+    assert messages[4] == "Title is required."
+    assert messages[5] == "ISBN must be exactly 13 digits."
+    assert messages[6] == "Total copies must be a positive integer."
+    assert messages[7] == "A book with this ISBN already exists."
+    assert messages[8] == "A book with this ISBN already exists."  # duplicate of an earlier batch
+    assert messages[9] == "Total copies must be a positive integer."
+    assert batches[-1] == 8 and len(batches) >= 2
+
+    book = database.get_book_by_isbn("7000000000001")
+    assert (book["title"], book["total_copies"], book["available_copies"]) == ("Imported One", 2, 2)
+    assert [b["isbn"] for b in search_books_in_catalog("imported tw", "title")] == ["7000000000002"]
+
+
+def test_jsonl_import_rejects_bad_lines_and_in_batch_duplicates(isolated_db):
+    lines = [
+        json.dumps({"title": "Json Book", "author": "A", "isbn": "7100000000001", "total_copies": 3}),
+        "{not json",
+        json.dumps({"title": "Json Dup", "author": "A", "isbn": "7100000000001", "total_copies": 1}),
+        json.dumps(["not", "an", "object"]),
+    ]
+
+    summary = import_books(io.StringIO("\n".join(lines) + "\n"), "jsonl")
+
+    assert (summary["imported"], summary["rejected"]) == (1, 3)
+    assert database.get_book_by_isbn("7100000000001")["title"] == "Json Book"
+
+
+def test_import_command(isolated_db, tmp_path, capsys):
+    feed = tmp_path / "feed.csv"
+    feed.write_text(CSV_FEED)
+
+    assert main([str(feed), "--database", isolated_db]) == 0
+
+    summary = json.loads(capsys.readouterr().out)
+    assert (summary["imported"], summary["rejected"]) == (3, 5)
+
+
+def test_import_api_accepts_uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "import_api.db"))
+    from app import create_app
+    client = create_app().test_client()
+    try:
+        response = client.post("/api/books/import",
+                               data={"file": (io.BytesIO(CSV_FEED.encode()), "feed.csv")},
+                               content_type="multipart/form-data")
+        assert response.status_code == 200
+        assert response.get_json()["imported"] == 3
+
+        raw = json.dumps({"title": "Raw Body", "author": "A", "isbn": "7200000000001", "total_copies": 1})
+        response = client.post("/api/books/import", data=raw, content_type="application/x-ndjson")
+        assert response.get_json()["imported"] == 1
+
+        assert client.post("/api/books/import", data="x", content_type="text/plain").status_code == 400
+    finally:
+        database.close_pools()
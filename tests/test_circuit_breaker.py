@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+from unittest.mock import patch
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+import requests
+
+import database
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from services.gateway_server import StandInGatewayServer
+from services.library_service import pay_late_fees
+from services.payment_service import PaymentGateway, configure_gateway_client, gateway_breaker_stats
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(window_size=4, minimum_calls=4, failure_rate_threshold=0.5, slow_call_seconds=1.0,
+                          slow_call_rate_threshold=0.75, open_seconds=10, half_open_calls=2, clock=clock)
+
+
+def test_opens_at_failure_rate_and_rejects(breaker):
+    for failed in (False, True, False):
+        breaker.before_call()
+        breaker.record(0.1, failed=failed)
+    assert breaker.state == CLOSED
+
+    breaker.before_call()
+    breaker.record(0.1, failed=True)
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpenError, match="retry in 10s"):
+        breaker.before_call()
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_opens_at_slow_call_rate(breaker):
+    for duration in (1.5, 2.0, 0.2, 1.0):
+        breaker.before_call()
+        breaker.record(duration)
+    assert breaker.state == OPEN
+    assert breaker.stats()["failures"] == 0
+
+
+def test_half_open_trials_close_or_reopen(breaker, clock):
+    for _ in range(4):
+        breaker.before_call()
+        breaker.record(0.1, failed=True)
+    clock.now = 10
+    assert breaker.state == HALF_OPEN
+
+    breaker.before_call()
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # only half_open_calls trials at a time
+    breaker.record(0.1)
+    breaker.record(2.0)  # a slow trial opens it again
+    assert breaker.state == OPEN
+
+    clock.now = 20
+    breaker.call(lambda: None)
+    breaker.call(lambda: None)
+    assert breaker.state == CLOSED
+
+
+@pytest.fixture
+def slow_server():
+    """A stand-in answering after 0.2s, with a breaker that treats 0.1s as slow."""
+    with StandInGatewayServer(latency=0.2) as server:
+        configure_gateway_client(base_url=server.url, breaker_settings={
+            "window_size": 3, "minimum_calls": 3, "slow_call_seconds": 0.1, "open_seconds": 60})
+        yield server
+        configure_gateway_client(base_url="", call_budget=5.0, breaker_settings={})
+
+
+def test_slow_gateway_opens_breaker_and_calls_fail_fast(slow_server):
+    gateway = PaymentGateway()
+    for _ in range(3):
+        assert gateway.process_payment("123456", 1.00)[0] is True
+
+    started = time.monotonic()
+    with pytest.raises(CircuitOpenError):
+        gateway.process_payment("123456", 1.00)
+    assert time.monotonic() - started < 0.1
+    assert slow_server.requests == 3
+
+    stats = gateway_breaker_stats()[slow_server.url]
+    assert stats["state"] == OPEN and stats["slow_calls"] == 3 and stats["rejected"] == 1
+
+
+def test_open_breaker_message_reaches_patron(slow_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "breaker_test.db"))
+    database.init_database()
+    for _ in range(3):
+        PaymentGateway().process_payment("123456", 1.00)
+
+    with patch("services.library_service.calculate_late_fee_for_book",
+               return_value={"fee_amount": 2.50, "days_overdue": 5, "status": "Overdue", "loan_id": 7}), \
+         patch("services.library_service.get_book_by_id", return_value={"id": 1, "title": "Test Book"}):
+        success, message, _ = pay_late_fees("123456", 1, PaymentGateway())
+    database.close_pools()
+
+    assert success is False
+    assert "Payment gateway is unavailable (circuit open" in message
+
+
+def test_call_budget_caps_wait(slow_server):
+    configure_gateway_client(call_budget=0.05)
+
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout, match="did not respond within 0.05s"):
+        PaymentGateway().process_payment("123456", 1.00)
+    assert time.monotonic() - started < 0.2
+    assert gateway_breaker_stats()[slow_server.url]["failures"] == 1
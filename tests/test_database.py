@@ -0,0 +1,405 @@
+import os
+import sqlite3
+import sys
+import threading
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Point the database module at a fresh file so pool tests start from zero."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "pool_test.db"))
+    database.init_database()
+    database.add_sample_data()
+    yield database.DATABASE
+    database.close_pools()
+
+
+# Connection pool testcases:
+def test_pool_reuses_connections(temp_db):
+    """Helpers should draw from the pool instead of opening a connection per call."""
+    for _ in range(20):
+        database.get_book_by_id(1)
+        database.get_patron_borrow_count("123456")
+
+    stats = database.get_pool_stats()
+    assert stats["checkouts"] >= 40
+    assert stats["connections_created"] == 1
+    assert stats["in_use"] == 0
+
+
+def test_pool_applies_pragmas(temp_db):
+    conn = database.get_db_connection()
+    try:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    finally:
+        conn.close()
+
+
+def test_pool_rolls_back_unfinished_transaction_on_release(temp_db):
+    conn = database.get_db_connection()
+    conn.execute(
+        "INSERT INTO books (title, author, isbn, total_copies, available_copies) VALUES (?, ?, ?, ?, ?)",
+        ("Uncommitted", "Author", "3000000000001", 1, 1),
+    )
+    conn.close()
+
+    assert database.get_book_by_isbn("3000000000001") is None
+
+
+def test_pool_counts_waits_when_exhausted(temp_db):
+    database.configure_pool(size=1)
+    try:
+        held = database.get_db_connection()
+        result = {}
+
+        def borrow_connection():
+            conn = database.get_db_connection()
+            result["ok"] = conn.execute("SELECT 1").fetchone()[0] == 1
+            conn.close()
+
+        worker = threading.Thread(target=borrow_connection)
+        worker.start()
+        worker.join(timeout=0.2)
+        assert worker.is_alive(), "second checkout should wait for the held connection"
+        held.close()
+        worker.join(timeout=5)
+
+        stats = database.get_pool_stats()
+        assert result["ok"] is True
+        assert stats["waits"] == 1
+        assert stats["wait_time"] > 0
+        assert stats["connections_created"] == 1
+    finally:
+        database.configure_pool(size=5)
+
+
+def test_pool_times_out_when_exhausted(temp_db):
+    database.configure_pool(size=1, timeout=0.05)
+    try:
+        held = database.get_db_connection()
+        with pytest.raises(database.sqlite3.OperationalError):
+            database.get_db_connection()
+        held.close()
+        assert database.get_pool_stats()["timeouts"] == 1
+    finally:
+        database.configure_pool(size=5, timeout=10.0)
+
+
+def test_failing_helpers_do_not_leak_connections(temp_db, monkeypatch):
+    database.configure_pool(size=2, timeout=0.5)
+    try:
+        def broken(*args, **kwargs):
+            raise database.sqlite3.OperationalError("disk I/O error")
+
+        with monkeypatch.context() as patched:
+            patched.setattr(database, "_fetch_records", broken)
+            for _ in range(5):
+                with pytest.raises(database.sqlite3.OperationalError):
+                    database.get_all_books()
+                with pytest.raises(database.sqlite3.OperationalError):
+                    database.get_patron_borrowed_books("123456")
+
+        assert database.get_pool_stats()["in_use"] == 0
+        assert len(database.get_all_books()) == 3
+    finally:
+        database.configure_pool(size=5, timeout=10.0)
+
+
+def test_unreleased_connection_returns_to_pool_when_dropped(temp_db):
+    conn = database.get_db_connection()
+    conn.execute("SELECT 1")
+    assert database.get_pool_stats()["in_use"] == 1
+
+    del conn
+
+    assert database.get_pool_stats()["in_use"] == 0
+
+
+def test_pool_replaces_unhealthy_connection(temp_db):
+    database.configure_pool(health_check_interval=0)
+    try:
+        conn = database.get_db_connection()
+        raw = conn._conn
+        conn.close()
+        raw.close()  # simulate a connection that died while idle
+
+        assert database.get_book_by_id(1) is not None
+        stats = database.get_pool_stats()
+        assert stats["health_check_failures"] == 1
+        assert stats["connections_discarded"] == 1
+    finally:
+        database.configure_pool(health_check_interval=30.0)
+
+
+# Search index testcases:
+def test_search_index_backfills_existing_books(tmp_path, monkeypatch):
+    """Databases created before the search columns and index get them populated on startup."""
+    path = str(tmp_path / "legacy.db")
+    monkeypatch.setattr(database, "DATABASE", path)
+    legacy = database.sqlite3.connect(path)
+    legacy.execute("""
+        CREATE TABLE books (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL,
+                            author TEXT NOT NULL, isbn TEXT UNIQUE NOT NULL,
+                            total_copies INTEGER NOT NULL, available_copies INTEGER NOT NULL)
+    """)
+    legacy.execute("INSERT INTO books (title, author, isbn, total_copies, available_copies) "
+                   "VALUES ('Legacy Title', 'Old Author', '5000000000001', 1, 1)")
+    legacy.commit()
+    legacy.close()
+    try:
+        database.init_database()
+        assert [b["isbn"] for b in database.search_books("title", "legacy")] == ["5000000000001"]
+        assert [b["isbn"] for b in database.search_books_by_prefix("author", "OLD")] == ["5000000000001"]
+        conn = database.get_db_connection()
+        row = conn.execute("SELECT title_norm, author_norm FROM books").fetchone()
+        conn.close()
+        assert tuple(row) == ("legacy title", "old author")
+    finally:
+        database.close_pools()
+
+
+def test_edited_book_is_found_under_its_new_name(temp_db):
+    conn = database.get_db_connection()
+    conn.execute("UPDATE books SET title = 'Brave New World', author = 'Aldous Huxley' WHERE isbn = '9780451524935'")
+    conn.commit()
+    conn.close()
+
+    assert [b.isbn for b in database.search_books_by_prefix("title", "brave")] == ["9780451524935"]
+    assert [b.isbn for b in database.search_books_by_prefix("author", "aldous")] == ["9780451524935"]
+    assert database.search_books_by_prefix("title", "1984") == []
+
+
+def test_inserted_book_is_written_once(temp_db):
+    """The insert carries the casefolded columns, so no trigger rewrites the row (one catalog bump per book)."""
+    conn = database.get_db_connection()
+    before = conn.execute("SELECT version FROM catalog_state").fetchone()[0]
+    conn.close()
+
+    assert database.insert_book("Straße Ölberg", "Émile Zola", "5000000000002", 1, 1)
+    database.insert_books_bulk([("Nana", "ÉMILE ZOLA", "5000000000003", 1)])
+
+    conn = database.get_db_connection()
+    after = conn.execute("SELECT version FROM catalog_state").fetchone()[0]
+    rows = conn.execute("SELECT title_norm, author_norm FROM books WHERE isbn LIKE '5%' ORDER BY isbn").fetchall()
+    conn.execute("INSERT INTO books (title, author, isbn, total_copies, available_copies) "
+                 "VALUES ('By Hand', 'No Norms', '5000000000004', 1, 1)")
+    by_hand = conn.execute("SELECT title_norm, author_norm FROM books WHERE isbn = '5000000000004'").fetchone()
+    conn.rollback()
+    conn.close()
+    assert after - before == 2
+    assert [tuple(row) for row in rows] == [("strasse ölberg", "émile zola"), ("nana", "émile zola")]
+    assert tuple(by_hand) == ("by hand", "no norms")
+
+
+# Migration testcases:
+def test_migrations_run_once_and_record_versions(temp_db):
+    latest = database.MIGRATIONS[-1][0]
+    assert database.get_schema_version() == latest
+
+    assert database.migrate() == latest  # running again is a no-op
+    conn = database.get_db_connection()
+    versions = [row["version"] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    conn.close()
+    assert versions == [version for version, _, _ in database.MIGRATIONS]
+
+
+def test_migrations_can_stop_at_target_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "partial.db"))
+    try:
+        assert database.migrate(target_version=1) == 1
+        assert database.migrate() == database.MIGRATIONS[-1][0]
+    finally:
+        database.close_pools()
+
+
+def test_epoch_migration_converts_iso_dates(tmp_path, monkeypatch):
+    from datetime import datetime, timedelta
+
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "iso.db"))
+    try:
+        database.migrate(target_version=9)
+        borrowed = datetime(2024, 2, 28, 21, 15, 30, 123456)
+        conn = database.get_db_connection()
+        conn.execute("INSERT INTO books (title, author, isbn, total_copies, available_copies) "
+                     "VALUES ('Old Book', 'Author', '9000000000001', 1, 0)")
+        conn.execute("INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date) "
+                     "VALUES ('111111', 1, ?, ?, NULL), ('111111', 1, ?, ?, ?)",
+                     (borrowed.isoformat(), (borrowed + timedelta(days=14)).isoformat(),
+                      "2023-01-01T09:00:00", "2023-01-15T09:00:00", "2023-01-20T17:30:00"))
+        conn.commit()
+        indexes_before = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'borrow_records'")}
+        conn.close()
+
+        database.migrate()
+
+        conn = database.get_db_connection()
+        types = conn.execute("SELECT typeof(borrow_date), typeof(due_date), typeof(return_date) "
+                             "FROM borrow_records ORDER BY id").fetchall()
+        indexes_after = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'borrow_records'")}
+        conn.close()
+        assert [tuple(row) for row in types] == [("integer", "integer", "null"), ("integer", "integer", "integer")]
+        assert indexes_after == indexes_before
+
+        loan = database.get_patron_borrowed_books("111111")[0]
+        assert loan["borrow_date"] == borrowed.replace(microsecond=0)
+        assert loan["due_date"] == datetime(2024, 3, 13, 21, 15, 30)
+        history = database.get_patron_borrowing_history("111111")
+        assert history[1]["return_date"] == datetime(2023, 1, 20, 17, 30)
+    finally:
+        database.close_pools()
+
+
+def test_epoch_conversion_round_trips():
+    from datetime import datetime
+
+    for value in (datetime(1970, 1, 1), datetime(2024, 3, 10, 2, 30), datetime(1969, 7, 20, 20, 17, 40)):
+        assert database.from_epoch(database.to_epoch(value)) == value
+    assert database.to_epoch(datetime(1970, 1, 2, 0, 0, 0, 999999)) == 86400
+    assert database.from_epoch(None) is None
+
+
+def test_loans_due_between(temp_db):
+    from datetime import datetime, timedelta
+
+    now = datetime.now()
+    for i, days in enumerate((1, 2, 5, -1)):
+        due = now + timedelta(days=days)
+        database.insert_borrow_record(f"80000{i}", 1, due - timedelta(days=14), due)
+    database.close_open_loan("800001", 1, now)
+
+    due_soon = database.get_loans_due_between(now, now + timedelta(days=3))
+
+    assert [loan["patron_id"] for loan in due_soon] == ["800000"]
+    assert isinstance(due_soon[0]["due_date"], datetime)
+
+
+def test_queries_use_indexes(temp_db):
+    """
+    Run every database.py helper with SQL tracing on, then check that
+    EXPLAIN QUERY PLAN for each traced statement seeks through an index
+    rather than scanning a whole table.
+    """
+    from datetime import datetime, timedelta
+
+    database.configure_pool(size=1)
+    try:
+        statements = []
+        conn = database.get_db_connection()
+        conn.set_trace_callback(statements.append)
+        conn.close()
+
+        now = datetime.now()
+        book_id = database.get_book_by_isbn("9780743273565")["id"]
+        database.get_book_by_id(book_id)
+        database.insert_borrow_record("654321", book_id, now, now + timedelta(days=14))
+        database.checkout_book_copy(book_id)
+        database.get_patron_borrow_count("654321")
+        database.get_patron_borrowed_books("654321")
+        database.get_patron_borrowing_history("654321", limit=10)
+        conn = database.get_db_connection()
+        list(database.iter_borrow_records(patron_id="654321", conn=conn))
+        list(database.iter_borrow_records(start=now - timedelta(days=1), end=now + timedelta(days=1), conn=conn))
+        conn.close()
+        list(database.iter_overdue_loan_chunks(now + timedelta(days=30)))
+        database.get_loans_due_between(now, now + timedelta(days=3))
+        list(database.iter_overdue_loan_chunks(now + timedelta(days=30), patron_range=("600000", "700000")))
+        database.close_open_loan("654321", book_id, now)
+        database.get_payment_allocations("txn_654321_1")
+        database.update_borrow_record_return_date("123456", 3, now)
+        database.update_book_availability(book_id, 1)
+        database.search_books("title", "gatsby")
+        database.search_books_by_prefix("author", "harper")
+
+        conn = database.get_db_connection()
+        conn.set_trace_callback(None)
+        checked = 0
+        for sql in statements:
+            if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            if "sqlite_master" in sql or "books_fts_" in sql:
+                continue  # catalog lookups and FTS5's own shadow-table bookkeeping
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            full_scans = [step for step in plan if step.startswith("SCAN") and "VIRTUAL TABLE" not in step]
+            assert not full_scans, f"{sql.strip()} -> {plan}"
+            checked += 1
+        conn.close()
+        assert checked >= 10
+    finally:
+        database.configure_pool(size=5)
+
+
+# Borrow record export testcases:
+def test_iter_borrow_records_streams_in_batches(temp_db):
+    from datetime import datetime, timedelta
+
+    base = datetime(2024, 1, 1)
+    for i in range(25):
+        database.insert_borrow_record(f"{700000 + i % 3}", 1, base + timedelta(days=i),
+                                      base + timedelta(days=i + 14))
+
+    records = database.iter_borrow_records(batch_size=4)
+    first = next(records)
+    assert set(first) == set(database.EXPORT_COLUMNS)
+    assert database.get_pool_stats()["in_use"] == 0  # streams from its own connection, not a pool slot
+    assert len(list(records)) >= 24
+
+    patron = list(database.iter_borrow_records(patron_id="700001", batch_size=2))
+    assert len(patron) == 8
+    assert [r["borrow_date"] for r in patron] == sorted(r["borrow_date"] for r in patron)
+
+    window = list(database.iter_borrow_records(start=base + timedelta(days=5), end=base + timedelta(days=10)))
+    assert [database.from_epoch(r["borrow_date"]).strftime("%Y-%m-%d") for r in window] == [f"2024-01-{d:02d}" for d in range(6, 11)]
+
+
+def test_export_connection_is_closed_when_done_or_abandoned(temp_db, monkeypatch):
+    opened = []
+    connect_read_only = database.connect_read_only
+    monkeypatch.setattr(database, "connect_read_only", lambda: opened.append(connect_read_only()) or opened[-1])
+
+    list(database.iter_borrow_records())
+    records = database.iter_borrow_records(batch_size=1)
+    next(records)
+    records.close()
+
+    assert len(opened) == 2
+    for conn in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+    assert database.get_pool_stats()["in_use"] == 0
+
+
+# Record testcases:
+def test_helpers_return_slotted_records(temp_db):
+    from datetime import datetime, timedelta
+
+    book = database.get_book_by_isbn("9780743273565")
+    assert isinstance(book, database.Book)
+    assert not hasattr(book, "__dict__")
+    assert book["title"] == book.title == "The Great Gatsby"
+    assert book.get("missing") is None and "isbn" in book
+    assert book.to_json() == dict(book)
+
+    borrowed = datetime(2024, 5, 1, 10, 30)
+    database.insert_borrow_record("800100", book.id, borrowed, borrowed + timedelta(days=14))
+    loan = database.get_patron_borrowed_books("800100")[0]
+    assert isinstance(loan, database.Loan)
+    assert loan["due_date"] == datetime(2024, 5, 15, 10, 30)
+    assert loan.is_overdue and not loan.is_returned
+    assert loan.to_json() == {
+        "loan_id": loan.loan_id, "patron_id": "800100", "book_id": book.id,
+        "title": "The Great Gatsby", "author": "F. Scott Fitzgerald",
+        "borrow_date": "2024-05-01T10:30:00", "due_date": "2024-05-15T10:30:00",
+        "return_date": None, "is_returned": False, "is_overdue": True,
+    }
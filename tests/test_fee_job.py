@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from services import fee_job
+from services.overdue_sweep import sweep_overdue_fees
+
+
+@pytest.fixture
+def job_db(tmp_path, monkeypatch):
+    """A database with 40 patrons holding open loans between 5 days early and 30 days late."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "fee_job_test.db"))
+    database.init_database()
+    database.insert_book("Job Book", "Author", "8100000000001", 1000, 1000)
+    now = datetime.now()
+    conn = database.get_db_connection()
+    for i in range(200):
+        due = now - timedelta(days=i % 36 - 5, hours=12)
+        conn.execute("INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) VALUES (?, 1, ?, ?)",
+                     (f"{910000 + i % 40}", database.to_epoch(due - timedelta(days=14)), database.to_epoch(due)))
+    conn.commit()
+    conn.close()
+    yield now
+    database.close_pools()
+
+
+def test_shard_bounds_split_open_loans_evenly(job_db):
+    bounds = database.get_patron_shard_bounds(4)
+    assert bounds == sorted(bounds) and len(bounds) == 3
+    assert database.get_patron_shard_bounds(1) == []
+
+
+def test_job_matches_single_process_sweep(job_db):
+    expected = sweep_overdue_fees(as_of=job_db, engine="python")
+
+    summary = fee_job.run_fee_job(workers=2, shards=5, chunk_size=7, as_of=job_db, engine="python")
+
+    assert summary["shards"] == 5
+    assert not summary["resumed"]
+    for key in ("overdue_loans", "patrons", "total_fees"):
+        assert summary[key] == expected[key]
+    assert database.get_overdue_fee_report(summary["run_id"]) == \
+        database.get_overdue_fee_report(expected["run_id"])
+
+
+def test_job_subtracts_ledger_payments_like_the_sweep(job_db):
+    unpaid = sweep_overdue_fees(as_of=job_db, engine="python")
+    for loan_id in range(1, 200, 3):
+        database.record_payment(f"txn_job_{loan_id}", f"{910000 + (loan_id - 1) % 40}", loan_id, 1, loan_id % 9)
+    database.record_refund("txn_job_7", 3.00)
+    expected = sweep_overdue_fees(as_of=job_db, engine="python")
+
+    summary = fee_job.run_fee_job(workers=2, shards=5, chunk_size=7, as_of=job_db, engine="python")
+
+    for key in ("overdue_loans", "patrons", "total_fees"):
+        assert summary[key] == expected[key]
+    assert database.get_overdue_fee_report(summary["run_id"]) == \
+        database.get_overdue_fee_report(expected["run_id"])
+    assert summary["total_fees"] < unpaid["total_fees"]
+    assert database.get_paid_amounts([7]) == {7: 4.0}
+
+
+def test_job_resumes_after_crash(job_db, monkeypatch):
+    expected = sweep_overdue_fees(as_of=job_db, engine="python")
+    real_save = fee_job.save_fee_job_shard
+    saved = []
+
+    def save_then_crash(run_id, shard, totals):
+        if saved:
+            raise RuntimeError("worker host went away")
+        real_save(run_id, shard, totals)
+        saved.append(shard)
+
+    monkeypatch.setattr(fee_job, "save_fee_job_shard", save_then_crash)
+    with pytest.raises(RuntimeError):
+        fee_job.run_fee_job(workers=1, shards=4, as_of=job_db, engine="python")
+    monkeypatch.setattr(fee_job, "save_fee_job_shard", real_save)
+
+    summary = fee_job.run_fee_job(workers=2, engine="python")
+
+    assert summary["resumed"]
+    assert summary["shards"] == 3
+    assert summary["as_of"] == job_db.isoformat()
+    assert summary["total_fees"] == expected["total_fees"]
+    assert fee_job.run_fee_job(workers=1, as_of=job_db, engine="python")["resumed"] is False
+
+
+def test_worker_connection_is_read_only(job_db):
+    conn = database.connect_read_only()
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM borrow_records").fetchone()[0] == 200
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM borrow_records")
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+import requests
+
+from services import payment_service
+from services.gateway_server import StandInGatewayServer
+from services.payment_queue import PaymentQueue, SUCCEEDED
+from services.payment_service import PaymentGateway, configure_gateway_client, gateway_idempotency_key
+
+
+@pytest.fixture
+def server():
+    """A stand-in gateway on a free local port, with PaymentGateway pointed at it."""
+    pool_size, call_budget = payment_service.GATEWAY_POOL_SIZE, payment_service.GATEWAY_CALL_BUDGET
+    with StandInGatewayServer() as server:
+        configure_gateway_client(base_url=server.url, pool_size=2)
+        yield server
+        configure_gateway_client(base_url="", pool_size=pool_size, read_timeout=10.0, call_budget=call_budget)
+
+
+def test_charge_status_and_refund_round_trip(server):
+    gateway = PaymentGateway()
+
+    success, transaction_id, message = gateway.process_payment("123456", 6.50, "Late fees")
+    assert success is True and transaction_id.startswith("txn_123456_")
+    assert message == "Payment of $6.50 processed successfully"
+    assert gateway.verify_payment_status(transaction_id)["status"] == "completed"
+
+    success, message = gateway.refund_payment(transaction_id, 6.50)
+    assert success is True and "Refund ID: refund_" in message
+    assert gateway.verify_payment_status(transaction_id)["status"] == "refunded"
+    assert gateway.verify_payment_status("txn_missing")["status"] == "not_found"
+
+
+def test_gateway_errors_map_to_failures(server):
+    gateway = PaymentGateway()
+
+    assert gateway.process_payment("123456", 1500.00) == (False, "", "Payment declined: amount exceeds limit")
+    assert gateway.process_payment("12345", 5.00) == (False, "", "Invalid patron ID format")
+    assert gateway.refund_payment("txn_unknown", 5.00) == (False, "Invalid transaction ID")
+
+
+def test_repeated_idempotency_key_is_carried_out_once(server):
+    gateway = PaymentGateway()
+
+    with gateway_idempotency_key("charge-key-1"):
+        first = gateway.process_payment("123456", 6.50, "Late fees")
+        assert gateway.process_payment("123456", 6.50, "Late fees") == first
+    with gateway_idempotency_key("refund-key-1"):
+        assert gateway.refund_payment(first[1], 2.00) == gateway.refund_payment(first[1], 2.00)
+
+    assert len(server.charges) == 1 and len(server.refunds) == 1
+    assert gateway.verify_payment_status(idempotency_key="charge-key-1")["transaction_id"] == first[1]
+    assert gateway.verify_payment_status(idempotency_key="unknown-key")["status"] == "not_found"
+
+
+def test_calls_reuse_pooled_connection(server):
+    for _ in range(5):
+        assert PaymentGateway().process_payment("123456", 1.00)[0] is True
+
+    assert server.requests == 5
+    assert server.connections == 1
+
+
+def test_read_timeout_is_enforced(server):
+    server.latency = 0.5
+    configure_gateway_client(read_timeout=0.1)
+
+    with pytest.raises(requests.Timeout):
+        PaymentGateway().process_payment("123456", 1.00)
+
+
+def test_trickled_response_is_cut_off_at_call_budget(server):
+    server.trickle = 0.05  # about 10s for a charge's response, each byte well inside the read timeout
+    configure_gateway_client(call_budget=0.3)
+
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout, match="within 0.3s"):
+        PaymentGateway().process_payment("123456", 1.00)
+    assert time.monotonic() - started < 1.0
+    assert payment_service.gateway_breaker_stats()[server.url]["failures"] == 1
+
+    server.trickle = 0.0
+    assert PaymentGateway().process_payment("123456", 2.00)[0] is True
+
+
+def test_stalled_headers_are_cut_off_at_call_budget(server):
+    # The stall and every gap between header bytes each fit inside the read timeout
+    server.latency, server.trickle = 0.25, 0.02
+    configure_gateway_client(read_timeout=0.28, call_budget=0.3)
+
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout, match="within 0.3s"):
+        PaymentGateway().verify_payment_status("txn_missing")
+    assert time.monotonic() - started < 0.6
+
+    server.latency, server.trickle = 0.0, 0.0
+    assert PaymentGateway().verify_payment_status("txn_missing")["status"] == "not_found"
+
+
+def test_payment_queue_charges_stand_in(server):
+    queue = PaymentQueue(workers=2, gateway_factory=PaymentGateway)
+    try:
+        handles = [queue.submit("123456", amount, "Late fees") for amount in (1.50, 2.00, 3.50)]
+        jobs = [queue.wait(handle, timeout=5) for handle in handles]
+    finally:
+        queue.shutdown()
+
+    assert [job["status"] for job in jobs] == [SUCCEEDED] * 3
+    assert sorted(charge["amount"] for charge in server.charges.values()) == [1.50, 2.00, 3.50]
+    assert server.connections <= 2
+
+
+def test_unconfigured_gateway_stays_simulated():
+    assert payment_service.GATEWAY_URL is None
+    assert PaymentGateway().http is False
@@ -0,0 +1,234 @@
+import os
+import sys
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+import requests
+
+import database
+from services import idempotency
+from services.gateway_server import StandInGatewayServer
+from services.idempotency import idempotency_store, IdempotencyStore, CLAIMED, IN_PROGRESS, REPLAYED
+from services.library_service import pay_late_fees, pay_all_late_fees, refund_late_fee_payment
+from services.payment_queue import PaymentQueue
+from services.payment_service import PaymentGateway, configure_gateway_client
+
+
+@pytest.fixture(autouse=True)
+def payments_db(tmp_path, monkeypatch, mocker):
+    """A fresh database and a patron owing $6.50 on book 1."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "idempotency_test.db"))
+    database.init_database()
+    mocker.patch("services.library_service.calculate_late_fee_for_book",
+                 return_value={"fee_amount": 6.50, "days_overdue": 10, "status": "Overdue", "loan_id": 41})
+    mocker.patch("services.library_service.get_book_by_id", return_value={"id": 1, "title": "Test Book"})
+    yield
+    database.close_pools()
+
+
+@pytest.fixture
+def gateway():
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (True, "txn_123456_1", "Payment of $6.50 processed successfully")
+    gateway.refund_payment.return_value = (True, "Refund of $6.50 processed successfully")
+    return gateway
+
+
+def test_retry_with_same_key_replays_result(gateway):
+    first = pay_late_fees("123456", 1, gateway, idempotency_key="client-key-1")
+    retry = pay_late_fees("123456", 1, gateway, idempotency_key="client-key-1")
+
+    assert first == retry == (True, "Payment successful! Payment of $6.50 processed successfully", "txn_123456_1")
+    gateway.process_payment.assert_called_once()
+
+    pay_late_fees("123456", 1, gateway, idempotency_key="client-key-2")
+    assert gateway.process_payment.call_count == 2
+
+
+def test_derived_key_replays_from_table_after_cache_loss(gateway):
+    pay_late_fees("123456", 1, gateway)
+    idempotency_store.clear()
+
+    assert pay_late_fees("123456", 1, gateway)[2] == "txn_123456_1"
+    gateway.process_payment.assert_called_once()
+    assert database.get_idempotency_record(
+        idempotency.derive_key("pay_late_fees", "123456", 1, 41, 6.5, 0.0, 0))["status"] == "completed"
+
+
+def test_declined_payment_can_be_retried(gateway):
+    gateway.process_payment.return_value = (False, None, "Insufficient funds")
+    assert pay_late_fees("123456", 1, gateway, idempotency_key="client-key-3")[0] is False
+
+    gateway.process_payment.return_value = (True, "txn_123456_2", "Payment processed")
+    assert pay_late_fees("123456", 1, gateway, idempotency_key="client-key-3")[2] == "txn_123456_2"
+    assert gateway.process_payment.call_count == 2
+
+
+def test_request_in_flight_is_not_sent_twice(gateway):
+    assert idempotency_store.begin("client-key-4", "pay_late_fees") == (CLAIMED, None)
+
+    success, message, _ = pay_late_fees("123456", 1, gateway, idempotency_key="client-key-4")
+
+    assert success is False and "already in progress" in message
+    gateway.process_payment.assert_not_called()
+
+
+def test_stale_pending_key_is_reclaimed():
+    store = IdempotencyStore(pending_timeout=timedelta(seconds=-1))
+    assert store.begin("client-key-5", "pay_late_fees")[0] == CLAIMED
+    assert store.begin("client-key-5", "pay_late_fees")[0] == CLAIMED
+    assert IdempotencyStore().begin("client-key-5", "pay_late_fees")[0] == IN_PROGRESS
+
+
+def test_repeated_refund_under_same_key_is_not_resent(gateway):
+    assert refund_late_fee_payment("txn_123456_1", 6.50, gateway, idempotency_key="refund-key-1") == \
+        (True, "Refund of $6.50 processed successfully")
+    assert refund_late_fee_payment("txn_123456_1", 6.50, gateway, idempotency_key="refund-key-1")[0] is True
+    gateway.refund_payment.assert_called_once()
+
+
+def test_partial_refunds_of_same_amount_are_each_made(gateway):
+    for loan_id, amount in ((41, 6.50), (42, 6.50), (43, 6.50)):
+        database.record_payment("txn_123456_1", "123456", loan_id, 1, amount)
+
+    assert refund_late_fee_payment("txn_123456_1", 2.00, gateway)[0] is True
+    assert refund_late_fee_payment("txn_123456_1", 2.00, gateway)[0] is True
+    assert gateway.refund_payment.call_count == 2
+
+    assert refund_late_fee_payment("txn_123456_1", 15.50, gateway)[0] is True  # a pay-all charge of $19.50
+    success, message = refund_late_fee_payment("txn_123456_1", 0.50, gateway)
+    assert success is False and "$0.00 left to refund" in message
+    assert gateway.refund_payment.call_count == 3
+
+
+def test_unanswered_refund_is_sent_again_under_same_key(gateway):
+    database.record_payment("txn_123456_1", "123456", 41, 1, 6.50)
+    gateway.refund_payment.side_effect = [requests.Timeout("read timed out"), (True, "Refund processed")]
+    key = idempotency.derive_key("refund_late_fee_payment", "txn_123456_1", 2.0, 0)
+
+    assert "outcome unknown" in refund_late_fee_payment("txn_123456_1", 2.00, gateway)[1]
+    assert database.get_idempotency_record(key)["status"] == "unknown"
+    assert refund_late_fee_payment("txn_123456_1", 2.00, gateway) == (True, "Refund processed")
+    assert database.get_idempotency_record(key)["status"] == "completed"
+    assert database.get_paid_amounts([41]) == {41: 4.50}
+
+
+def test_queued_payment_records_key_when_it_succeeds(gateway, mocker):
+    queue = PaymentQueue(workers=1, gateway_factory=lambda: gateway)
+    mocker.patch("services.library_service.payment_queue", queue)
+    try:
+        _, _, handle = pay_late_fees("123456", 1, enqueue=True, idempotency_key="client-key-6")
+        queue.wait(handle, timeout=5)
+        replay = pay_late_fees("123456", 1, enqueue=True, idempotency_key="client-key-6")
+    finally:
+        queue.shutdown()
+
+    assert replay[2] == "txn_123456_1"
+    gateway.process_payment.assert_called_once()
+
+
+def test_fee_owed_again_after_refund_gets_a_new_derived_key(gateway):
+    pay_late_fees("123456", 1, gateway)
+    refund_late_fee_payment("txn_123456_1", 6.50, gateway)
+    gateway.process_payment.return_value = (True, "txn_123456_2", "Payment processed")
+
+    assert pay_late_fees("123456", 1, gateway)[2] == "txn_123456_2"
+    assert gateway.process_payment.call_count == 2
+
+
+def test_derived_refund_key_expires():
+    store = IdempotencyStore()
+    assert store.begin("refund-key", "refund_late_fee_payment")[0] == CLAIMED
+    store.complete("refund-key", [True, "Refunded"])
+
+    assert store.begin("refund-key", "refund_late_fee_payment", ttl=timedelta(minutes=15))[0] == REPLAYED
+    assert store.begin("refund-key", "refund_late_fee_payment", ttl=timedelta(seconds=-1))[0] == CLAIMED
+
+
+def test_unanswered_charge_is_resolved_before_charging_again(gateway):
+    gateway.process_payment.side_effect = requests.Timeout("read timed out")
+    success, message, _ = pay_late_fees("123456", 1, gateway, idempotency_key="client-key-7")
+    assert success is False and "outcome unknown" in message
+    assert database.get_idempotency_record("client-key-7")["status"] == "unknown"
+
+    gateway.verify_payment_status.return_value = {"status": "error", "message": "Gateway returned HTTP 503"}
+    assert "outcome unknown" in pay_late_fees("123456", 1, gateway, idempotency_key="client-key-7")[1]
+
+    gateway.verify_payment_status.return_value = {"transaction_id": "txn_123456_7", "status": "completed",
+                                                  "amount": 6.50}
+    assert pay_late_fees("123456", 1, gateway, idempotency_key="client-key-7")[2] == "txn_123456_7"
+    gateway.verify_payment_status.assert_called_with(idempotency_key="client-key-7")
+    gateway.process_payment.assert_called_once()
+    assert database.get_paid_amounts([41]) == {41: 6.50}
+
+
+def test_unanswered_charge_never_made_is_charged(gateway):
+    gateway.process_payment.side_effect = [requests.ConnectionError("connection reset"),
+                                           (True, "txn_123456_8", "Payment processed")]
+    gateway.verify_payment_status.return_value = {"status": "not_found", "message": "Transaction not found"}
+
+    assert pay_late_fees("123456", 1, gateway, idempotency_key="client-key-8")[0] is False
+    assert pay_late_fees("123456", 1, gateway, idempotency_key="client-key-8")[2] == "txn_123456_8"
+    assert gateway.process_payment.call_count == 2
+
+
+@pytest.fixture
+def two_overdue_loans(mocker):
+    """Loans 51 (book 1, $1.50 owed) and 52 (book 2, $6.50 owed) for patron 123456."""
+    now = datetime.now()
+    loans = [database.Loan(loan_id, "123456", book_id, f"Book {book_id}", "Author",
+                           database.to_epoch(now - timedelta(days=days + 14, hours=12)),
+                           database.to_epoch(now - timedelta(days=days, hours=12)))
+             for loan_id, book_id, days in ((51, 1, 3), (52, 2, 10))]
+    mocker.patch("services.library_service.get_patron_borrowed_books", return_value=loans)
+
+
+def test_pay_all_retry_with_same_key_replays_result(gateway, two_overdue_loans):
+    gateway.process_payment.return_value = (True, "txn_123456_3", "Payment of $8.00 processed successfully")
+
+    first = pay_all_late_fees("123456", gateway, idempotency_key="client-key-10")
+    retry = pay_all_late_fees("123456", gateway, idempotency_key="client-key-10")
+
+    assert first[:3] == retry[:3] == (True, "Payment successful! Payment of $8.00 processed successfully",
+                                      "txn_123456_3")
+    assert retry[3] == first[3]
+    gateway.process_payment.assert_called_once()
+    assert database.get_paid_amounts([51, 52]) == {51: 1.50, 52: 6.50}
+
+
+def test_unanswered_pay_all_is_resolved_under_its_derived_key(gateway, two_overdue_loans):
+    gateway.process_payment.side_effect = requests.Timeout("read timed out")
+    success, message, transaction_id, allocations = pay_all_late_fees("123456", gateway)
+    assert success is False and transaction_id is None and "outcome unknown" in message
+    assert [allocation["amount"] for allocation in allocations] == [1.50, 6.50]
+    key = idempotency.derive_key("pay_all_late_fees", "123456", [(51, 1.5, 0.0, 0), (52, 6.5, 0.0, 0)])
+    assert database.get_idempotency_record(key)["status"] == "unknown"
+
+    gateway.verify_payment_status.return_value = {"transaction_id": "txn_123456_4", "status": "completed",
+                                                  "amount": 8.00}
+    assert pay_all_late_fees("123456", gateway)[2] == "txn_123456_4"
+    gateway.verify_payment_status.assert_called_with(idempotency_key=key)
+    gateway.process_payment.assert_called_once()
+    assert database.get_payment_allocations("txn_123456_4")[1]["amount"] == 6.50
+    assert pay_all_late_fees("123456", gateway)[1] == "No late fees to pay."
+
+
+def test_timed_out_charge_is_not_charged_twice_by_stand_in():
+    with StandInGatewayServer(latency=0.3) as server:
+        configure_gateway_client(base_url=server.url, call_budget=0.1)
+        try:
+            first = pay_late_fees("123456", 1, idempotency_key="client-key-9")
+            server.latency = 0.0
+            retry = pay_late_fees("123456", 1, idempotency_key="client-key-9")
+        finally:
+            configure_gateway_client(base_url="", call_budget=5.0)
+
+    assert first[0] is False and "outcome unknown" in first[1]
+    assert retry[0] is True
+    assert list(server.charges) == [retry[2]]
+    assert server.charges[retry[2]]["idempotency_key"] == "client-key-9"
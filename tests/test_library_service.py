@@ -1,5 +1,7 @@
 import os
 import sys
+import threading
+import time
 from datetime import datetime, timedelta
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -10,6 +12,7 @@ from services.library_service import (
     add_book_to_catalog,
     borrow_book_by_patron,
     return_book_by_patron,
+    process_circulation_batch,
     calculate_late_fee_for_book,
     search_books_in_catalog,
     get_patron_status_report,
@@ -18,9 +21,21 @@ from database import (
     get_all_books,
 )
 
+import pytest
+
+import database
 import services.library_service as ls
 
 
+@pytest.fixture
+def isolated_db(tmp_path, monkeypatch):
+    """Run a test against its own database file instead of the shared library.db."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "library_test.db"))
+    database.init_database()
+    yield database.DATABASE
+    database.close_pools()
+
+
 # R1 testcases:
 def test_add_book_valid_input():
     """Test adding a book with valid input."""
@@ -382,6 +397,56 @@ def test_search_books_no_results():
     assert len(results) == 0
 
 
+def test_search_matches_substring_semantics(isolated_db):
+    """R6: indexed search returns exactly what a case-insensitive substring scan would."""
+    catalog = [
+        ("The Great Gatsby", "F. Scott Fitzgerald"),
+        ("Great Expectations", "Charles Dickens"),
+        ("A Tale of Two Cities", "Charles Dickens"),
+        ('The "Quoted" Title', "O'Brien"),
+        ("Ögonblick", "Åsa Larsson"),
+    ]
+    for i, (title, author) in enumerate(catalog):
+        add_book_to_catalog(title, author, f"41000000000{i:02d}", 1)
+
+    for term, search_type in [("great", "title"), ("GREAT gat", "title"), ("ti", "title"),
+                              ("dickens", "author"), ('"Quoted"', "title"), ("o'b", "author"),
+                              ("ögon", "title"), ("zzz", "title")]:
+        expected = [b["title"] for b in get_all_books()
+                    if term.lower() in b[search_type].lower()]
+        results = [b["title"] for b in search_books_in_catalog(term, search_type)]
+        assert results == expected, term
+
+
+def test_search_index_follows_catalog_changes_and_pages(isolated_db):
+    """R6: the full-text index is kept in sync by triggers and supports LIMIT/OFFSET."""
+    for i in range(5):
+        add_book_to_catalog(f"Paged Volume {i}", "Author", f"42000000000{i:02d}", 1)
+
+    page = search_books_in_catalog("paged vol", "title", limit=2, offset=2)
+    assert [b["title"] for b in page] == ["Paged Volume 2", "Paged Volume 3"]
+
+    conn = database.get_db_connection()
+    conn.execute("UPDATE books SET title = 'Renamed Volume' WHERE isbn = '4200000000000'")
+    conn.commit()
+    conn.close()
+    assert len(search_books_in_catalog("paged vol", "title")) == 4
+    assert [b["isbn"] for b in search_books_in_catalog("renamed", "title")] == ["4200000000000"]
+
+
+def test_search_by_prefix_uses_casefolded_columns(isolated_db):
+    """R6: prefix matching is case-insensitive and only matches at the start."""
+    add_book_to_catalog("Straße der Bücher", "Ödön Author", "4300000000001", 1)
+    add_book_to_catalog("Strange Tales", "Writer", "4300000000002", 1)
+    add_book_to_catalog("A Strange Day", "Writer", "4300000000003", 1)
+
+    titles = [b["title"] for b in search_books_in_catalog("STRA", "title", match="prefix")]
+    assert titles == ["Strange Tales", "Straße der Bücher"]
+    assert [b["title"] for b in search_books_in_catalog("STRASSE", "title", match="prefix")] == ["Straße der Bücher"]
+    assert [b["isbn"] for b in search_books_in_catalog("ödön", "author", match="prefix")] == ["4300000000001"]
+    assert search_books_in_catalog("Strange", "title", match="fuzzy") == []
+
+
 # R7 testcases:
 def test_patron_status_with_borrowed_books():
     """Test generating a patron status report with borrowed books."""
@@ -458,6 +523,31 @@ def test_patron_status_with_borrowing_history():
     assert "History Book" in history_titles
 
 
+def test_patron_status_fees_and_paged_history(isolated_db):
+    """R7: per-loan fees come from the loaded loans and history is paged newest first."""
+    add_book_to_catalog("Status Book", "Author", "4000000000004", 10)
+    book_id = database.get_book_by_isbn("4000000000004")["id"]
+    now = datetime.now()
+    for days_ago in (40, 30, 20):
+        borrowed = now - timedelta(days=days_ago)
+        database.insert_borrow_record("343434", book_id, borrowed, borrowed + timedelta(days=14))
+    database.close_open_loan("343434", book_id, now)  # closes the oldest loan
+
+    status = get_patron_status_report("343434", history_limit=2)
+
+    fees = sorted(b["late_fee"] for b in status["currently_borrowed"])
+    assert fees == [3.0, 12.5]  # 6 and 16 days overdue
+    assert status["total_late_fees"] == 15.5
+    assert status["books_borrowed_count"] == 2
+    assert len(status["borrowing_history"]) == 2
+    assert status["history_has_more"] is True
+    assert status["borrowing_history"][0]["borrow_date"] > status["borrowing_history"][1]["borrow_date"]
+
+    last_page = get_patron_status_report("343434", history_limit=2, history_offset=2)
+    assert len(last_page["borrowing_history"]) == 1
+    assert last_page["history_has_more"] is False
+
+
 #extra tests
 
 def test_add_book_title_too_long():
@@ -517,7 +607,7 @@ def test_borrow_book_book_not_found(monkeypatch):
     """
     R3: cover branch where get_book_by_id returns None.
     """
-    monkeypatch.setattr(ls, "get_book_by_id", lambda book_id: None)
+    monkeypatch.setattr(ls, "get_book_by_id", lambda book_id, conn=None: None)
 
     success, message = borrow_book_by_patron("555555", 999999)
     assert success is False
@@ -548,29 +638,33 @@ def test_return_book_with_late_fee_branch(monkeypatch):
     R4 + R5: hit the 'late fee > 0' path in return_book_by_patron
     without depending on real DB dates.
     """
-    monkeypatch.setattr(ls, "get_book_by_id",lambda book_id: {"id": book_id, "title": "Late Book"})
-
-    borrowed_record = {"book_id": 1, "due_date": datetime.now() - timedelta(days=3)}
-    monkeypatch.setattr(ls, "get_patron_borrowed_books",lambda patron_id: [borrowed_record])
-
-    monkeypatch.setattr(ls, "update_borrow_record_return_date",lambda patron_id, book_id, return_date: True)
-                        
-    monkeypatch.setattr(ls, "update_book_availability",lambda book_id, delta: True)
-
-    monkeypatch.setattr(
-        ls,
-        "calculate_late_fee_for_book",
-        lambda patron_id, book_id: {
-            "fee_amount": 5.0,
-            "days_overdue": 3,
-            "status": "Overdue",
-        },
-    )
+    monkeypatch.setattr(ls, "get_book_by_id", lambda book_id, conn=None: {"id": book_id, "title": "Late Book"})
+
+    closed_loan = {"loan_id": 1, "book_id": 1, "due_date": datetime.now() - timedelta(days=3)}
+    monkeypatch.setattr(ls, "close_open_loan", lambda patron_id, book_id, return_date, conn=None: closed_loan)
+
+    monkeypatch.setattr(ls, "update_book_availability", lambda book_id, delta, conn=None: True)
 
     success, message = return_book_by_patron("123456", 1)
     assert success is True
     assert "late fee" in message.lower()
-    assert "$5.00" in message
+    assert "$1.50" in message
+
+
+def test_return_overdue_book_reports_fee_from_closed_loan(isolated_db):
+    """R4 + R5: the fee in the return message comes from the loan that was just closed."""
+    add_book_to_catalog("Overdue Return Book", "Author", "4000000000003", 1)
+    book_id = database.get_book_by_isbn("4000000000003")["id"]
+    borrowed = datetime.now() - timedelta(days=24)
+    database.insert_borrow_record("232323", book_id, borrowed, borrowed + timedelta(days=14))
+    database.update_book_availability(book_id, -1)
+
+    success, message = return_book_by_patron("232323", book_id)
+
+    assert success is True
+    assert "$6.50" in message  # 10 days late: 7 * $0.50 + 3 * $1.00
+    assert database.get_book_by_id(book_id)["available_copies"] == 1
+    assert database.get_patron_borrow_count("232323") == 0
 
 def test_calculate_late_fee_invalid_patron_id_branch():
     """
@@ -591,4 +685,152 @@ def test_calculate_late_fee_book_not_found_branch(monkeypatch):
     info = calculate_late_fee_for_book("123456", 9999)  
     assert info["fee_amount"] == 0.0
     assert info["days_overdue"] == 0
-    assert info["status"] == "Book not found"
\ No newline at end of file
+    assert info["status"] == "Book not found"
+
+
+# Concurrency testcases:
+def test_concurrent_borrows_never_oversell(isolated_db):
+    """
+    Many patrons race for the last copies of one book: exactly total_copies
+    borrows may succeed and availability must never go negative.
+    """
+    copies = 5
+    add_book_to_catalog("Contended Book", "Author", "4000000000001", copies)
+    book_id = database.get_book_by_isbn("4000000000001")["id"]
+    patrons = [f"{700000 + i}" for i in range(40)]
+
+    results = []
+    results_lock = threading.Lock()
+    start = threading.Barrier(len(patrons))
+
+    def attempt(patron_id):
+        start.wait()
+        success, _ = borrow_book_by_patron(patron_id, book_id)
+        with results_lock:
+            results.append(success)
+
+    threads = [threading.Thread(target=attempt, args=(p,)) for p in patrons]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=30)
+
+    conn = database.get_db_connection()
+    open_loans = conn.execute(
+        "SELECT COUNT(*) FROM borrow_records WHERE book_id = ? AND return_date IS NULL", (book_id,)
+    ).fetchone()[0]
+    conn.close()
+
+    assert results.count(True) == copies
+    assert open_loans == copies
+    assert database.get_book_by_id(book_id)["available_copies"] == 0
+
+
+def test_concurrent_borrow_throughput(isolated_db):
+    """Stress the borrow path from several threads and hold it to a borrows/second floor."""
+    add_book_to_catalog("Plentiful Book", "Author", "4000000000002", 10000)
+    book_id = database.get_book_by_isbn("4000000000002")["id"]
+    workers, borrows_per_worker = 8, 25
+
+    results = []
+
+    def run(worker):
+        for i in range(borrows_per_worker):
+            # a fresh patron per borrow keeps the per-patron limit out of the way
+            results.append(borrow_book_by_patron(f"{800000 + worker * 1000 + i}", book_id))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(w,)) for w in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+    elapsed = time.perf_counter() - started
+
+    total = workers * borrows_per_worker
+    assert not any(t.is_alive() for t in threads)
+    failures = [message for success, message in results if not success]
+    assert len(results) == total and failures == []
+    # a floor far below what the pooled borrow path manages, so only a real regression trips it
+    assert total / elapsed > 100, f"{total} borrows took {elapsed:.3f}s"
+    assert database.get_book_by_id(book_id)["available_copies"] == 10000 - total
+
+
+# Circulation batch testcases:
+def test_circulation_batch_borrow_and_return(isolated_db):
+    add_book_to_catalog("Batch Book", "Author", "4100000000001", 2)
+    book_id = database.get_book_by_isbn("4100000000001")["id"]
+
+    result = process_circulation_batch([
+        {"action": "borrow", "patron_id": "510001", "book_id": book_id},
+        {"action": "borrow", "patron_id": "510002", "book_id": book_id},
+        {"action": "borrow", "patron_id": "510003", "book_id": book_id},
+        {"action": "return", "patron_id": "510001", "book_id": book_id},
+    ])
+
+    assert [r["success"] for r in result["results"]] == [True, True, False, True]
+    assert "not available" in result["results"][2]["message"]
+    assert result["results"][3]["late_fee"] == 0.0
+    assert (result["succeeded"], result["failed"]) == (3, 1)
+    assert database.get_book_by_id(book_id)["available_copies"] == 1
+
+
+def test_circulation_batch_failed_item_is_undone_alone(isolated_db, monkeypatch):
+    add_book_to_catalog("Savepoint Book", "Author", "4100000000002", 3)
+    book_id = database.get_book_by_isbn("4100000000002")["id"]
+    real_insert = ls.insert_borrow_record
+
+    def flaky_insert(patron_id, *args, **kwargs):
+        return False if patron_id == "520002" else real_insert(patron_id, *args, **kwargs)
+
+    monkeypatch.setattr(ls, "insert_borrow_record", flaky_insert)
+    result = process_circulation_batch([
+        {"action": "borrow", "patron_id": "520001", "book_id": book_id},
+        {"action": "borrow", "patron_id": "520002", "book_id": book_id},
+        {"action": "borrow", "patron_id": "52000x", "book_id": book_id},
+    ])
+
+    assert [r["success"] for r in result["results"]] == [True, False, False]
+    # the failed item's copy checkout was rolled back with it
+    assert database.get_book_by_id(book_id)["available_copies"] == 2
+
+
+def test_circulation_batch_late_fees_in_one_pass(isolated_db):
+    add_book_to_catalog("Late Batch Book", "Author", "4100000000003", 2)
+    book_id = database.get_book_by_isbn("4100000000003")["id"]
+    now = datetime.now()
+    for patron_id, days_late in (("530001", 3), ("530002", 10)):
+        database.insert_borrow_record(patron_id, book_id, now - timedelta(days=14 + days_late),
+                                      now - timedelta(days=days_late))
+        database.update_book_availability(book_id, -1)
+
+    result = process_circulation_batch([
+        {"action": "return", "patron_id": "530001", "book_id": book_id},
+        {"action": "return", "patron_id": "530002", "book_id": book_id},
+        {"action": "return", "patron_id": "530002", "book_id": book_id},
+    ])
+
+    assert [r.get("late_fee") for r in result["results"]] == [1.50, 6.50, None]
+    assert "Late fee: $6.50" in result["results"][1]["message"]
+    assert result["results"][2]["message"] == "You have not borrowed this book."
+    assert result["total_late_fees"] == 8.00
+
+
+def test_circulation_batch_throughput(isolated_db):
+    """A 50-item batch should cost about as much as a handful of single requests."""
+    add_book_to_catalog("Desk Book", "Author", "4100000000004", 100)
+    book_id = database.get_book_by_isbn("4100000000004")["id"]
+    operations = [{"action": "borrow", "patron_id": f"{540000 + i}", "book_id": book_id} for i in range(50)]
+
+    started = time.perf_counter()
+    borrow_book_by_patron("549999", book_id)
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = process_circulation_batch(operations)
+    batch = time.perf_counter() - started
+
+    assert result["succeeded"] == 50
+    assert database.get_book_by_id(book_id)["available_copies"] == 49
+    # one transaction for the whole batch: well under half the cost of 50 single borrows
+    assert batch < 50 * single * 0.5, f"50-item batch {batch * 1000:.2f}ms vs single borrow {single * 1000:.2f}ms"
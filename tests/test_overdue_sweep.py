@@ -0,0 +1,110 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from services import overdue_sweep
+from services.library_service import calculate_late_fee_for_book
+
+ENGINES = ["python", pytest.param("numpy", marks=pytest.mark.skipif(
+    overdue_sweep.np is None, reason="NumPy is not installed"))]
+
+
+@pytest.fixture
+def sweep_db(tmp_path, monkeypatch):
+    """A database with one book per (patron, days overdue) open loan."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "sweep_test.db"))
+    database.init_database()
+    yield database.DATABASE
+    database.close_pools()
+
+
+def seed_loans(now, patrons, days_overdue):
+    """Give each patron one open loan per entry of days_overdue, each on its own book."""
+    conn = database.get_db_connection()
+    for i, days in enumerate(days_overdue):
+        isbn = f"{8000000000000 + i}"
+        conn.execute("INSERT INTO books (title, author, isbn, total_copies, available_copies) "
+                     "VALUES (?, 'Author', ?, 100, 100)", (f"Sweep Book {i}", isbn))
+        book_id = conn.execute("SELECT id FROM books WHERE isbn = ?", (isbn,)).fetchone()[0]
+        # half a day off the boundary so "now" moving during the test cannot change the day count
+        due = now - timedelta(days=days, hours=12)
+        for patron_id in patrons:
+            conn.execute("INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) "
+                         "VALUES (?, ?, ?, ?)",
+                         (patron_id, book_id, database.to_epoch(due - timedelta(days=14)), database.to_epoch(due)))
+    conn.commit()
+    conn.close()
+
+
+def test_fee_table_follows_schedule():
+    table = overdue_sweep.build_fee_table()
+    assert table[:9] == [0, 50, 100, 150, 200, 250, 300, 350, 450]
+    assert table[18] == 1450 and table[19] == 1500 and table[-1] == 1500
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_sweep_matches_calculate_late_fee_for_book(sweep_db, engine):
+    now = datetime.now()
+    days_overdue = [-3, 0, 1, 6, 7, 8, 12, 18, 19, 25, 400]
+    patrons = ["900001", "900002", "900003"]
+    seed_loans(now, patrons, days_overdue)
+
+    summary = overdue_sweep.sweep_overdue_fees(as_of=now, chunk_size=4, engine=engine)
+    report = {row["patron_id"]: row for row in database.get_overdue_fee_report(summary["run_id"])}
+
+    book_ids = range(1, len(days_overdue) + 1)
+    for patron_id in patrons:
+        expected = [calculate_late_fee_for_book(patron_id, book_id)["fee_amount"] for book_id in book_ids]
+        assert report[patron_id]["total_fees"] == round(sum(expected), 2)
+        assert report[patron_id]["overdue_loans"] == sum(1 for fee in expected if fee > 0)
+    assert summary["engine"] == engine
+    assert summary["patrons"] == 3
+    assert summary["total_fees"] == round(3 * report["900001"]["total_fees"], 2)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_sweep_subtracts_ledger_payments(sweep_db, engine):
+    now = datetime.now()
+    seed_loans(now, ["900030", "900031"], [10, 20, 30])
+    # loan ids follow the seeding order: book 1 is loans 1-2, book 2 is 3-4, book 3 is 5-6
+    database.record_payment("txn_part", "900030", 1, 1, 4.00)
+    database.record_payment("txn_full", "900030", 3, 2, 15.00)
+    database.record_payment("txn_refunded", "900031", 6, 3, 15.00)
+    database.record_refund("txn_refunded", 5.00)
+
+    summary = overdue_sweep.sweep_overdue_fees(as_of=now, chunk_size=2, engine=engine)
+    report = {row["patron_id"]: row for row in database.get_overdue_fee_report(summary["run_id"])}
+
+    for patron_id in ("900030", "900031"):
+        expected = [calculate_late_fee_for_book(patron_id, book_id)["fee_amount"] for book_id in (1, 2, 3)]
+        assert report[patron_id]["total_fees"] == round(sum(expected), 2)
+        assert report[patron_id]["overdue_loans"] == sum(1 for fee in expected if fee > 0)
+    assert report["900030"] == {"patron_id": "900030", "overdue_loans": 2, "total_fees": 17.5}
+    assert report["900031"] == {"patron_id": "900031", "overdue_loans": 3, "total_fees": 26.5}
+
+
+def test_returned_loans_are_not_charged(sweep_db):
+    now = datetime.now()
+    seed_loans(now, ["900010"], [10, 20])
+    database.close_open_loan("900010", 1, now)
+
+    overdue_sweep.sweep_overdue_fees(as_of=now, engine="python")
+
+    assert database.get_overdue_fee_report() == [
+        {"patron_id": "900010", "overdue_loans": 1, "total_fees": 15.0}
+    ]
+
+
+def test_sweep_command_prints_summary(sweep_db, capsys):
+    seed_loans(datetime.now(), ["900020"], [3])
+
+    assert overdue_sweep.main(["--database", sweep_db, "--engine", "python"]) == 0
+
+    assert '"total_fees": 1.5' in capsys.readouterr().out
@@ -0,0 +1,58 @@
+import os
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import database
+from services.page_cache import PageCache, versioned_key
+
+
+def test_lru_evicts_least_recently_used_entry():
+    cache = PageCache(max_entries=2, max_bytes=1024)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"  # "b" is now least recently used
+    cache.set("c", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_cap_is_enforced():
+    cache = PageCache(max_entries=100, max_bytes=10)
+    cache.set("a", "12345")
+    cache.set("b", "12345")
+    cache.set("c", "123")
+    cache.set("huge", "x" * 11)  # larger than the whole cache: never stored
+
+    stats = cache.stats()
+    assert stats["bytes"] <= 10
+    assert cache.get("a") is None and cache.get("huge") is None
+    assert cache.get("c") == "123"
+
+
+def test_hit_and_miss_metrics():
+    cache = PageCache()
+    renders = []
+    for _ in range(3):
+        cache.get_or_render("page", lambda: renders.append(1) or "<html>")
+
+    stats = cache.stats()
+    assert len(renders) == 1
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+
+
+def test_versioned_key_changes_when_catalog_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "page_cache_test.db"))
+    database.init_database()
+    try:
+        before = versioned_key("catalog")
+        database.bump_catalog_version()
+        after_bump = versioned_key("catalog")
+        database.insert_book("Versioned Book", "Author", "6300000000001", 1, 1)
+        assert len({before, after_bump, versioned_key("catalog")}) == 3
+    finally:
+        database.close_pools()
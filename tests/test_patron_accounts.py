@@ -0,0 +1,113 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from services import patron_accounts
+from services.library_service import (
+    add_book_to_catalog, borrow_book_by_patron, return_book_by_patron,
+    process_circulation_batch, get_patron_status_report
+)
+
+
+@pytest.fixture
+def accounts_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "accounts_test.db"))
+    database.init_database()
+    add_book_to_catalog("Account Book", "Author", "8200000000001", 10)
+    yield database.get_book_by_isbn("8200000000001")["id"]
+    database.close_pools()
+
+
+def insert_raw_loan(patron_id, book_id, borrowed, returned=None, stamp=database.to_epoch):
+    """Write a loan straight into borrow_records, bypassing the summary counters."""
+    conn = database.get_db_connection()
+    conn.execute("INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date) "
+                 "VALUES (?, ?, ?, ?, ?)",
+                 (patron_id, book_id, stamp(borrowed), stamp(borrowed + timedelta(days=14)),
+                  stamp(returned) if returned else None))
+    conn.commit()
+    conn.close()
+
+
+def test_borrow_and_return_keep_summary_current(accounts_db):
+    book_id = accounts_db
+    borrow_book_by_patron("730001", book_id)
+    borrow_book_by_patron("730001", book_id)
+    borrowed = datetime.now() - timedelta(days=24)
+    database.insert_borrow_record("730001", book_id, borrowed, borrowed + timedelta(days=14))
+    assert database.get_patron_borrow_count("730001") == 3
+
+    return_book_by_patron("730001", book_id)  # closes the oldest loan, 10 days late
+
+    summary = database.get_patron_summary("730001")
+    assert summary["active_loans"] == 2
+    assert summary["accrued_fees"] == 6.50
+    assert datetime.now() - summary["last_activity"] < timedelta(minutes=1)
+    status = get_patron_status_report("730001")
+    assert status["accrued_fees"] == 6.50
+    assert status["books_borrowed_count"] == 2
+
+
+def test_failed_return_leaves_summary_alone(accounts_db):
+    assert return_book_by_patron("730002", accounts_db)[0] is False
+    assert database.get_patron_summary("730002") == {
+        "patron_id": "730002", "active_loans": 0, "accrued_fees": 0.00, "last_activity": None
+    }
+
+
+def test_circulation_batch_accrues_fees_per_patron(accounts_db):
+    book_id = accounts_db
+    now = datetime.now()
+    for days_late in (3, 10):
+        borrowed = now - timedelta(days=14 + days_late)
+        database.insert_borrow_record("730003", book_id, borrowed, borrowed + timedelta(days=14))
+
+    process_circulation_batch([{"action": "return", "patron_id": "730003", "book_id": book_id}] * 2)
+
+    assert database.get_patron_summary("730003")["accrued_fees"] == 8.00
+    assert database.get_patron_borrow_count("730003") == 0
+
+
+def test_reconcile_rebuilds_drifted_rows(accounts_db):
+    book_id = accounts_db
+    borrow_book_by_patron("730004", book_id)
+    now = datetime.now()
+    insert_raw_loan("730005", book_id, now - timedelta(days=30), returned=now - timedelta(days=6))  # 10 days late
+    insert_raw_loan("730005", book_id, now - timedelta(days=2))
+    assert database.get_patron_borrow_count("730005") == 0
+
+    dry = patron_accounts.reconcile_patron_summaries(dry_run=True)
+    assert dry["corrected"] == 1
+    assert database.get_patron_borrow_count("730005") == 0
+
+    result = patron_accounts.reconcile_patron_summaries()
+
+    assert result["corrected"] == 1
+    assert result["corrections"][0]["patron_id"] == "730005"
+    summary = database.get_patron_summary("730005")
+    assert (summary["active_loans"], summary["accrued_fees"]) == (1, 6.50)
+    assert database.get_patron_borrow_count("730004") == 1
+    assert patron_accounts.reconcile_patron_summaries()["corrected"] == 0
+
+
+def test_migration_backfills_counters(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "legacy.db"))
+    try:
+        database.migrate(target_version=8)
+        database.insert_book("Legacy Book", "Author", "8200000000002", 5, 5)
+        # version 8 still stores ISO strings
+        insert_raw_loan("730006", 1, datetime.now() - timedelta(days=3), stamp=datetime.isoformat)
+        insert_raw_loan("730006", 1, datetime.now() - timedelta(days=1), stamp=datetime.isoformat)
+
+        database.migrate()
+
+        assert database.get_patron_borrow_count("730006") == 2
+    finally:
+        database.close_pools()
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from services.library_service import (
+    add_book_to_catalog, calculate_late_fee_for_book, get_patron_status_report,
+    pay_late_fees, pay_all_late_fees, refund_late_fee_payment, return_book_by_patron, process_circulation_batch
+)
+from services.payment_service import PaymentGateway
+
+
+@pytest.fixture
+def ledger_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "ledger_test.db"))
+    database.init_database()
+    yield
+    database.close_pools()
+
+
+@pytest.fixture
+def overdue_books(ledger_db):
+    """Two books patron 123456 has had out for 24 days (10 overdue: $6.50 each)."""
+    book_ids = []
+    for number in range(2):
+        isbn = f"830000000000{number}"
+        add_book_to_catalog(f"Ledger Book {number}", "Author", isbn, 3)
+        book_ids.append(database.get_book_by_isbn(isbn)["id"])
+        borrowed = datetime.now() - timedelta(days=24)
+        database.insert_borrow_record("123456", book_ids[-1], borrowed, borrowed + timedelta(days=14))
+    return book_ids
+
+
+def gateway(transaction_id="txn_123456_1"):
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (True, transaction_id, "Payment processed")
+    gateway.refund_payment.return_value = (True, "Refund processed")
+    return gateway
+
+
+def test_entries_are_written_in_batches(ledger_db):
+    for number in range(300):
+        database.record_payment(f"txn_{number}", "123456", number, 1, 0.50)
+
+    assert database.flush_ledger(timeout=5)
+    stats = database.get_ledger_stats()
+    assert stats["written"] == 300 and stats["pending"] == 0 and stats["held"] == 0
+    assert stats["batches"] < 300
+    assert database.get_paid_amounts(range(300)) == {number: 0.50 for number in range(300)}
+
+
+def test_refund_is_split_across_the_transaction_loans(ledger_db):
+    database.record_payment("txn_A", "123456", 1, 1, 1.25)
+    database.record_payment("txn_A", "123456", 2, 2, 1.75)
+    database.record_refund("txn_A", 2.00)
+    database.record_refund("txn_unknown", 1.00)
+
+    assert database.get_paid_amounts([1, 2, 3]) == {1: 0.00, 2: 1.00}
+    assert [(e["entry_type"], e["loan_id"], e["amount"]) for e in database.get_ledger_entries("txn_A")] == [
+        ("payment", 1, 1.25), ("payment", 2, 1.75), ("refund", 1, 1.25), ("refund", 2, 0.75)]
+    assert database.get_ledger_entries("txn_unknown")[0]["loan_id"] is None
+
+
+def test_paid_lookup_uses_loan_index(ledger_db):
+    conn = database.get_db_connection()
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT loan_id, SUM(amount) FROM payment_ledger "
+                        "WHERE loan_id IN (1, 2) GROUP BY loan_id").fetchall()
+    conn.close()
+    assert any("idx_payment_ledger_loan" in row["detail"] for row in plan)
+
+
+def test_paid_fee_is_no_longer_owed(overdue_books):
+    book_id = overdue_books[0]
+    assert pay_late_fees("123456", book_id, gateway())[0] is True
+
+    fee_info = calculate_late_fee_for_book("123456", book_id)
+    assert (fee_info["fee_amount"], fee_info["amount_paid"]) == (0.00, 6.50)
+    assert pay_late_fees("123456", book_id, gateway()) == (False, "No late fees to pay for this book.", None)
+
+    report = get_patron_status_report("123456")
+    assert report["total_late_fees"] == 6.50
+    assert sorted((loan.late_fee, loan.amount_paid) for loan in report["currently_borrowed"]) == [
+        (0.00, 6.50), (6.50, 0.00)]
+
+
+def test_pay_all_charges_only_what_is_still_owed(overdue_books):
+    pay_late_fees("123456", overdue_books[0], gateway())
+    all_gateway = gateway("txn_123456_2")
+
+    success, _, _, allocations = pay_all_late_fees("123456", all_gateway)
+
+    assert success is True
+    assert [allocation["book_id"] for allocation in allocations] == [overdue_books[1]]
+    assert all_gateway.process_payment.call_args.kwargs["amount"] == 6.50
+    assert get_patron_status_report("123456")["total_late_fees"] == 0.00
+
+
+def test_refund_makes_fee_owed_again(overdue_books):
+    pay_late_fees("123456", overdue_books[0], gateway())
+    refund_late_fee_payment("txn_123456_1", 6.50, gateway())
+
+    assert calculate_late_fee_for_book("123456", overdue_books[0])["fee_amount"] == 6.50
+
+
+def a_day_passes(patron_id):
+    """Move the patron's open loans one day further past due."""
+    conn = database.get_db_connection()
+    conn.execute("UPDATE borrow_records SET due_date = due_date - 86400 WHERE patron_id = ? AND return_date IS NULL",
+                 (patron_id,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("pay_all", [False, True])
+def test_same_amount_owed_on_later_days_is_charged_each_time(ledger_db, pay_all):
+    add_book_to_catalog("Ledger Book", "Author", "8300000000009", 3)
+    book_id = database.get_book_by_isbn("8300000000009")["id"]
+    due = datetime.now() - timedelta(days=7, hours=12)
+    database.insert_borrow_record("123456", book_id, due - timedelta(days=14), due)
+
+    transaction_ids = []
+    for day, owed in enumerate((3.50, 1.00, 1.00), start=1):
+        payment_gateway = gateway(f"txn_123456_{day}")
+        if pay_all:
+            success, _, transaction_id, _ = pay_all_late_fees("123456", payment_gateway)
+        else:
+            success, _, transaction_id = pay_late_fees("123456", book_id, payment_gateway)
+        assert success is True
+        assert payment_gateway.process_payment.call_args.kwargs["amount"] == owed
+        transaction_ids.append(transaction_id)
+        a_day_passes("123456")
+
+    assert transaction_ids == ["txn_123456_1", "txn_123456_2", "txn_123456_3"]
+    assert calculate_late_fee_for_book("123456", book_id)["amount_paid"] == 5.50
+
+
+def test_returns_accrue_only_what_is_still_owed(overdue_books):
+    for book_id in overdue_books:
+        database.update_book_availability(book_id, -1)
+    pay_late_fees("123456", overdue_books[0], gateway())
+    database.record_payment("txn_123456_2", "123456", 2, overdue_books[1], 2.00)
+
+    assert return_book_by_patron("123456", overdue_books[0])[1].endswith("No late fees.")
+    batch = process_circulation_batch([{"action": "return", "patron_id": "123456", "book_id": overdue_books[1]}])
+
+    assert batch["total_late_fees"] == 4.50
+    assert database.get_patron_summary("123456")["accrued_fees"] == 4.50
+
+
+def test_close_pools_writes_queued_entries(ledger_db):
+    database.record_payment("txn_A", "123456", 1, 1, 2.00)
+    database.close_pools()
+
+    assert database.get_paid_amounts([1]) == {1: 2.00}
+
+
+def failing_writes(monkeypatch, failures):
+    """Make the next `failures` ledger writes raise, then write normally; returns [failures left]."""
+    write = database.write_ledger_entries
+    remaining = [failures]
+
+    def flaky(entries, conn=None):
+        if remaining[0] > 0:
+            remaining[0] -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return write(entries, conn=conn)
+
+    monkeypatch.setattr(database, "write_ledger_entries", flaky)
+    monkeypatch.setattr(database, "LEDGER_WRITE_ATTEMPTS", 1)
+    monkeypatch.setattr(database, "LEDGER_RETRY_SECONDS", 0.01)
+    return remaining
+
+
+def test_failed_writes_are_held_and_retried(ledger_db, monkeypatch):
+    failing_writes(monkeypatch, 3)
+    database.record_payment("txn_A", "123456", 1, 1, 2.00)
+    database.record_refund("txn_A", 0.50)
+
+    deadline = time.monotonic() + 5
+    while database.get_ledger_stats()["written"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = database.get_ledger_stats()
+    assert stats["written"] == 2 and stats["held"] == 0 and stats["write_errors"] == 3
+    assert database.get_paid_amounts([1]) == {1: 1.50}
+
+
+def test_ledger_is_not_read_while_entries_are_held(ledger_db, monkeypatch):
+    remaining = failing_writes(monkeypatch, 1000)
+    database.record_payment("txn_A", "123456", 1, 1, 2.00)
+
+    with pytest.raises(sqlite3.OperationalError):
+        database.get_paid_amounts([1])
+    with pytest.raises(sqlite3.OperationalError):
+        database.get_payment_allocations("txn_A")
+
+    remaining[0] = 0
+    assert database.get_paid_amounts([1]) == {1: 2.00}
+    assert database.get_ledger_stats()["held"] == 0
+
+
+def test_close_raises_when_held_entries_cannot_be_written(ledger_db, monkeypatch):
+    failing_writes(monkeypatch, 1000)
+    writer = database.get_ledger_writer()
+    database.record_payment("txn_A", "123456", 1, 1, 2.00)
+    assert database.flush_ledger(timeout=5) is False
+
+    with pytest.raises(sqlite3.OperationalError):
+        database.close_pools()
+    assert writer.stats()["held"] == 1
+    assert not database._pools
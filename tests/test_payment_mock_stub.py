@@ -7,11 +7,24 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
+from datetime import datetime, timedelta
+
 import pytest
 from unittest.mock import Mock
-from services.library_service import pay_late_fees, refund_late_fee_payment
+import database
+from database import Loan, to_epoch
+from services.library_service import pay_all_late_fees, pay_late_fees, refund_late_fee_payment
 from services.payment_service import PaymentGateway
 
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    """Each test gets its own database, so no idempotency key recorded by another test is replayed."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "payments_test.db"))
+    database.init_database()
+    yield
+    database.close_pools()
+
 def test_pay_late_fees_successful_payment(mocker):
 
     mocker.patch(
@@ -413,4 +426,57 @@ def test_refund_late_fee_with_decimal_amount(mocker):
     
     assert success is True
     
-    mock_gateway.refund_payment.assert_called_once_with("txn_123456", 3.75)
\ No newline at end of file
+    mock_gateway.refund_payment.assert_called_once_with("txn_123456", 3.75)
+
+def overdue_loan(loan_id, book_id, title, days_overdue):
+    due = datetime.now() - timedelta(days=days_overdue, hours=12)
+    return Loan(loan_id, "123456", book_id, title, "Author", to_epoch(due - timedelta(days=14)), to_epoch(due))
+
+
+def test_pay_all_late_fees_single_charge_with_breakdown(mocker):
+    mocker.patch(
+        'services.library_service.get_patron_borrowed_books',
+        return_value=[overdue_loan(11, 1, "Book A", 3), overdue_loan(12, 2, "Book B", -2),
+                      overdue_loan(13, 3, "Book C", 10)]
+    )
+    record = mocker.patch('services.library_service.record_payment')
+    mock_gateway = Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (True, "txn_123456_9", "Payment of $8.00 processed successfully")
+
+    success, message, transaction_id, allocations = pay_all_late_fees("123456", mock_gateway)
+
+    assert success is True and transaction_id == "txn_123456_9"
+    mock_gateway.process_payment.assert_called_once_with(
+        patron_id="123456",
+        amount=8.00,
+        description="Late fees for 2 book(s): 'Book A' $1.50; 'Book C' $6.50"
+    )
+    assert [(a["loan_id"], a["amount"]) for a in allocations] == [(11, 1.50), (13, 6.50)]
+    assert [c.args for c in record.call_args_list] == [("txn_123456_9", "123456", 11, 1, 1.50),
+                                                        ("txn_123456_9", "123456", 13, 3, 6.50)]
+
+
+def test_pay_all_late_fees_nothing_owed_mock_not_called(mocker):
+    mocker.patch('services.library_service.get_patron_borrowed_books',
+                 return_value=[overdue_loan(21, 1, "Book A", -5)])
+    mock_gateway = Mock(spec=PaymentGateway)
+
+    success, message, transaction_id, allocations = pay_all_late_fees("123456", mock_gateway)
+
+    assert (success, transaction_id, allocations) == (False, None, [])
+    assert message == "No late fees to pay."
+    mock_gateway.process_payment.assert_not_called()
+
+
+def test_pay_all_late_fees_declined_records_nothing(mocker):
+    mocker.patch('services.library_service.get_patron_borrowed_books',
+                 return_value=[overdue_loan(31, 1, "Book A", 4)])
+    record = mocker.patch('services.library_service.record_payment')
+    mock_gateway = Mock(spec=PaymentGateway)
+    mock_gateway.process_payment.return_value = (False, None, "Insufficient funds")
+
+    success, message, transaction_id, _ = pay_all_late_fees("123456", mock_gateway)
+
+    assert success is False and transaction_id is None
+    assert "Payment failed" in message
+    record.assert_not_called()
@@ -0,0 +1,108 @@
+import os
+import sys
+import threading
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+from services.library_service import pay_late_fees
+from services.payment_queue import PaymentQueue, SUCCEEDED, FAILED
+
+
+class StandInGateway:
+    """Local stand-in for the payment gateway; charges wait until release is set."""
+
+    def __init__(self, declines=(), error=None):
+        self.release = threading.Event()
+        self.calls = []
+        self.declines = declines
+        self.error = error
+
+    def process_payment(self, patron_id, amount, description=""):
+        self.calls.append((patron_id, amount, description))
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        if patron_id in self.declines:
+            return False, "", "Card declined"
+        return True, f"txn_{patron_id}_{len(self.calls)}", f"Payment of ${amount:.2f} processed successfully"
+
+
+@pytest.fixture
+def gateway():
+    return StandInGateway()
+
+
+@pytest.fixture
+def queue(gateway):
+    queue = PaymentQueue(workers=2, gateway_factory=lambda: gateway)
+    yield queue
+    gateway.release.set()
+    queue.shutdown()
+
+
+def test_submit_returns_pending_handle_before_gateway_answers(queue, gateway):
+    handle = queue.submit("123456", 4.50, "Late fees for 'Book'", book_id=3)
+
+    assert handle.startswith("pay_")
+    assert queue.get(handle)["status"] in ("pending", "processing")
+
+    gateway.release.set()
+    job = queue.wait(handle, timeout=5)
+    assert job["status"] == SUCCEEDED
+    assert job["transaction_id"] == "txn_123456_1"
+    assert job["book_id"] == 3 and job["amount"] == 4.50
+    assert gateway.calls == [("123456", 4.50, "Late fees for 'Book'")]
+
+
+def test_declines_and_errors_mark_job_failed(gateway):
+    gateway.release.set()
+    queue = PaymentQueue(workers=1, gateway_factory=lambda: gateway)
+    broken = StandInGateway(error=ConnectionError("gateway unreachable"))
+    broken.release.set()
+    gateway.declines = ("654321",)
+    try:
+        declined = queue.wait(queue.submit("654321", 2.00), timeout=5)
+        errored = queue.wait(queue.submit("123456", 2.00, gateway=broken), timeout=5)
+    finally:
+        queue.shutdown()
+
+    assert declined["status"] == FAILED and declined["message"] == "Payment failed: Card declined"
+    assert errored["status"] == FAILED and "gateway unreachable" in errored["message"]
+    assert queue.stats()["failed"] == 2
+
+
+def test_finished_jobs_are_evicted_oldest_first(gateway):
+    gateway.release.set()
+    queue = PaymentQueue(workers=1, gateway_factory=lambda: gateway, max_finished_jobs=2)
+    try:
+        handles = [queue.submit("123456", 1.00) for _ in range(3)]
+        for handle in handles:
+            queue.wait(handle, timeout=5)
+    finally:
+        queue.shutdown()
+
+    assert queue.get(handles[0]) is None
+    assert [queue.get(h)["status"] for h in handles[1:]] == [SUCCEEDED, SUCCEEDED]
+
+
+def test_pay_late_fees_enqueue_returns_handle(mocker, queue, gateway, tmp_path, monkeypatch):
+    import database
+
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "queue_test.db"))
+    database.init_database()
+    mocker.patch("services.library_service.payment_queue", queue)
+    mocker.patch("services.library_service.calculate_late_fee_for_book",
+                 return_value={"fee_amount": 6.50, "days_overdue": 10, "status": "Overdue"})
+    mocker.patch("services.library_service.get_book_by_id", return_value={"id": 1, "title": "Test Book"})
+
+    success, message, handle = pay_late_fees("123456", 1, enqueue=True)
+
+    assert success is True and "pending" in message
+    assert handle.startswith("pay_")
+    gateway.release.set()
+    assert queue.wait(handle, timeout=5)["status"] == SUCCEEDED
+    assert gateway.calls == [("123456", 6.50, "Late fees for 'Test Book'")]
@@ -0,0 +1,145 @@
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from unittest.mock import Mock
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from services.payment_reconciliation import reconcile_payments, write_discrepancy_report
+from services.library_service import refund_late_fee_payment
+from services import payment_service
+from services.payment_service import PaymentGateway
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    """
+    A two-loan charge of $3.00 and one of $5.00 in the ledger, and an older
+    single-fee payment known only from its idempotency record.
+    """
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "reconciliation_test.db"))
+    database.init_database()
+    database.record_payment("txn_A", "123456", 1, 1, 1.25)
+    database.record_payment("txn_A", "123456", 2, 2, 1.75)
+    database.record_payment("txn_B", "654321", 3, 1, 5.00)
+    database.claim_idempotency_key("single-fee", "pay_late_fees", datetime.now())
+    database.complete_idempotency_key("single-fee", json.dumps([True, "Payment successful!", "txn_C"]))
+    yield
+    database.close_pools()
+
+
+def gateway_with(statuses, delay=0.0):
+    def verify(transaction_id):
+        time.sleep(delay)
+        return statuses[transaction_id]
+
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.side_effect = verify
+    return gateway
+
+
+def test_reports_discrepancies_and_caches_matches(ledger, tmp_path):
+    gateway = gateway_with({
+        "txn_A": {"status": "completed", "amount": 3.00},
+        "txn_B": {"status": "completed", "amount": 4.00},
+        "txn_C": {"status": "not_found", "message": "Transaction not found"},
+    })
+
+    summary = reconcile_payments(gateway, concurrency=4)
+
+    assert (summary["checked"], summary["matched"], summary["unverified"]) == (3, 1, 0)
+    assert [(d["transaction_id"], d["issue"]) for d in summary["discrepancies"]] == [
+        ("txn_B", "amount mismatch"), ("txn_C", "missing at gateway")]
+
+    report = tmp_path / "discrepancies.csv"
+    assert write_discrepancy_report(summary["discrepancies"], str(report)) == 2
+    rows = list(csv.DictReader(report.open()))
+    assert rows[0] == {"transaction_id": "txn_B", "patron_id": "654321", "recorded_amount": "5.0",
+                       "recorded_refunds": "0.0", "gateway_status": "completed", "gateway_amount": "4.0",
+                       "issue": "amount mismatch"}
+
+    gateway.verify_payment_status.reset_mock()
+    assert reconcile_payments(gateway)["checked"] == 2
+    assert sorted(call.args[0] for call in gateway.verify_payment_status.call_args_list) == ["txn_B", "txn_C"]
+    assert reconcile_payments(gateway, recheck=True)["checked"] == 3
+
+
+def test_unanswered_transactions_are_checked_again(ledger):
+    def verify(transaction_id):
+        if transaction_id == "txn_C":
+            raise TimeoutError("read timed out")
+        if transaction_id == "txn_B":
+            return {"status": "error", "message": "Gateway returned HTTP 503"}
+        return {"status": "completed", "amount": 3.00}
+
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.side_effect = verify
+
+    summary = reconcile_payments(gateway)
+
+    assert (summary["matched"], summary["unverified"], summary["discrepancies"]) == (1, 2, [])
+    assert reconcile_payments(gateway)["checked"] == 2
+
+
+def test_refunds_in_ledger_set_expected_status(ledger):
+    statuses = {"txn_A": {"status": "completed", "amount": 3.00}, "txn_B": {"status": "refunded", "amount": 5.00},
+                "txn_C": {"status": "completed", "amount": 2.50}}
+    summary = reconcile_payments(gateway_with(statuses))
+    assert [d["issue"] for d in summary["discrepancies"]] == ["gateway status is refunded, ledger expects completed"]
+
+    refund_gateway = Mock(spec=PaymentGateway)
+    refund_gateway.refund_payment.return_value = (True, "Refund of $3.00 processed successfully")
+    assert refund_late_fee_payment("txn_A", 3.00, refund_gateway)[0] is True
+
+    statuses["txn_A"] = {"status": "refunded", "amount": 3.00}
+    summary = reconcile_payments(gateway_with(statuses))
+    assert summary["checked"] == 2  # txn_A again (its cached status was cleared) and txn_B
+    assert [d["transaction_id"] for d in summary["discrepancies"]] == ["txn_B"]
+
+
+def test_wall_time_scales_with_concurrency(ledger):
+    for number in range(37):
+        database.record_payment(f"txn_bulk_{number}", "123456", 1, 1, 1.00)
+    statuses = {f"txn_bulk_{number}": {"status": "completed", "amount": 1.00} for number in range(37)}
+    statuses.update({"txn_A": {"status": "completed", "amount": 3.00},
+                     "txn_B": {"status": "completed", "amount": 5.00},
+                     "txn_C": {"status": "completed"}})
+
+    summary = reconcile_payments(gateway_with(statuses, delay=0.05), concurrency=10)
+
+    assert summary["matched"] == 40
+    assert summary["elapsed"] < 40 * 0.05 / 3  # 4 rounds of 10, not 40 calls in a row
+
+
+def test_concurrency_is_capped_at_gateway_pool_size(ledger, monkeypatch):
+    monkeypatch.setattr(payment_service, "GATEWAY_POOL_SIZE", 2)
+    lock = threading.Lock()
+    in_flight = [0, 0]  # now, most
+
+    def verify(transaction_id):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return {"status": "completed", "amount": {"txn_A": 3.00, "txn_B": 5.00}.get(transaction_id)}
+
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.side_effect = verify
+
+    assert reconcile_payments(gateway, concurrency=16)["concurrency"] == 2
+    assert in_flight[1] == 2
+    assert reconcile_payments(gateway, recheck=True)["concurrency"] == 2
+    assert reconcile_payments(gateway, concurrency=1, recheck=True)["concurrency"] == 1
+    with pytest.raises(ValueError):
+        reconcile_payments(gateway, concurrency=0)
@@ -0,0 +1,360 @@
+import os
+import sqlite3
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pytest
+
+import database
+from app import create_app
+from services.library_service import add_book_to_catalog
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Flask test client backed by its own database file (with the sample books)."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "routes_test.db"))
+    app = create_app()
+    app.config["TESTING"] = True
+    yield app.test_client()
+    database.close_pools()
+
+
+# Catalog pagination testcases:
+def test_api_books_pages_through_whole_catalog(client):
+    for i in range(7):
+        add_book_to_catalog(f"Paging Book {i}", "Author", f"60000000000{i:02d}", 1)
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        data = client.get("/api/books", query_string=params).get_json()
+        assert data["count"] <= 3
+        seen.extend(book["title"] for book in data["books"])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert len(seen) == 10  # 3 sample books + 7 added
+    assert seen == sorted(seen)
+
+
+def test_api_books_available_only_filter(client):
+    data = client.get("/api/books", query_string={"available": "1"}).get_json()
+    titles = [book["title"] for book in data["books"]]
+    assert "1984" not in titles  # the sample data has no copies of 1984 left
+    assert all(book["available_copies"] > 0 for book in data["books"])
+
+
+def test_api_books_rejects_bad_cursor(client):
+    response = client.get("/api/books", query_string={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+def test_catalog_page_links_to_next_page(client, monkeypatch):
+    import routes.catalog_routes as catalog_routes
+    monkeypatch.setattr(catalog_routes, "CATALOG_PAGE_SIZE", 2)
+
+    first = client.get("/catalog").get_data(as_text=True)
+    assert "1984" in first and "Next page" in first
+    assert "To Kill a Mockingbird" not in first
+
+    data = client.get("/api/books", query_string={"limit": 2}).get_json()
+    second = client.get("/catalog", query_string={"cursor": data["next_cursor"]}).get_data(as_text=True)
+    assert "To Kill a Mockingbird" in second
+    assert "Next page" not in second
+
+
+# Page cache testcases:
+def test_catalog_served_from_cache_with_one_state_read(client):
+    from services.page_cache import page_cache
+
+    first = client.get("/catalog").get_data(as_text=True)
+    hits_before = page_cache.stats()["hits"]
+
+    (second,), statements = _traced_requests(client, ("/catalog", {}))
+
+    assert second.get_data(as_text=True) == first
+    assert page_cache.stats()["hits"] == hits_before + 1
+    assert statements == [CATALOG_STATE_READ]
+
+
+def test_borrow_invalidates_cached_catalog(client):
+    before = client.get("/api/books").get_json()
+    gatsby = next(b for b in before["books"] if b["title"] == "The Great Gatsby")
+
+    client.post("/borrow", data={"patron_id": "121314", "book_id": gatsby["id"]})
+
+    after = client.get("/api/books").get_json()
+    gatsby_after = next(b for b in after["books"] if b["id"] == gatsby["id"])
+    assert gatsby_after["available_copies"] == gatsby["available_copies"] - 1
+
+
+def test_pending_flash_bypasses_cache(client):
+    client.get("/catalog")  # warm the cache
+    response = client.post("/borrow", data={"patron_id": "121315", "book_id": 1}, follow_redirects=True)
+    assert "Successfully borrowed" in response.get_data(as_text=True)
+
+
+def test_metrics_endpoint_reports_cache_and_pool(client):
+    client.get("/api/search", query_string={"q": "great"})
+    client.get("/api/search", query_string={"q": "great"})
+    data = client.get("/api/metrics").get_json()
+    assert data["page_cache"]["hits"] >= 1
+    assert data["db_pool"]["checkouts"] > 0
+
+
+# Conditional GET testcases:
+CATALOG_STATE_READ = "SELECT instance, version, changed_at FROM catalog_state WHERE id = 1"
+
+
+def _age_catalog_state(seconds=10):
+    """Move the last catalog change into the past, so its second is over."""
+    conn = database.get_db_connection()
+    conn.execute("UPDATE catalog_state SET changed_at = changed_at - ?", (seconds,))
+    conn.commit()
+    conn.close()
+
+
+def _traced_requests(client, *requests):
+    """Issue requests with SQL tracing on the (single) pooled connection; return responses and SQL."""
+    database.configure_pool(size=1)
+    statements = []
+    conn = database.get_db_connection()
+    conn.set_trace_callback(statements.append)
+    conn.close()
+    try:
+        responses = [client.get(path, headers=headers) for path, headers in requests]
+    finally:
+        database.configure_pool(size=5)
+    return responses, statements
+
+
+def test_api_search_304_reads_only_catalog_state(client):
+    first = client.get("/api/search?q=great")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert first.headers["Last-Modified"]
+
+    (response,), statements = _traced_requests(client, ("/api/search?q=great", {"If-None-Match": etag}))
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.get_data() == b""
+    assert statements == [CATALOG_STATE_READ]
+
+
+def test_catalog_304_reads_only_catalog_state(client):
+    _age_catalog_state()
+    first = client.get("/catalog")
+    etag = first.headers["ETag"]
+
+    (by_etag, by_date), statements = _traced_requests(
+        client,
+        ("/catalog", {"If-None-Match": etag}),
+        ("/catalog", {"If-Modified-Since": first.headers["Last-Modified"]}),
+    )
+
+    assert by_etag.status_code == 304
+    assert by_date.status_code == 304
+    assert statements == [CATALOG_STATE_READ] * 2
+
+
+def test_etag_changes_after_catalog_write(client):
+    etag = client.get("/api/search?q=great").headers["ETag"]
+    add_book_to_catalog("Great New Arrival", "Author", "6100000000001", 1)
+
+    response = client.get("/api/search?q=great", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert "Great New Arrival" in [b["title"] for b in response.get_json()["results"]]
+
+
+def test_validators_change_after_write_by_another_connection(client):
+    _age_catalog_state()
+    first = client.get("/api/search?q=great")
+
+    other = sqlite3.connect(database.DATABASE)
+    other.execute("UPDATE books SET available_copies = available_copies + 1 WHERE title = 'The Great Gatsby'")
+    other.commit()
+    other.close()
+
+    by_etag = client.get("/api/search?q=great", headers={"If-None-Match": first.headers["ETag"]})
+    by_date = client.get("/api/search?q=great", headers={"If-Modified-Since": first.headers["Last-Modified"]})
+    assert by_etag.status_code == by_date.status_code == 200
+    assert by_etag.headers["ETag"] != first.headers["ETag"]
+
+
+def test_last_modified_is_never_shared_by_two_catalog_states(client):
+    first = client.get("/catalog")
+    add_book_to_catalog("Same Second Arrival", "Author", "6100000000002", 1)
+
+    response = client.get("/catalog", headers={"If-Modified-Since": first.headers["Last-Modified"]})
+
+    assert response.status_code == 200
+    assert "Same Second Arrival" in response.get_data(as_text=True)
+
+
+def test_etag_differs_per_query(client):
+    great = client.get("/api/search?q=great").headers["ETag"]
+    mockingbird = client.get("/api/search?q=mockingbird").headers["ETag"]
+    assert great != mockingbird
+    assert client.get("/api/search?q=mockingbird", headers={"If-None-Match": great}).status_code == 200
+
+
+# Circulation batch API testcases:
+def test_circulation_batch_api(client):
+    add_book_to_catalog("Desk Scan Book", "Author", "6200000000001", 3)
+    book_id = database.get_book_by_isbn("6200000000001")["id"]
+
+    borrowed = client.post("/api/circulation/batch", json={
+        "action": "borrow",
+        "operations": [{"patron_id": "610001", "book_id": book_id},
+                       {"patron_id": "610002", "book_id": book_id}],
+    })
+    returned = client.post("/api/circulation/batch", json={
+        "operations": [{"action": "return", "patron_id": "610001", "book_id": book_id},
+                       {"action": "return", "patron_id": "610003", "book_id": book_id}],
+    })
+
+    assert borrowed.status_code == 200
+    assert borrowed.get_json()["succeeded"] == 2
+    assert [r["success"] for r in returned.get_json()["results"]] == [True, False]
+    assert database.get_book_by_id(book_id)["available_copies"] == 2
+
+
+def test_circulation_batch_api_rejects_bad_payload(client):
+    assert client.post("/api/circulation/batch", json=[1, 2]).status_code == 400
+    too_many = [{"action": "borrow", "patron_id": "610001", "book_id": 1}] * 201
+    assert client.post("/api/circulation/batch", json={"operations": too_many}).status_code == 400
+
+
+# Loan export API testcases:
+def test_export_loans_ndjson_and_csv(client):
+    import csv
+    import io
+    import json
+
+    add_book_to_catalog("Export Book", "Author", "6300000000001", 10)
+    book_id = database.get_book_by_isbn("6300000000001")["id"]
+    client.post("/api/circulation/batch", json={
+        "action": "borrow", "operations": [{"patron_id": f"62000{i}", "book_id": book_id} for i in range(5)]})
+
+    ndjson = client.get("/api/loans/export")
+    assert ndjson.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in ndjson.get_data(as_text=True).splitlines()]
+    assert {"620000", "620004"} <= {row["patron_id"] for row in rows}
+
+    one = client.get("/api/loans/export?patron_id=620003&format=csv")
+    assert one.mimetype == "text/csv"
+    table = list(csv.DictReader(io.StringIO(one.get_data(as_text=True))))
+    assert [row["patron_id"] for row in table] == ["620003"]
+    assert table[0]["title"] and table[0]["return_date"] == ""
+
+
+def test_export_loans_validates_parameters(client):
+    assert client.get("/api/loans/export?format=xml").status_code == 400
+    assert client.get("/api/loans/export?patron_id=12").status_code == 400
+    assert client.get("/api/loans/export?start=yesterday").status_code == 400
+    assert client.get("/api/loans/export?start=2000-01-01&end=2000-01-02").get_data() == b""
+
+
+def test_loans_due_soon_api(client):
+    from datetime import datetime, timedelta
+
+    due = datetime.now() + timedelta(days=2)
+    database.insert_borrow_record("640001", 1, due - timedelta(days=14), due)
+
+    data = client.get("/api/loans/due_soon?days=3").get_json()
+
+    assert [loan["patron_id"] for loan in data["loans"]] == ["640001"]
+    assert data["loans"][0]["due_date"] == due.replace(microsecond=0).isoformat()
+
+
+# Payment queue testcases:
+def test_payment_api_queues_and_reports_status(client, monkeypatch):
+    from datetime import datetime, timedelta
+    from services.payment_queue import payment_queue
+
+    class InstantGateway:
+        def process_payment(self, patron_id, amount, description=""):
+            return True, f"txn_{patron_id}_1", f"Payment of ${amount:.2f} processed successfully"
+
+    monkeypatch.setattr(payment_queue, "gateway_factory", InstantGateway)
+    borrowed = datetime.now() - timedelta(days=20, hours=12)
+    database.insert_borrow_record("640002", 1, borrowed, borrowed + timedelta(days=14))
+
+    response = client.post("/api/payments", json={"patron_id": "640002", "book_id": 1})
+    assert response.status_code == 202
+    handle = response.get_json()["handle"]
+
+    payment_queue.wait(handle, timeout=5)
+    status = client.get(response.get_json()["status_url"]).get_json()
+    assert status["status"] == "succeeded"
+    assert status["transaction_id"] == "txn_640002_1" and status["amount"] == 3.00
+    assert client.get("/api/payments/pay_unknown").status_code == 404
+    assert client.post("/api/payments", json={"patron_id": "640003", "book_id": 1}).status_code == 400
+
+
+def test_payment_apis_replay_a_retry_with_the_same_idempotency_key(client, monkeypatch):
+    from datetime import datetime, timedelta
+    import services.library_service as library_service
+    from services.payment_queue import payment_queue
+
+    class InstantGateway:
+        calls = []
+
+        def process_payment(self, patron_id, amount, description=""):
+            self.calls.append(amount)
+            return True, f"txn_{patron_id}_{len(self.calls)}", "Payment processed successfully"
+
+    monkeypatch.setattr(library_service, "PaymentGateway", InstantGateway)
+    monkeypatch.setattr(payment_queue, "gateway_factory", InstantGateway)
+    due = datetime.now() - timedelta(days=10, hours=12)
+    database.insert_borrow_record("640006", 1, due - timedelta(days=14), due)
+    database.insert_borrow_record("640007", 2, due - timedelta(days=14), due)
+
+    first = client.post("/api/late_fee/640006/pay_all", headers={"Idempotency-Key": "retry-1"}).get_json()
+    retry = client.post("/api/late_fee/640006/pay_all", headers={"Idempotency-Key": "retry-1"}).get_json()
+    assert first["success"] is True and retry == first
+
+    handle = client.post("/api/payments", json={"patron_id": "640007", "book_id": 2},
+                         headers={"Idempotency-Key": "retry-2"}).get_json()["handle"]
+    payment_queue.wait(handle, timeout=5)
+    response = client.post("/api/payments", json={"patron_id": "640007", "book_id": 2},
+                           headers={"Idempotency-Key": "retry-2"})
+    assert response.status_code == 200
+    assert response.get_json()["transaction_id"] == payment_queue.get(handle)["transaction_id"]
+    assert InstantGateway.calls == [6.50, 6.50]
+
+
+def test_pay_all_late_fees_api_records_allocation(client, monkeypatch):
+    from datetime import datetime, timedelta
+    import services.library_service as library_service
+
+    class InstantGateway:
+        calls = []
+
+        def process_payment(self, patron_id, amount, description=""):
+            self.calls.append(amount)
+            return True, f"txn_{patron_id}_2", "Payment processed successfully"
+
+    monkeypatch.setattr(library_service, "PaymentGateway", InstantGateway)
+    now = datetime.now()
+    for book_id, days_late in ((1, 3), (2, 10)):
+        due = now - timedelta(days=days_late, hours=12)
+        database.insert_borrow_record("640004", book_id, due - timedelta(days=14), due)
+
+    data = client.post("/api/late_fee/640004/pay_all").get_json()
+
+    assert data["success"] is True and data["total"] == 8.00
+    assert InstantGateway.calls == [8.00]
+    recorded = database.get_payment_allocations("txn_640004_2")
+    assert sorted((row["book_id"], row["amount"]) for row in recorded) == [(1, 1.50), (2, 6.50)]
+    assert client.post("/api/late_fee/640005/pay_all").status_code == 400